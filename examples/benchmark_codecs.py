@@ -0,0 +1,75 @@
+# encoding: utf-8
+"""Benchmark the compression ratio and decode throughput of the LMDB codecs."""
+import time
+import shutil
+import tempfile
+import click
+import numpy as np
+from manet.lmdb.builder import LmdbBuilder
+from manet.lmdb.dataset import LmdbDb
+from manet.lmdb.compression import CODECS, lzma
+from manet.data import prob_map
+
+
+def synthetic_mammogram(shape, rng):
+    """16-bit image with a noisy half-ellipse as breast and a zero background."""
+    rows, cols = np.ogrid[:shape[0], :shape[1]]
+    center = shape[0] / 2.
+    breast = ((rows - center) / (0.45 * shape[0]))**2 + (cols / (0.7 * shape[1]))**2 < 1
+    image = np.zeros(shape, dtype=np.uint16)
+    image[breast] = rng.normal(2000, 300, size=breast.sum()).clip(0, 4095).astype(np.uint16)
+    return image
+
+
+def load_images(num_images, shape):
+    rng = np.random.RandomState(0)
+    images = {'synthetic_{}'.format(idx): synthetic_mammogram(shape, rng) for idx in range(num_images)}
+    for name in ['one', 'two']:
+        try:
+            images['prob_map_' + name] = prob_map(name)[0].astype(np.float32)
+        except RuntimeError:
+            click.echo('Probability map {} not available, skipping.'.format(name))
+    return images
+
+
+def benchmark_codec(path, codec, images, num_epochs):
+    """Write the images with codec and return the compressed size and decode throughput in MB/s."""
+    with LmdbBuilder(path, codec, codec=codec) as builder:
+        for key, image in images.items():
+            builder.write(key, image)
+
+    # Without a persistent transaction raw reads are copied, as the decoded reads are.
+    dataset = LmdbDb(path, codec, persistent_txn=False)
+    with dataset.env.begin(buffers=True) as txn:
+        size = sum(len(txn.get(key.encode('utf-8'))) for key in images)
+
+    start = time.time()
+    for _ in range(num_epochs):
+        for key in images:
+            dataset[key]['data']
+    throughput = num_epochs * sum(_.nbytes for _ in images.values()) / (time.time() - start) / 2**20
+    dataset.close()
+    return size, throughput
+
+
+@click.command()
+@click.option('--num-images', default=8, help='Number of synthetic images.')
+@click.option('--height', default=3328, help='Height of the synthetic images.')
+@click.option('--width', default=2560, help='Width of the synthetic images.')
+@click.option('--num-epochs', default=3, help='Number of passes over the database.')
+def benchmark(num_images, height, width, num_epochs):
+    images = load_images(num_images, (height, width))
+    raw_size = sum(_.nbytes for _ in images.values())
+    path = tempfile.mkdtemp()
+    try:
+        for codec in sorted(CODECS, key=lambda _: CODECS[_][0]):
+            if 'lzma' in codec and lzma is None:
+                continue
+            size, throughput = benchmark_codec(path, codec, images, num_epochs)
+            click.echo('{:>14}: ratio {:5.2f}, decode {:8.1f} MB/s'.format(codec, float(raw_size) / size, throughput))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    benchmark()
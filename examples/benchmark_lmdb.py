@@ -0,0 +1,70 @@
+# encoding: utf-8
+"""Benchmark the read throughput of LmdbDb on a synthetic dataset."""
+import time
+import shutil
+import tempfile
+import click
+import numpy as np
+from manet.lmdb.dataset import LmdbDb
+from manet.lmdb.builder import LmdbBuilder
+from manet.lmdb.memmap import MemmapDb, lmdb_to_memmap
+
+
+def create_synthetic_db(path, db_name, num_items, shape, dtype='uint16'):
+    """Write num_items random images of given shape to an LMDB database."""
+    with LmdbBuilder(path, db_name) as builder:
+        for idx in range(num_items):
+            image = np.random.randint(0, 4096, size=shape).astype(dtype)
+            builder.write('image_{:06d}'.format(idx), image, {'spacing': (0.1, 0.1)})
+
+
+def items_per_second(dataset, keys, num_epochs):
+    """Read all keys num_epochs times in random order and report the items per second."""
+    start = time.time()
+    for _ in range(num_epochs):
+        for key in np.random.permutation(keys):
+            dataset[key]['data'].sum()
+    return num_epochs * len(keys) / (time.time() - start)
+
+
+def batched_items_per_second(dataset, keys, num_epochs, batch_size):
+    """Read all keys num_epochs times in random minibatches and report the items per second."""
+    start = time.time()
+    for _ in range(num_epochs):
+        keys = np.random.permutation(keys)
+        for idx in range(0, len(keys), batch_size):
+            dataset.get_many(keys[idx:idx + batch_size], stack=True)['data'].sum()
+    return num_epochs * len(keys) / (time.time() - start)
+
+
+@click.command()
+@click.option('--num-items', default=2000, help='Number of images in the database.')
+@click.option('--size', default=64, help='Height and width of the images.')
+@click.option('--num-epochs', default=5, help='Number of passes over the database.')
+@click.option('--batch-size', default=32, help='Batch size for the batched reads.')
+def benchmark(num_items, size, num_epochs, batch_size):
+    path = tempfile.mkdtemp()
+    try:
+        create_synthetic_db(path, 'bench', num_items, (size, size))
+        for persistent_txn in [False, True]:
+            dataset = LmdbDb(path, 'bench', persistent_txn=persistent_txn)
+            keys = dataset.keys()
+            rate = items_per_second(dataset, keys, num_epochs)
+            print('persistent_txn={}: {:.0f} items/s'.format(persistent_txn, rate))
+            rate = batched_items_per_second(dataset, keys, num_epochs, batch_size)
+            print('persistent_txn={}, batch_size={}: {:.0f} items/s'.format(persistent_txn, batch_size, rate))
+            dataset.close()
+
+        lmdb_to_memmap(path, 'bench', path, 'bench_memmap')
+        dataset = MemmapDb(path, 'bench_memmap')
+        keys = dataset.keys()
+        rate = items_per_second(dataset, keys, num_epochs)
+        print('memmap: {:.0f} items/s'.format(rate))
+        rate = batched_items_per_second(dataset, keys, num_epochs, batch_size)
+        print('memmap, batch_size={}: {:.0f} items/s'.format(batch_size, rate))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,18 @@
+# encoding: utf-8
+"""Build or update the index of all dicom series in a directory tree."""
+import click
+from manet.utils import build_series_index
+
+
+@click.command()
+@click.argument('root', type=click.Path(exists=True))
+@click.argument('index', type=click.Path())
+@click.option('--workers', default=None, type=int, help='Number of processes, by default the number of cpus.')
+def main(root, index, workers):
+    """Index the dicom series below ROOT into INDEX, unchanged directories in an existing INDEX are not scanned."""
+    series_index = build_series_index(root, index, workers=workers)
+    click.echo('{} series in {} directories.'.format(len(series_index), len(series_index.directories)))
+
+
+if __name__ == '__main__':
+    main()
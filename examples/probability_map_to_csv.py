@@ -8,9 +8,9 @@ import os
 import click
 
 
-def prediction_to_csv(pred_fn, csv_fn, num_steps):
+def prediction_to_csv(pred_fn, csv_fn, num_steps, cache=None):
     """Given filename to probability map and number of steps create a csv file with the local maxima for that threshold"""
-    pred, metadata = manet.utils.read_image(pred_fn)
+    pred, metadata = manet.utils.read_image(pred_fn, cache=cache)
     pred = pred[0]
     distance = 37  # 2 * distance + 1 = 15mm = 75 pixels (200 micron spacing)
     thresholds = np.linspace(0.1, 1, num_steps)
@@ -29,7 +29,8 @@ def prediction_to_csv(pred_fn, csv_fn, num_steps):
 
 @click.command()
 @click.argument('folder_id', type=click.Path(exists=True))
-def generate_csv(folder_id):
+@click.option('--cache', default=None, help='Folder to cache the decoded images in.', type=click.Path())
+def generate_csv(folder_id, cache):
     """Given folder, folder/prediction.nrrd is given and folder/prediction.csv written."""
     pred_fn = os.path.join(folder_id, 'prediction.nrrd')
     csv_fn = os.path.join(folder_id, 'prediction.csv')
@@ -37,7 +38,7 @@ def generate_csv(folder_id):
     if os.path.exists(csv_fn):
         os.remove(csv_fn)
 
-    prediction_to_csv(pred_fn, csv_fn, 90)
+    prediction_to_csv(pred_fn, csv_fn, 90, cache=cache)
 
 
 if __name__ == '__main__':
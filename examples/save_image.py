@@ -25,12 +25,14 @@ from manet.plotting.imshow import plot_2d
 @click.option('--threshold', default=0.5, help='Threshold for the overlay')
 @click.option('--alpha', default=0., help='alpha of the overlay.')
 @click.option('--local-maxima/--no-local-maxima', default=False, help='add local maximal to the plot')
-def write_image(image, mask, overlay, output, height, dpi, linewidth, bbox, contour, threshold, alpha, local_maxima):
+@click.option('--cache', default=None, help='Folder to cache the decoded images in.', type=click.Path())
+def write_image(image, mask, overlay, output, height, dpi, linewidth, bbox, contour, threshold, alpha, local_maxima,
+                cache):
     """Write image to disk, given input dcm. Possible to add contours and bounding boxes.
     """
-    image, _ = read_dcm(image, window_leveling=True)
+    image, _ = read_dcm(image, window_leveling=True, cache=cache)
     if mask:
-        mask_arr, _ = read_dcm(mask, window_leveling=False)
+        mask_arr, _ = read_dcm(mask, window_leveling=False, cache=cache)
         if image.shape != mask_arr.shape:
             mask_arr = resize(mask_arr, image.shape)
 
@@ -45,7 +47,7 @@ def write_image(image, mask, overlay, output, height, dpi, linewidth, bbox, cont
         mask_arr = None
 
     if overlay:
-        overlay, _ = read_image(overlay, force_2d=True)
+        overlay, _ = read_image(overlay, force_2d=True, cache=cache)
 
     min_distance = 37 if local_maxima else False
 
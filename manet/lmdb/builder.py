@@ -0,0 +1,267 @@
+# encoding: utf-8
+"""Tools to write images to an LMDB database."""
+import os
+import logging
+import lmdb
+from manet.utils import read_dcm_series, read_images, write_list
+from manet.utils.pyramid import build_pyramid, scale_metadata
+from manet.lmdb.record import FORMAT_KEY, FORMAT_VERSION, KEYS_DB, EXTRA_DB, HEADER_SIZE
+from manet.lmdb.record import pack_record, pack_tiled_record, chunk_key, pyramid_key
+from manet.lmdb.record import sampler_key, check_key
+
+logger = logging.getLogger(__name__)
+
+# Initial map size if nothing is known about the data.
+_DEFAULT_MAP_SIZE = 2**30
+
+
+def estimate_map_size(record_size, num_records, headroom=1.5):
+    """Estimate the LMDB map size required to store num_records records.
+
+    Parameters
+    ----------
+    record_size : int
+        Size in bytes of a typical record.
+    num_records : int
+        Number of records which will be written.
+    headroom : float
+        Factor to account for the B-tree overhead and variation in record sizes.
+
+    Returns
+    -------
+    Map size in bytes, rounded up to a multiple of 1MB.
+    """
+    # Large values are stored on overflow pages, which are allocated per 4096 bytes.
+    pages = (record_size + 4095) // 4096 + 1
+    map_size = int(headroom * pages * 4096 * num_records) + _DEFAULT_MAP_SIZE // 16
+    return (map_size // 2**20 + 1) * 2**20
+
+
+def read_series(folder):
+    """Read a dicom series and clean the metadata for storage in the database."""
+    data, metadata = read_dcm_series(folder)
+    # If dataset is written to LMDB, we do not need the filenames anymore.
+    metadata.pop('filenames', None)
+    series_ids = metadata.pop('series_ids', None)
+    if series_ids:
+        metadata['series_id'] = series_ids[0]
+    return data, metadata
+
+
+class LmdbBuilder(object):
+    def __init__(self, path, db_name, map_size=None, commit_every=64, max_pending_bytes=2**30,
+                 chunk_shape=None, codec=None, pyramid=None):
+        """Writer for an LMDB database in the format read by `manet.lmdb.dataset.LmdbDb`.
+
+        Records are buffered and written in a single transaction per chunk, together with their keys
+        in the key index. A chunk is written when it has commit_every records or max_pending_bytes bytes,
+        so large volumes do not accumulate in memory. If the database already exists, the keys already
+        written are loaded, so an interrupted build can be resumed by skipping these keys.
+
+        Parameters
+        ----------
+        path : str
+            Path to folder with LMDB db.
+        db_name : str
+            Name of the database.
+        map_size : int, optional
+            Initial map size in bytes, see `estimate_map_size`. The map is grown if it turns out to be too small.
+        commit_every : int
+            Maximal number of records per write transaction.
+        max_pending_bytes : int
+            Maximal number of bytes of the records, including chunks and pyramid levels, per write transaction.
+        chunk_shape : tuple, optional
+            If given, the images are stored tiled in chunks of this shape, so regions can be read without
+            reading the complete image. For instance (1, 256, 256) for volumes, for 2D images the last
+            dimensions are used.
+        codec : str, optional
+            Codec to compress the images or chunks with, see `manet.lmdb.compression.CODECS`.
+        pyramid : tuple, optional
+            Downsampling factors, e.g. (2, 4, 8). If given, the downsampled images are stored next to every
+            image and can be read with `manet.lmdb.dataset.LmdbDb.read_scaled`.
+        """
+        self.lmdb_path = os.path.join(path, db_name)
+        self.commit_every = commit_every
+        self.max_pending_bytes = max_pending_bytes
+        self.chunk_shape = chunk_shape
+        self.codec = codec
+        self.pyramid = tuple(sorted(pyramid)) if pyramid else None
+        self.env = lmdb.open(self.lmdb_path, map_size=map_size or _DEFAULT_MAP_SIZE,
+                             map_async=True, max_dbs=2)
+        if map_size and self.env.info()['map_size'] < map_size:
+            self.env.set_mapsize(map_size)
+
+        with self.env.begin(write=False) as txn:
+            version = txn.get(FORMAT_KEY)
+            num_entries = txn.stat()['entries']
+        if version is None and num_entries > 0:
+            raise ValueError('{} is not empty and not in the manet format.'.format(self.lmdb_path))
+        # Chunks, pyramid levels, samplers and the key index are stored in sub-databases, see `manet.lmdb.record`.
+        self._extra_db = self.env.open_db(EXTRA_DB)
+        self._keys_db = self.env.open_db(KEYS_DB)
+
+        with self.env.begin(write=False, db=self._keys_db) as txn:
+            self._keys = set(key.decode('utf-8') for key in txn.cursor().iternext(keys=True, values=False))
+        self._pending = []
+        self._pending_bytes = 0
+
+    def has_key(self, key):
+        return key in self._keys
+
+    def keys(self):
+        return sorted(self._keys)
+
+    def write(self, key, image, metadata=None, sampler=None):
+        """Add an image to the database, the image is written on the next commit.
+
+        Parameters
+        ----------
+        key : str
+            Key of the image, should not start with `manet.lmdb.record.RESERVED_PREFIX`.
+        image : ndarray
+        metadata : dict, optional
+        sampler : MaskSampler, optional
+            Sampler of for instance the lesion mask of the image, read with
+            `manet.lmdb.dataset.LmdbDb.read_sampler`.
+        """
+        check_key(key)
+        # Records stored in the sub-database, which are not part of the key index.
+        extra = []
+        if sampler is not None:
+            extra.append((sampler_key(key), sampler.pack()))
+        if self.pyramid:
+            for factor, level in build_pyramid(image, self.pyramid).items():
+                level_metadata = scale_metadata(metadata or {}, factor, level.shape)
+                extra.append((pyramid_key(key, factor), pack_record(level, level_metadata, self.codec)))
+            metadata = dict(metadata or {}, pyramid=list(self.pyramid))
+
+        if self.chunk_shape:
+            record, chunks = pack_tiled_record(image, metadata, self.chunk_shape, self.codec)
+            extra += [(chunk_key(key, chunk_idx), chunk) for chunk_idx, chunk in chunks]
+        else:
+            record = pack_record(image, metadata, self.codec)
+        self._pending.append((key, record, extra))
+        self._pending_bytes += len(record) + sum(len(value) for _, value in extra)
+        if len(self._pending) >= self.commit_every or self._pending_bytes >= self.max_pending_bytes:
+            self.commit()
+
+    def _grow(self, required):
+        """Grow the map such that at least required extra bytes fit."""
+        info = self.env.info()
+        stat = self.env.stat()
+        used = (info['last_pgno'] + 1) * stat['psize']
+        new_size = max(2 * info['map_size'], estimate_map_size(used + required, 1))
+        logger.info('Growing LMDB map size to %dMB.', new_size // 2**20)
+        self.env.set_mapsize(new_size)
+
+    def commit(self):
+        """Write all pending records and their keys in a single transaction."""
+        if not self._pending:
+            return
+        while True:
+            try:
+                with self.env.begin(write=True) as txn:
+                    txn.put(FORMAT_KEY, str(FORMAT_VERSION).encode('utf-8'))
+                    for key, record, extra in self._pending:
+                        txn.put(key.encode('utf-8'), record)
+                        txn.put(key.encode('utf-8'), b'', db=self._keys_db)
+                        for extra_key, value in extra:
+                            txn.put(extra_key.encode('utf-8'), value, db=self._extra_db)
+                break
+            except lmdb.MapFullError:
+                self._grow(self._pending_bytes + len(self._pending) * HEADER_SIZE)
+
+        self._keys.update(key for key, _, _ in self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+
+    def close(self):
+        self.commit()
+        self.env.sync(True)
+        self.env.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (' + self.lmdb_path + ')'
+
+
+def build_db(path, db_name, items, read_fn=read_series, num_workers=None,
+             commit_every=64, max_pending_bytes=2**30, map_size=None, chunk_shape=None, codec=None, pyramid=None,
+             generate_keys=False):
+    """Build an LMDB database from a list of (key, source) pairs.
+
+    The sources are decoded in a pool of processes with `manet.utils.read_images`, while the main process
+    writes the results in chunks of at most commit_every records or max_pending_bytes bytes per transaction.
+    Keys which are already in the database are skipped, so after a crash the build can be resumed by calling
+    this function again.
+
+    Parameters
+    ----------
+    path : str
+        Path to folder with LMDB db.
+    db_name : str
+        Name of the database.
+    items : list
+        List of (key, source) tuples, source is passed to read_fn.
+    read_fn : function
+        Function mapping a source to an image and metadata dictionary, needs to be picklable.
+        By default a folder with a dicom series is read.
+    num_workers : int, optional
+        Number of processes to decode the images, by default the number of cpus. If 0, everything
+        is done in the current process.
+    commit_every : int
+        Maximal number of records per write transaction.
+    max_pending_bytes : int
+        Maximal number of bytes per write transaction, see `LmdbBuilder`.
+    map_size : int, optional
+        Map size in bytes. If not given, the map size is estimated from the first image.
+    chunk_shape : tuple, optional
+        If given, store the images tiled, see `LmdbBuilder`.
+    codec : str, optional
+        Codec to compress the images with, see `LmdbBuilder`.
+    pyramid : tuple, optional
+        Downsampling factors to store next to the images, see `LmdbBuilder`.
+    generate_keys : bool
+        If True, also write the keys to the keys file.
+
+    Returns
+    -------
+    List of (key, error message) tuples for the items which failed.
+    """
+    items = list(items)
+    failed = []
+    with LmdbBuilder(path, db_name, map_size=map_size, commit_every=commit_every, max_pending_bytes=max_pending_bytes,
+                     chunk_shape=chunk_shape, codec=codec, pyramid=pyramid) as builder:
+        todo = [(key, source) for key, source in items if not builder.has_key(key)]
+        logger.info('Writing %d items, %d already in %s.', len(todo), len(items) - len(todo), builder)
+
+        # The results are ordered, so the number of decoded images waiting to be written is bounded.
+        results = read_images([source for _, source in todo], workers=num_workers, reader=read_fn,
+                              processes=True, ordered=True)
+        presized = map_size is not None
+        for (key, _), (source, data, metadata, error) in zip(todo, results):
+            if error:
+                error = '{}: {}'.format(source, error)
+                logger.warning('%s failed: %s', key, error)
+                failed.append((key, error))
+                continue
+            if not presized:
+                # Pre-size the map from the first image, such that it does not need to be grown.
+                estimate = estimate_map_size(data.nbytes + HEADER_SIZE, len(todo))
+                builder.env.set_mapsize(max(builder.env.info()['map_size'], estimate))
+                presized = True
+            builder.write(key, data, metadata)
+
+        if generate_keys:
+            write_list(os.path.join(path, db_name + '_keys.lst'), builder.keys(),
+                       header=['LMDB keys for db {}'.format(db_name)])
+
+    return failed
@@ -0,0 +1,176 @@
+# encoding: utf-8
+"""Compression codecs for the records in LMDB.
+
+The codec is stored as a code in the record header, so every record can use a different codec.
+The 'shuffle' codecs first group the bytes by their significance before compressing, which
+greatly improves the compression of images with a small range of values.
+"""
+import zlib
+import logging
+import numpy as np
+logger = logging.getLogger(__name__)
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+    logger.debug('lzma not available. lzma codecs will not work.')
+
+
+# Size of the blocks the data is decompressed in.
+_BLOCK_SIZE = 2**22
+
+
+def _shuffle(data, itemsize):
+    if itemsize == 1:
+        return data
+    arr = np.frombuffer(data, dtype=np.uint8).reshape(-1, itemsize)
+    return arr.T.tobytes()
+
+
+def _zlib_blocks(data):
+    decompressor = zlib.decompressobj()
+    while not decompressor.eof:
+        block = decompressor.decompress(data, _BLOCK_SIZE)
+        if not block and not decompressor.eof and not decompressor.unconsumed_tail:
+            raise ValueError('Compressed data is truncated.')
+        data = decompressor.unconsumed_tail
+        yield block
+
+
+def _lzma_blocks(data):
+    decompressor = lzma.LZMADecompressor()
+    while not decompressor.eof:
+        block = decompressor.decompress(data, _BLOCK_SIZE)
+        if not block and not decompressor.eof and decompressor.needs_input:
+            raise ValueError('Compressed data is truncated.')
+        data = b''
+        yield block
+
+
+def _decompress_into(blocks, out, itemsize):
+    """Write the decompressed blocks into the flat uint8 array out, such that only one block is held in memory
+    next to the output. If itemsize > 1, the data is shuffled and the bytes of every element are gathered."""
+    size = len(out) // itemsize
+    # Byte planes of the output, the shuffled data contains the planes one after the other.
+    planes = out.reshape(size, itemsize).T
+    pos = 0
+    for block in blocks:
+        block = np.frombuffer(block, dtype=np.uint8)
+        if pos + len(block) > len(out):
+            raise ValueError('Decompressed data is larger than the image.')
+        while len(block):
+            plane, start = divmod(pos, size)
+            count = min(len(block), size - start)
+            planes[plane, start:start + count] = block[:count]
+            block = block[count:]
+            pos += count
+    if pos != len(out):
+        raise ValueError('Decompressed data is smaller than the image.')
+
+
+def _zlib_encode(data, itemsize):
+    return zlib.compress(data, 6)
+
+
+def _zlib_decode(data, itemsize, out):
+    _decompress_into(_zlib_blocks(data), out, 1)
+
+
+def _lzma_encode(data, itemsize):
+    return lzma.compress(data)
+
+
+def _lzma_decode(data, itemsize, out):
+    _decompress_into(_lzma_blocks(data), out, 1)
+
+
+def _shuffle_zlib_encode(data, itemsize):
+    return zlib.compress(_shuffle(data, itemsize), 6)
+
+
+def _shuffle_zlib_decode(data, itemsize, out):
+    _decompress_into(_zlib_blocks(data), out, itemsize)
+
+
+def _shuffle_lzma_encode(data, itemsize):
+    return lzma.compress(_shuffle(data, itemsize))
+
+
+def _shuffle_lzma_decode(data, itemsize, out):
+    _decompress_into(_lzma_blocks(data), out, itemsize)
+
+
+# name: (code, encode, decode). Codes are stored in the header and should never change.
+CODECS = {
+    'raw': (0, None, None),
+    'zlib': (1, _zlib_encode, _zlib_decode),
+    'lzma': (2, _lzma_encode, _lzma_decode),
+    'shuffle-zlib': (3, _shuffle_zlib_encode, _shuffle_zlib_decode),
+    'shuffle-lzma': (4, _shuffle_lzma_encode, _shuffle_lzma_decode),
+}
+_CODEC_NAMES = {code: name for name, (code, _, _) in CODECS.items()}
+
+
+def codec_to_code(codec):
+    """Convert a codec name to the code stored in the header."""
+    if codec is None:
+        return 0
+    if codec not in CODECS:
+        raise ValueError('Codec {} not available, choose from {}.'.format(codec, sorted(CODECS)))
+    if 'lzma' in codec and lzma is None:
+        raise ValueError('Codec {} requires the lzma module.'.format(codec))
+    return CODECS[codec][0]
+
+
+def code_to_codec(code):
+    """Convert a code from the header to a codec name."""
+    try:
+        return _CODEC_NAMES[code]
+    except KeyError:
+        raise ValueError('Codec code {} is not known.'.format(code))
+
+
+def encode(codec, data, itemsize):
+    """Compress bytes with the given codec.
+
+    Parameters
+    ----------
+    codec : str
+        Name of the codec, see `CODECS`.
+    data : bytes
+    itemsize : int
+        Size in bytes of the elements, used for shuffling.
+
+    Returns
+    -------
+    bytes
+    """
+    codec_to_code(codec)
+    if codec in [None, 'raw']:
+        return data
+    return CODECS[codec][1](data, itemsize)
+
+
+def decode(codec, buf, shape, dtype):
+    """Decompress a buffer into an array.
+
+    Parameters
+    ----------
+    codec : str
+        Name of the codec, see `CODECS`.
+    buf : bytes or buffer
+    shape : tuple
+    dtype : dtype
+
+    Returns
+    -------
+    ndarray, for compressed data this is a new writable array, otherwise a view of buf.
+    """
+    dtype = np.dtype(dtype)
+    if codec in [None, 'raw']:
+        return np.ndarray(shape, dtype, buffer=buf)
+    # Decompressed block by block into the output, so the image is not copied.
+    out = np.empty(shape, dtype=dtype)
+    CODECS[codec][2](buf, dtype.itemsize, out.reshape(-1).view(np.uint8))
+    return out
@@ -1,21 +1,120 @@
 # encoding: utf-8
 import os
 import copy
+import threading
+import itertools
+from collections import OrderedDict
 import lmdb
 import numpy as np
 import simplejson as json
 from manet.utils import write_list, read_list
+from manet.utils.bbox_utils import _split_bbox
+from manet.utils.patch_utils import extract_patch
+from manet.utils.pyramid import downsample, scale_metadata
+from manet.utils.mask_utils import MaskSampler
+from manet.lmdb.record import FORMAT_KEY, KEYS_DB, EXTRA_DB, RESERVED_PREFIX, unpack_header
+from manet.lmdb.record import chunk_key, chunk_grid, chunk_slices, unpack_data, unpack_chunk, pyramid_key
+from manet.lmdb.record import sampler_key
+
+
+def _encode_key(key):
+    """LMDB keys are bytes, the keys in the dataset are strings."""
+    if isinstance(key, bytes):
+        return key
+    return key.encode('utf-8')
+
+
+def _decode_key(key):
+    if isinstance(key, bytes):
+        return key.decode('utf-8')
+    return key
+
+
+# Read-only environments per path as [pid, environment, sub-databases, number of references]. LMDB does
+# not allow to open an environment twice in a process, so all datasets in a process share it.
+_ENVIRONMENTS = {}
+_ENVIRONMENTS_LOCK = threading.Lock()
+
+
+def _acquire_env(lmdb_path):
+    """Open the read-only environment of lmdb_path, or return it if it is already open in this process.
+    Every call takes a reference, which is released with `_release_env`.
+
+    Returns
+    -------
+    The environment and a dictionary with the handles of the sub-databases `EXTRA_DB` and `KEYS_DB`
+    which exist in the database.
+    """
+    with _ENVIRONMENTS_LOCK:
+        entry = _ENVIRONMENTS.get(lmdb_path, None)
+        if entry is not None and entry[0] != os.getpid():
+            # The environment was inherited from the parent and cannot be used after a fork.
+            entry[1].close()
+            entry = None
+        if entry is None:
+            env = lmdb.open(lmdb_path, max_readers=None, readonly=True, lock=False,
+                            readahead=False, meminit=False, max_dbs=2)
+            dbs = {}
+            for name in [EXTRA_DB, KEYS_DB]:
+                try:
+                    dbs[name] = env.open_db(name, create=False)
+                except lmdb.NotFoundError:
+                    pass
+            entry = _ENVIRONMENTS[lmdb_path] = [os.getpid(), env, dbs, 0]
+        entry[3] += 1
+        return entry[1], entry[2]
+
+
+def _release_env(lmdb_path, env):
+    """Release a reference to env, the environment is closed when the last reference is released."""
+    with _ENVIRONMENTS_LOCK:
+        entry = _ENVIRONMENTS.get(lmdb_path, None)
+        if entry is None or entry[1] is not env:
+            return
+        entry[3] -= 1
+        if entry[3] == 0:
+            del _ENVIRONMENTS[lmdb_path]
+            env.close()
+
+
+class _EnvLease(object):
+    def __init__(self, lmdb_path):
+        """Reference to the shared environment of lmdb_path, which is released when the lease is garbage
+        collected. A lease is only valid in the process which took it."""
+        self.lmdb_path = lmdb_path
+        self.env, self.dbs = _acquire_env(lmdb_path)
+        self.pid = os.getpid()
+
+    def __del__(self):
+        if self.pid == os.getpid():
+            _release_env(self.lmdb_path, self.env)
+
+
+class _MapView(object):
+    def __init__(self, data, lease, txn):
+        """Array interface of a zero-copy view into the memory map, which keeps the lease and the
+        transaction the view was read in alive, so the view stays valid after the dataset is released."""
+        self.__array_interface__ = data.__array_interface__
+        self.data = data
+        self.lease = lease
+        self.txn = txn
 
 
 class LmdbDb(object):
-    def __init__(self, path, db_name):
+    def __init__(self, path, db_name, persistent_txn=False):
         """Load an LMDB database, containing a dataset.
 
-        The dataset should be structured as image_id: binary representing the contiguous block.
-        If image_id is available we also need image_id_metadata which is a json parseble dictionary.
-        This dictionary should contains the key 'shape' representing the shape and 'dtype'.
+        The dataset should be structured as image_id: record as written by `manet.lmdb.record.pack_record`,
+        containing a binary header with the shape, dtype and spacing followed by the contiguous block.
+        The legacy format, where image_id is the binary contiguous block and image_id_metadata is a json
+        parseble dictionary containing the keys 'shape' and 'dtype', is detected automatically.
 
-        If the keys file is available, the file is loaded, otherwise generated.
+        The keys are read from the key index stored in the database. For databases without a key index,
+        such as the legacy format, the keys file is loaded. Only if neither is available, the keys file is
+        generated from a scan over the keys.
+
+        The LMDB environment is opened on first access in every process, so the dataset can be pickled
+        or forked into the workers of a data loader.
 
         Parameters
         ----------
@@ -23,58 +122,384 @@ class LmdbDb(object):
             Path to folder with LMDB db.
         db_name : str
             Name of the database.
+        persistent_txn : bool
+            If True, every thread keeps a long-lived read transaction open which is reused for
+            all reads, and the returned arrays are zero-copy views into the memory map.
+            The transaction is reopened after a fork.
 
         """
         lmdb_path = os.path.join(path, db_name)
         lmdb_keys_path = os.path.join(path, db_name + '_keys.lst')
         self.lmdb_path = lmdb_path
-        self.env = lmdb.open(lmdb_path, max_readers=None, readonly=True, lock=False,
-                             readahead=False, meminit=False)
-        with self.env.begin(write=False) as txn:
-            self.length = txn.stat()['entries'] // 2
+        self.persistent_txn = persistent_txn
+        self._local = threading.local()
+        self._lease = None
+        self._format_version = None
+        # Parsed metadata per key: (shape, dtype, offset, metadata). Pyramid levels are cached under (key, scale).
+        self._meta_cache = {}
 
-        if os.path.isfile(lmdb_keys_path):
-            self._keys = read_list(lmdb_keys_path)
-        else:
-            # The keys file does not exist, we will generate one, but this can take a while.
+        keys = None
+        env = self.env
+        if KEYS_DB in self._lease.dbs:
+            # The key index is updated with every commit, so it is never stale, unlike the keys file.
+            with env.begin(write=False, db=self._lease.dbs[KEYS_DB]) as txn:
+                keys = [_decode_key(key) for key in txn.cursor().iternext(keys=True, values=False)]
+        if keys is None and os.path.isfile(lmdb_keys_path):
+            keys = read_list(lmdb_keys_path)
+
+        if keys is None:
+            # No key index is available, we will generate a keys file, but this can take a while.
+            with self.env.begin(write=False) as txn:
+                keys = [_decode_key(key) for key in txn.cursor().iternext(keys=True, values=False)]
+            keys = [key for key in keys if not key.startswith(RESERVED_PREFIX)]
+            if self.format_version == 0:
+                keys = [key for key in keys if '_metadata' not in key]
+            write_list(lmdb_keys_path, keys, header=['LMDB keys for db {}'.format(db_name)])
+
+        # Ordered dictionary for constant time lookups and deletes.
+        self._keys = OrderedDict.fromkeys(keys)
+        self._keys_list = None
+        # True if the keys are shared with a copy, these are copied before modifying.
+        self._keys_shared = False
+
+    @property
+    def format_version(self):
+        """Version of the record format, 0 for the legacy format."""
+        if self._format_version is None:
             with self.env.begin(write=False) as txn:
-                keys = [key for key, _ in txn.cursor() if '_metadata' not in key]
-                write_list(keys, lmdb_keys_path, header=['LMDB keys for db {}'.format(db_name)])
-                self._keys = keys
+                version = txn.get(FORMAT_KEY)
+            self._format_version = int(version) if version is not None else 0
+        return self._format_version
+
+    @property
+    def env(self):
+        """The LMDB environment, which is shared by all datasets in this process. An environment
+        cannot be used across a fork, so when the process id changed the environment is reopened."""
+        if self._lease is None or self._lease.pid != os.getpid():
+            # Transactions of the parent process or a closed environment are invalid.
+            self._lease = _EnvLease(self.lmdb_path)
+            self._local = threading.local()
+        return self._lease.env
+
+    def _get_extra(self, txn, key):
+        """Get a record of the sub-database with chunks, pyramid levels and samplers, or None."""
+        dbs = self._lease.dbs
+        if EXTRA_DB not in dbs:
+            return None
+        return txn.get(_encode_key(key), db=dbs[EXTRA_DB])
+
+    def _read_txn(self):
+        """Return the long-lived read transaction of the current thread."""
+        env = self.env
+        txn = getattr(self._local, 'txn', None)
+        if txn is None:
+            txn = env.begin(buffers=True, write=False)
+            self._local.txn = txn
+        return txn
+
+    def _pin(self, data):
+        """Let a zero-copy view into the memory map hold a reference to the environment and the
+        transaction of the current thread, arrays which own their data are returned as is."""
+        if data.flags.owndata:
+            return data
+        return np.asarray(_MapView(data, self._lease, self._read_txn()))
+
+    def close(self):
+        """Release the LMDB environment, it is reopened on the next access. The environment is shared with
+        the other datasets and copies on the same path. It is closed when all of these are closed or garbage
+        collected, and the arrays they returned with persistent_txn, which point into the memory map, are
+        garbage collected as well."""
+        self._local = threading.local()
+        self._lease = None
+
+    def __getstate__(self):
+        # The environment and transactions cannot be pickled, these are reopened on first access.
+        state = self.__dict__.copy()
+        state['_lease'] = None
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
 
     def __delitem__(self, key):
-        idx = self._keys.index[key]
-        self._keys.pop(idx, None)
+        if self._keys_shared:
+            self._keys = self._keys.copy()
+            self._keys_shared = False
+        del self._keys[key]
+        self._keys_list = None
 
     def copy(self):
-        return copy.deepcopy(self)
+        """Cheap copy of the dataset. The keys are shared until one of the copies deletes a key."""
+        new = copy.copy(self)
+        # The copy takes its own reference to the environment on first access.
+        new._lease = None
+        new._local = threading.local()
+        self._keys_shared = new._keys_shared = True
+        return new
 
     def has_key(self, key):
         return key in self._keys
 
     def keys(self):
-        return self._keys
+        if self._keys_list is None:
+            self._keys_list = list(self._keys)
+        return self._keys_list
+
+    def _parse_metadata(self, txn, key, buf):
+        if self.format_version == 0:
+            meta_buf = txn.get(_encode_key(key + '_metadata'))
+            metadata = json.loads(bytes(meta_buf).decode('utf-8'))
+            parsed = (tuple(metadata['shape']), np.dtype(metadata['dtype']), 0, metadata)
+        else:
+            parsed = unpack_header(buf)
+        self._meta_cache[key] = parsed
+        return parsed
+
+    def _get(self, txn, key):
+        buf = txn.get(_encode_key(key))
+        if buf is None:
+            raise KeyError(key)
+
+        parsed = self._meta_cache.get(key, None)
+        if parsed is None:
+            parsed = self._parse_metadata(txn, key, buf)
+        return buf, parsed
+
+    def _read_chunks(self, txn, key, shape, dtype, metadata, region, out):
+        """Copy a region of a tiled image into out, only the chunks intersecting the region are read.
+
+        Parameters
+        ----------
+        region : tuple
+            Tuple of slices within the image.
+        out : ndarray
+            Array with the shape of the region.
+        """
+        if any(r.stop <= r.start for r in region):
+            return out
+        chunk_shape = metadata['chunk_shape']
+        grid = chunk_grid(shape, chunk_shape)
+        chunk_ranges = [range(r.start // c, (r.stop - 1) // c + 1) for r, c in zip(region, chunk_shape)]
+        for idx in itertools.product(*chunk_ranges):
+            chunk_region = chunk_slices(idx, shape, chunk_shape)
+            buf = self._get_extra(txn, chunk_key(key, np.ravel_multi_index(idx, grid)))
+            if buf is None:
+                raise KeyError(chunk_key(key, np.ravel_multi_index(idx, grid)))
+            chunk = unpack_chunk(buf, tuple(c.stop - c.start for c in chunk_region), dtype, metadata)
+
+            overlap = [(max(r.start, c.start), min(r.stop, c.stop)) for r, c in zip(region, chunk_region)]
+            src_idx = tuple(slice(i - c.start, j - c.start) for (i, j), c in zip(overlap, chunk_region))
+            dst_idx = tuple(slice(i - r.start, j - r.start) for (i, j), r in zip(overlap, region))
+            out[dst_idx] = chunk[src_idx]
+        return out
+
+    def _read(self, txn, key, buf, parsed, copy, out=None):
+        """Convert a record to an array, tiled images are assembled from their chunks."""
+        shape, dtype, offset, metadata = parsed
+        if 'chunk_shape' in metadata:
+            if out is None:
+                out = np.empty(shape, dtype=dtype)
+            return self._read_chunks(txn, key, shape, dtype, metadata, tuple(slice(0, _) for _ in shape), out)
+
+        data = unpack_data(buf, shape, dtype, offset, metadata)
+        if out is not None:
+            out[...] = data
+            return out
+        # Compressed data is already decoded into a new buffer.
+        return data.copy() if copy and 'codec' not in metadata else data
 
     def __getitem__(self, key):
-        with self.env.begin(buffers=True, write=False) as txn:
-            if key not in self._keys:
-                raise KeyError(key)
-            buf = txn.get(key)
-            meta_buf = txn.get(key + '_metadata')
+        if key not in self._keys:
+            raise KeyError(key)
 
-        metadata = json.loads(str(meta_buf))
-        dtype = metadata['dtype']
-        shape = metadata['shape']
-        data = np.ndarray(shape, dtype, buffer=buf)
+        if self.persistent_txn:
+            txn = self._read_txn()
+            buf, parsed = self._get(txn, key)
+            data = self._pin(self._read(txn, key, buf, parsed, copy=False))
+        else:
+            # Without a persistent transaction the buffers are invalid after the transaction ends,
+            # so the data is copied.
+            with self.env.begin(buffers=True, write=False) as txn:
+                buf, parsed = self._get(txn, key)
+                data = self._read(txn, key, buf, parsed, copy=True)
 
         out = {}
         out['data'] = data
-        out['metadata'] = metadata
+        out['metadata'] = dict(parsed[-1])
         return out
 
+    def read_metadata(self, key):
+        """Metadata of an image, including the 'shape' and 'dtype', without reading the image data."""
+        if key not in self._keys:
+            raise KeyError(key)
+        with self.env.begin(buffers=True, write=False) as txn:
+            _, parsed = self._get(txn, key)
+        return dict(parsed[-1])
+
+    def read_scaled(self, key, scale):
+        """Read an image downsampled by an integer factor. If the level was stored by the builder,
+        only the small record is read, otherwise the image is downsampled after reading.
+
+        Parameters
+        ----------
+        key : str
+        scale : int
+            Downsampling factor, see `manet.utils.pyramid.downsample`.
+
+        Returns
+        -------
+        Dictionary with data and metadata, as `__getitem__`.
+        """
+        if key not in self._keys:
+            raise KeyError(key)
+        if scale == 1:
+            return self[key]
+
+        level_key = pyramid_key(key, scale)
+        with self.env.begin(buffers=True, write=False) as txn:
+            buf = self._get_extra(txn, level_key)
+            if buf is not None:
+                # The level key can be the key of another image, so the levels are cached under (key, scale).
+                parsed = self._meta_cache.get((key, scale), None) or unpack_header(buf)
+                self._meta_cache[key, scale] = parsed
+                return {'data': self._read(txn, level_key, buf, parsed, copy=True), 'metadata': dict(parsed[-1])}
+
+        item = self[key]
+        data = downsample(item['data'], scale)
+        metadata = dict(item['metadata'])
+        for k in ['pyramid', 'chunk_shape', 'codec']:
+            metadata.pop(k, None)
+        return {'data': data, 'metadata': scale_metadata(metadata, scale, data.shape)}
+
+    def read_sampler(self, key):
+        """The mask sampler stored with key, see `manet.lmdb.builder.LmdbBuilder.write`, or None."""
+        if key not in self._keys:
+            raise KeyError(key)
+        with self.env.begin(buffers=True, write=False) as txn:
+            buf = self._get_extra(txn, sampler_key(key))
+            return MaskSampler.unpack(buf) if buf is not None else None
+
+    def _read_region(self, txn, key, bbox, pad_value, copy):
+        buf, (shape, dtype, offset, metadata) = self._get(txn, key)
+        if 'chunk_shape' not in metadata:
+            patch = extract_patch(unpack_data(buf, shape, dtype, offset, metadata), bbox, pad_value)
+            return patch.copy() if copy and 'codec' not in metadata else patch
+
+        bbox_coords, bbox_size = _split_bbox(bbox)
+        # Part of the bounding box within the image.
+        region = tuple(slice(max(i, 0), min(i + j, s)) for i, j, s in zip(bbox_coords, bbox_size, shape))
+        out_idx = tuple(slice(r.start - i, r.stop - i) for r, i in zip(region, bbox_coords))
+        patch = np.empty(bbox_size, dtype=dtype)
+        if any(r.stop - r.start != j for r, j in zip(region, bbox_size)):
+            patch[...] = pad_value
+        self._read_chunks(txn, key, shape, dtype, metadata, region, patch[out_idx])
+        return patch
+
+    def read_region(self, key, bbox, pad_value=0):
+        """Read a region of an image. If the image is stored tiled, only the chunks intersecting
+        the bounding box are read.
+
+        Parameters
+        ----------
+        key : str
+        bbox : tuple
+            bbox of the form (coordinates, size), see `manet.utils.patch_utils.extract_patch`.
+        pad_value : number
+            Value to pad with if the bounding box is not contained in the image.
+
+        Returns
+        -------
+        ndarray
+        """
+        if key not in self._keys:
+            raise KeyError(key)
+
+        if self.persistent_txn:
+            return self._pin(self._read_region(self._read_txn(), key, bbox, pad_value, copy=False))
+
+        with self.env.begin(buffers=True, write=False) as txn:
+            return self._read_region(txn, key, bbox, pad_value, copy=True)
+
+    def _get_many(self, txn, keys, stack, out, copy, out_idx=None):
+        # Visit the keys in sorted order, so the B-tree is traversed sequentially.
+        order = sorted(range(len(keys)), key=lambda idx: keys[idx])
+        cursor = txn.cursor()
+        bufs = [None] * len(keys)
+        parsed = [None] * len(keys)
+        for idx in order:
+            key = keys[idx]
+            if key not in self._keys or not cursor.set_key(_encode_key(key)):
+                raise KeyError(key)
+            bufs[idx] = cursor.value()
+            parsed[idx] = self._meta_cache.get(key, None)
+            if parsed[idx] is None:
+                parsed[idx] = self._parse_metadata(txn, key, bufs[idx])
+
+        metadata = [dict(meta) for _, _, _, meta in parsed]
+        if not stack:
+            return [{'data': self._read(txn, key, buf, _parsed, copy=copy), 'metadata': meta}
+                    for key, buf, _parsed, meta in zip(keys, bufs, parsed, metadata)]
+
+        shape, dtype, _, _ = parsed[0]
+        if any(_shape != shape or _dtype != dtype for _shape, _dtype, _, _ in parsed):
+            raise ValueError('Can only stack items with the same shape and dtype.')
+        if out is None:
+            out = np.empty((len(keys), ) + shape, dtype=dtype)
+        elif out.shape[1:] != shape or out.dtype != dtype or (out_idx is None and len(out) != len(keys)):
+            raise ValueError('out should have shape {} and dtype {}.'.format((len(keys), ) + shape, dtype))
+        if out_idx is None:
+            out_idx = range(len(keys))
+        for idx in order:
+            self._read(txn, keys[idx], bufs[idx], parsed[idx], copy=False, out=out[out_idx[idx]])
+        return {'data': out, 'metadata': metadata}
+
+    def _stack_into(self, keys, out, out_idx):
+        """Read the images of keys into out[out_idx], used to stack a batch spread over several datasets.
+
+        Returns
+        -------
+        List with the metadata of the keys.
+        """
+        if self.persistent_txn:
+            return self._get_many(self._read_txn(), keys, True, out, False, out_idx)['metadata']
+        with self.env.begin(buffers=True, write=False) as txn:
+            return self._get_many(txn, keys, True, out, False, out_idx)['metadata']
+
+    def get_many(self, keys, stack=False, out=None):
+        """Fetch a batch of keys within a single transaction.
+
+        Parameters
+        ----------
+        keys : list
+            Keys to fetch.
+        stack : bool
+            If True, the images are copied into one array of shape (len(keys), *shape),
+            this requires all images to have the same shape and dtype.
+        out : ndarray, optional
+            Preallocated array to stack the images in, only used when stack is True.
+
+        Returns
+        -------
+        If stack is False a list of dictionaries as returned by `__getitem__`, otherwise a dictionary
+        with the stacked array as 'data' and the list of metadata as 'metadata'.
+        """
+        keys = list(keys)
+        if not keys:
+            return {'data': out, 'metadata': []} if stack else []
+
+        if self.persistent_txn:
+            items = self._get_many(self._read_txn(), keys, stack, out, copy=False)
+            for item in ([] if stack else items):
+                item['data'] = self._pin(item['data'])
+            return items
+
+        with self.env.begin(buffers=True, write=False) as txn:
+            return self._get_many(txn, keys, stack, out, copy=True)
+
     def __len__(self):
-        return self.length
+        return len(self._keys)
 
     def __repr__(self):
         return self.__class__.__name__ + ' (' + self.lmdb_path + ')'
-
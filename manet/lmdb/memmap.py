@@ -0,0 +1,248 @@
+# encoding: utf-8
+"""Dataset stored as one memory-mapped data file with an index, an alternative to LMDB.
+
+The dataset db_name in folder path consists of:
+    db_name.dat : the contiguous image data, every image starts at a multiple of `ALIGNMENT` bytes.
+    db_name_index.npy : structured array with per image the offset, dtype code, ndim, shape and spacing.
+    db_name_keys.lst : the keys, in the same order as the index.
+    db_name_metadata.json : the remaining metadata per key.
+"""
+import os
+import copy
+import numpy as np
+from manet.utils import read_list, write_list, read_json, write_json
+from manet.utils.patch_utils import extract_patch
+from manet.utils.pyramid import downsample, scale_metadata
+from manet.lmdb.record import MAX_NDIM, dtype_to_code, code_to_dtype
+from manet.lmdb.dataset import LmdbDb
+
+ALIGNMENT = 64
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('dtype', 'u1'), ('ndim', 'u1'),
+                        ('shape', '<u8', (MAX_NDIM, )), ('spacing', '<f8', (MAX_NDIM, ))])
+
+
+def _filenames(path, db_name):
+    return [os.path.join(path, db_name + _) for _ in ['.dat', '_index.npy', '_keys.lst', '_metadata.json']]
+
+
+class MemmapBuilder(object):
+    def __init__(self, path, db_name):
+        """Writer for a memory-mapped dataset read by `MemmapDb`. The index is written on close.
+
+        Parameters
+        ----------
+        path : str
+            Path to folder to write the dataset to.
+        db_name : str
+            Name of the dataset.
+        """
+        self.data_path, self.index_path, self.keys_path, self.metadata_path = _filenames(path, db_name)
+        self.db_name = db_name
+        self._file = open(self.data_path, 'wb')
+        self._index = []
+        self._keys = []
+        self._metadata = {}
+
+    def write(self, key, image, metadata=None):
+        image = np.ascontiguousarray(image)
+        if image.ndim > MAX_NDIM:
+            raise ValueError('Can only store images up to dimension {}.'.format(MAX_NDIM))
+        metadata = dict(metadata or {})
+        for k in ['shape', 'dtype', 'chunk_shape', 'codec']:
+            metadata.pop(k, None)
+        spacing = metadata.pop('spacing', None) or []
+
+        offset = self._file.tell()
+        padding = -offset % ALIGNMENT
+        self._file.write(b'\0' * padding)
+        self._file.write(image.tobytes())
+
+        entry = np.zeros((), dtype=INDEX_DTYPE)
+        entry['offset'] = offset + padding
+        entry['dtype'] = dtype_to_code(image.dtype)
+        entry['ndim'] = image.ndim
+        entry['shape'][:image.ndim] = image.shape
+        entry['spacing'][:len(spacing)] = spacing
+        self._index.append(entry)
+        self._keys.append(key)
+        if metadata:
+            self._metadata[key] = metadata
+
+    def close(self):
+        self._file.close()
+        np.save(self.index_path, np.array(self._index, dtype=INDEX_DTYPE))
+        write_list(self.keys_path, self._keys, header=['Memmap keys for db {}'.format(self.db_name)])
+        write_json(self.metadata_path, self._metadata)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MemmapDb(object):
+    def __init__(self, path, db_name):
+        """Load a memory-mapped dataset, with the same interface as `manet.lmdb.dataset.LmdbDb`.
+        The data is returned as read-only zero-copy views into the memory map.
+
+        Parameters
+        ----------
+        path : str
+            Path to folder with the dataset.
+        db_name : str
+            Name of the dataset.
+        """
+        self.data_path, index_path, keys_path, metadata_path = _filenames(path, db_name)
+        self._index = np.load(index_path)
+        self._metadata = read_json(metadata_path)
+        self._rows = {key: row for row, key in enumerate(read_list(keys_path))}
+        self._keys_list = None
+        self._data = None
+        # Parsed index entries per key: (shape, dtype, offset, metadata).
+        self._meta_cache = {}
+
+    @property
+    def data(self):
+        """Memory map of the data file, opened on first access."""
+        if self._data is None:
+            if os.path.getsize(self.data_path) == 0:
+                self._data = np.zeros(0, dtype=np.uint8)
+            else:
+                # A plain ndarray view avoids the overhead of the memmap subclass on every item.
+                self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r').view(np.ndarray)
+        return self._data
+
+    def close(self):
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def copy(self):
+        """Cheap copy of the dataset, the index is shared."""
+        new = copy.copy(self)
+        new._rows = self._rows.copy()
+        new._keys_list = None
+        return new
+
+    def __delitem__(self, key):
+        del self._rows[key]
+        self._keys_list = None
+
+    def has_key(self, key):
+        return key in self._rows
+
+    def keys(self):
+        if self._keys_list is None:
+            self._keys_list = sorted(self._rows, key=self._rows.get)
+        return self._keys_list
+
+    def _parse_entry(self, key):
+        entry = self._index[self._rows[key]]
+        ndim = int(entry['ndim'])
+        shape = tuple(int(_) for _ in entry['shape'][:ndim])
+        dtype = code_to_dtype(entry['dtype'])
+        metadata = dict(self._metadata.get(key, {}))
+        metadata['shape'] = shape
+        metadata['dtype'] = str(dtype)
+        spacing = tuple(entry['spacing'][:ndim].tolist())
+        if any(spacing):
+            metadata['spacing'] = spacing
+        parsed = (shape, dtype, int(entry['offset']), metadata)
+        self._meta_cache[key] = parsed
+        return parsed
+
+    def _view(self, key):
+        if key not in self._rows:
+            raise KeyError(key)
+        parsed = self._meta_cache.get(key, None)
+        if parsed is None:
+            parsed = self._parse_entry(key)
+        shape, dtype, offset, metadata = parsed
+        return np.ndarray(shape, dtype, buffer=self.data, offset=offset), metadata
+
+    def __getitem__(self, key):
+        data, metadata = self._view(key)
+        out = {}
+        out['data'] = data
+        out['metadata'] = dict(metadata)
+        return out
+
+    def read_metadata(self, key):
+        """See `manet.lmdb.dataset.LmdbDb.read_metadata`."""
+        _, metadata = self._view(key)
+        return dict(metadata)
+
+    def read_region(self, key, bbox, pad_value=0):
+        """See `manet.lmdb.dataset.LmdbDb.read_region`."""
+        data, _ = self._view(key)
+        return extract_patch(data, bbox, pad_value)
+
+    def read_scaled(self, key, scale):
+        """Read an image downsampled by an integer factor, see `manet.lmdb.dataset.LmdbDb.read_scaled`.
+        The levels are not stored, so the image is always downsampled after reading."""
+        data, metadata = self._view(key)
+        if scale == 1:
+            return {'data': data, 'metadata': dict(metadata)}
+        data = downsample(data, scale)
+        metadata = dict(metadata)
+        metadata.pop('pyramid', None)
+        return {'data': data, 'metadata': scale_metadata(metadata, scale, data.shape)}
+
+    def get_many(self, keys, stack=False, out=None):
+        """Fetch a batch of keys, see `manet.lmdb.dataset.LmdbDb.get_many`.
+        The keys are read in the order of the data file."""
+        keys = list(keys)
+        order = sorted(range(len(keys)), key=lambda idx: self._rows[keys[idx]])
+        views = [None] * len(keys)
+        for idx in order:
+            views[idx] = self._view(keys[idx])
+
+        metadata = [dict(meta) for _, meta in views]
+        if not stack:
+            return [{'data': data, 'metadata': meta} for (data, _), meta in zip(views, metadata)]
+
+        if not keys:
+            return {'data': out, 'metadata': []}
+        shape, dtype = views[0][0].shape, views[0][0].dtype
+        if any(data.shape != shape or data.dtype != dtype for data, _ in views):
+            raise ValueError('Can only stack items with the same shape and dtype.')
+        if out is None:
+            out = np.empty((len(keys), ) + shape, dtype=dtype)
+        for idx in order:
+            out[idx] = views[idx][0]
+        return {'data': out, 'metadata': metadata}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (' + self.data_path + ')'
+
+
+def lmdb_to_memmap(lmdb_path, lmdb_name, path, db_name=None):
+    """Convert an LMDB dataset to a memory-mapped dataset.
+
+    Parameters
+    ----------
+    lmdb_path : str
+        Path to folder with LMDB db.
+    lmdb_name : str
+        Name of the LMDB database.
+    path : str
+        Path to folder to write the memory-mapped dataset to.
+    db_name : str, optional
+        Name of the memory-mapped dataset, by default lmdb_name.
+    """
+    dataset = LmdbDb(lmdb_path, lmdb_name, persistent_txn=True)
+    try:
+        with MemmapBuilder(path, db_name or lmdb_name) as builder:
+            for key in dataset.keys():
+                item = dataset[key]
+                builder.write(key, item['data'], item['metadata'])
+    finally:
+        # Release the environment, so the database can be written again in this process.
+        dataset.close()
@@ -0,0 +1,228 @@
+# encoding: utf-8
+"""Binary record format for images stored in LMDB.
+
+A record is a fixed-size header followed by the contiguous image data and optionally a json
+encoded dictionary with the extended metadata. The header is packed as follows (little-endian):
+
+    magic (4 bytes), version (uint8), dtype code (uint8), ndim (uint8), flags (uint8), codec (uint8),
+    reserved (7 bytes), shape (4 x uint64), spacing (4 x float64), offset of extended metadata (uint64),
+    length of extended metadata (uint64).
+
+If the codec is not 'raw', the image data is compressed, see `manet.lmdb.compression`.
+
+Databases written in this format contain the key `FORMAT_KEY` with the version as value. Databases
+without this key are in the legacy format, where every image `key` has a json record `key_metadata`.
+The named sub-database `KEYS_DB` contains every image key with an empty value, so the keys can be listed
+without scanning the image records, and a commit only adds the new keys.
+
+Records belonging to an image, such as chunks, are stored in the named sub-database `EXTRA_DB`, so their
+keys cannot collide with the keys of the images in the main database.
+
+Large images can be stored tiled. In that case the flag `FLAG_TILED` is set and the record contains the
+chunk shape (ndim x uint64) in place of the image data. The chunks are stored in separate records with key
+`key/chunk index`, where the chunk index is the flat index in the grid of chunks. Chunks at the border of the
+image are cropped to the image. Every chunk is compressed separately with the codec in the header.
+
+Downsampled versions of an image can be stored next to it, in records with key `key/scale factor`.
+The factors are listed in the extended metadata of the full resolution record as 'pyramid'.
+A mask sampler, see `manet.utils.mask_utils.MaskSampler`, can be stored in the record with key `key/sampler`.
+"""
+import struct
+import numpy as np
+import simplejson as json
+from manet.lmdb.compression import codec_to_code, code_to_codec, encode, decode
+
+FORMAT_KEY = b'__manet_format__'
+FORMAT_VERSION = 1
+KEYS_DB = b'__manet_keys__'
+RESERVED_PREFIX = '__manet'
+EXTRA_DB = b'__manet_extra__'
+
+MAGIC = b'MNET'
+FLAG_TILED = 1
+MAX_NDIM = 4
+_HEADER = struct.Struct('<4sBBBBB7x4Q4dQQ')
+HEADER_SIZE = _HEADER.size
+
+_DTYPES = ['bool', 'uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32',
+           'uint64', 'int64', 'float16', 'float32', 'float64']
+_DTYPE_CODES = {np.dtype(dtype): code for code, dtype in enumerate(_DTYPES, 1)}
+
+
+def dtype_to_code(dtype):
+    """Convert a numpy dtype to the code stored in the header."""
+    try:
+        return _DTYPE_CODES[np.dtype(dtype)]
+    except KeyError:
+        raise ValueError('dtype {} cannot be stored.'.format(dtype))
+
+
+def code_to_dtype(code):
+    """Convert a dtype code from the header to a numpy dtype."""
+    return np.dtype(_DTYPES[code - 1])
+
+
+def _pack(image, metadata, data, flags, codec):
+    if image.ndim > MAX_NDIM:
+        raise ValueError('Can only store images up to dimension {}.'.format(MAX_NDIM))
+
+    metadata = dict(metadata or {})
+    for k in ['shape', 'dtype', 'chunk_shape', 'codec']:
+        metadata.pop(k, None)
+    spacing = metadata.pop('spacing', None) or []
+    if len(spacing) not in [0, image.ndim]:
+        raise ValueError('Spacing {} does not match the image dimension {}.'.format(spacing, image.ndim))
+
+    ext = json.dumps(metadata).encode('utf-8') if metadata else b''
+    ext_offset = HEADER_SIZE + len(data) if ext else 0
+
+    shape = list(image.shape) + [0] * (MAX_NDIM - image.ndim)
+    spacing = list(spacing) + [0.] * (MAX_NDIM - len(spacing))
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, dtype_to_code(image.dtype), image.ndim, flags,
+                          codec_to_code(codec), *(shape + spacing + [ext_offset, len(ext)]))
+    return header + data + ext
+
+
+def pack_record(image, metadata=None, codec=None):
+    """Pack an image and its metadata into a single record.
+
+    Parameters
+    ----------
+    image : ndarray
+    metadata : dict
+        Metadata, the keys 'shape' and 'dtype' are taken from the image. If 'spacing' is given
+        this is stored in the header, all other keys are stored as json after the image data.
+    codec : str, optional
+        Codec to compress the image data with, see `manet.lmdb.compression.CODECS`.
+
+    Returns
+    -------
+    bytes
+    """
+    image = np.ascontiguousarray(image)
+    return _pack(image, metadata, encode(codec, image.tobytes(), image.itemsize), 0, codec)
+
+
+def check_key(key):
+    """Raise a ValueError if key cannot be used for an image."""
+    if not key or key.startswith(RESERVED_PREFIX):
+        raise ValueError('Key {!r} is empty or starts with the reserved prefix {}.'.format(key, RESERVED_PREFIX))
+
+
+def chunk_key(key, chunk_idx):
+    """Key of the record in `EXTRA_DB` containing chunk chunk_idx of image key."""
+    return '{}/{}'.format(key, chunk_idx)
+
+
+def pyramid_key(key, factor):
+    """Key of the record in `EXTRA_DB` containing image key downsampled by factor."""
+    return '{}/scale{}'.format(key, factor)
+
+
+def sampler_key(key):
+    """Key of the record in `EXTRA_DB` containing the packed mask sampler of image key."""
+    return '{}/sampler'.format(key)
+
+
+def chunk_grid(shape, chunk_shape):
+    """Number of chunks along each axis."""
+    return tuple(-(-int(i) // int(j)) for i, j in zip(shape, chunk_shape))
+
+
+def chunk_slices(chunk_idx, shape, chunk_shape):
+    """Region of the image covered by a chunk, given the index of the chunk in the grid."""
+    return tuple(slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(chunk_idx, chunk_shape, shape))
+
+
+def pack_tiled_record(image, metadata=None, chunk_shape=None, codec=None):
+    """Pack an image into a header record and chunk records.
+
+    Parameters
+    ----------
+    image : ndarray
+    metadata : dict
+        See `pack_record`.
+    chunk_shape : tuple
+        Shape of the chunks. If it has more dimensions than the image, only the last dimensions are used.
+    codec : str, optional
+        Codec to compress each chunk with.
+
+    Returns
+    -------
+    The header record as bytes and a list of (chunk index, bytes) tuples.
+    """
+    chunk_shape = tuple(int(_) for _ in chunk_shape[len(chunk_shape) - image.ndim:])
+    if len(chunk_shape) != image.ndim:
+        raise ValueError('Chunk shape {} does not match the image dimension {}.'.format(chunk_shape, image.ndim))
+
+    header = _pack(image, metadata, np.array(chunk_shape, dtype='<u8').tobytes(), FLAG_TILED, codec)
+    grid = chunk_grid(image.shape, chunk_shape)
+    chunks = []
+    for chunk_idx, idx in enumerate(np.ndindex(*grid)):
+        chunk = np.ascontiguousarray(image[chunk_slices(idx, image.shape, chunk_shape)])
+        chunks.append((chunk_idx, encode(codec, chunk.tobytes(), image.itemsize)))
+    return header, chunks
+
+
+def unpack_header(buf):
+    """Parse the header of a record.
+
+    Parameters
+    ----------
+    buf : bytes or buffer
+        Record as written by `pack_record`.
+
+    Returns
+    -------
+    shape, dtype, offset of the data in the buffer and the metadata dictionary. For a tiled record
+    the metadata contains the key 'chunk_shape', for a compressed record the key 'codec'.
+    """
+    fields = _HEADER.unpack_from(buf)
+    magic, version, dtype_code, ndim, flags, codec_code = fields[:6]
+    if magic != MAGIC:
+        raise ValueError('Record does not start with the expected header.')
+    if version > FORMAT_VERSION:
+        raise ValueError('Record version {} is not supported.'.format(version))
+
+    shape = tuple(int(_) for _ in fields[6:6 + ndim])
+    spacing = tuple(fields[10:10 + ndim])
+    ext_offset, ext_length = fields[14:16]
+    dtype = code_to_dtype(dtype_code)
+
+    metadata = {}
+    if ext_length:
+        metadata = json.loads(bytes(buf[ext_offset:ext_offset + ext_length]).decode('utf-8'))
+    metadata['shape'] = shape
+    metadata['dtype'] = str(dtype)
+    if any(spacing):
+        metadata['spacing'] = spacing
+    if flags & FLAG_TILED:
+        metadata['chunk_shape'] = tuple(
+            int(_) for _ in np.frombuffer(buf, dtype='<u8', count=ndim, offset=HEADER_SIZE))
+    if codec_code:
+        metadata['codec'] = code_to_codec(codec_code)
+
+    return shape, dtype, HEADER_SIZE, metadata
+
+
+def unpack_data(buf, shape, dtype, offset, metadata):
+    """Image data of a record as parsed by `unpack_header`. Uncompressed data is not copied."""
+    codec = metadata.get('codec', None)
+    if codec is None:
+        return np.ndarray(shape, dtype, buffer=buf, offset=offset)
+    ext_offset = _HEADER.unpack_from(buf)[14]
+    return decode(codec, memoryview(buf)[offset:ext_offset or len(buf)], shape, dtype)
+
+
+def unpack_chunk(buf, shape, dtype, metadata):
+    """Data of a chunk record of a tiled image, shape is the shape of the chunk."""
+    return decode(metadata.get('codec', None), buf, shape, dtype)
+
+
+def unpack_record(buf):
+    """Unpack a record into the image and metadata dictionary."""
+    shape, dtype, offset, metadata = unpack_header(buf)
+    if 'chunk_shape' in metadata:
+        raise ValueError('Tiled records need to be assembled from the chunks.')
+    return unpack_data(buf, shape, dtype, offset, metadata), metadata
+
@@ -0,0 +1,235 @@
+# encoding: utf-8
+"""A dataset spread over several LMDB databases, for instance on different disks."""
+import os
+import copy
+import bisect
+import hashlib
+import multiprocessing
+import numpy as np
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+from manet.utils import read_json, write_json
+from manet.lmdb.dataset import LmdbDb
+from manet.lmdb.builder import build_db, read_series
+
+
+def _stable_hash(key):
+    """Hash which is the same in every process and python version, unlike `hash`."""
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    def __init__(self, num_shards, num_replicas=64):
+        """Consistent hash ring mapping keys to shards.
+
+        Every shard is placed num_replicas times on the ring and a key is routed to the first shard
+        following its hash. If a shard is added, only the keys of about one shard move.
+
+        Parameters
+        ----------
+        num_shards : int
+        num_replicas : int
+            Number of points per shard on the ring, more points give a more uniform distribution.
+        """
+        self.num_shards = num_shards
+        self.num_replicas = num_replicas
+        ring = sorted((_stable_hash('shard{}-{}'.format(shard, replica)), shard)
+                      for shard in range(num_shards) for replica in range(num_replicas))
+        self._hashes = [h for h, _ in ring]
+        self._shards = [shard for _, shard in ring]
+
+    def __call__(self, key):
+        """Shard index of key."""
+        idx = bisect.bisect(self._hashes, _stable_hash(key)) % len(self._hashes)
+        return self._shards[idx]
+
+
+def _manifest_path(path, db_name):
+    return os.path.join(path, db_name + '_shards.json')
+
+
+class ShardedLmdbDb(object):
+    def __init__(self, path, db_name, persistent_txn=False):
+        """Load a dataset which is sharded over several LMDB databases, as written by `build_sharded_db`.
+        This has the same interface as `manet.lmdb.dataset.LmdbDb`.
+
+        Parameters
+        ----------
+        path : str
+            Path to folder with the shards manifest.
+        db_name : str
+            Name of the database.
+        persistent_txn : bool
+            See `manet.lmdb.dataset.LmdbDb`.
+        """
+        self.manifest_path = _manifest_path(path, db_name)
+        manifest = read_json(self.manifest_path)
+        self.shards = [LmdbDb(shard_path, shard_name, persistent_txn=persistent_txn)
+                       for shard_path, shard_name in manifest['shards']]
+        self._ring = HashRing(len(self.shards), manifest['num_replicas'])
+        self._keys_list = None
+
+    def shard(self, key):
+        """The LmdbDb containing key."""
+        return self.shards[self._ring(key)]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def copy(self):
+        """Cheap copy of the dataset, see `manet.lmdb.dataset.LmdbDb.copy`."""
+        new = copy.copy(self)
+        new.shards = [shard.copy() for shard in self.shards]
+        return new
+
+    def __delitem__(self, key):
+        del self.shard(key)[key]
+        self._keys_list = None
+
+    def has_key(self, key):
+        return self.shard(key).has_key(key)
+
+    def keys(self):
+        if self._keys_list is None:
+            self._keys_list = [key for shard in self.shards for key in shard.keys()]
+        return self._keys_list
+
+    def __getitem__(self, key):
+        return self.shard(key)[key]
+
+    def read_metadata(self, key):
+        """See `manet.lmdb.dataset.LmdbDb.read_metadata`."""
+        return self.shard(key).read_metadata(key)
+
+    def read_region(self, key, bbox, pad_value=0):
+        """See `manet.lmdb.dataset.LmdbDb.read_region`."""
+        return self.shard(key).read_region(key, bbox, pad_value)
+
+    def read_scaled(self, key, scale):
+        """See `manet.lmdb.dataset.LmdbDb.read_scaled`."""
+        return self.shard(key).read_scaled(key, scale)
+
+    def read_sampler(self, key):
+        """See `manet.lmdb.dataset.LmdbDb.read_sampler`."""
+        return self.shard(key).read_sampler(key)
+
+    def get_many(self, keys, stack=False, out=None):
+        """Fetch a batch of keys with one transaction per shard, see `manet.lmdb.dataset.LmdbDb.get_many`.
+        With stack, every shard reads its images directly into out."""
+        keys = list(keys)
+        per_shard = {}
+        for idx, key in enumerate(keys):
+            per_shard.setdefault(self._ring(key), []).append(idx)
+
+        if not stack:
+            items = [None] * len(keys)
+            for shard, idxs in per_shard.items():
+                for idx, item in zip(idxs, self.shards[shard].get_many([keys[_] for _ in idxs])):
+                    items[idx] = item
+            return items
+
+        if not keys:
+            return {'data': out, 'metadata': []}
+        if out is None:
+            first = self.read_metadata(keys[0])
+            out = np.empty((len(keys), ) + tuple(first['shape']), dtype=first['dtype'])
+        elif len(out) != len(keys):
+            raise ValueError('out should have length {}, got shape {}.'.format(len(keys), out.shape))
+        # Every shard checks that its images have the shape and dtype of out.
+        metadata = [None] * len(keys)
+        for shard, idxs in per_shard.items():
+            for idx, meta in zip(idxs, self.shards[shard]._stack_into([keys[_] for _ in idxs], out, idxs)):
+                metadata[idx] = meta
+        return {'data': out, 'metadata': metadata}
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (' + self.manifest_path + ')'
+
+
+def _build_shard(queue, shard_idx, args, kwargs):
+    try:
+        failed = build_db(*args, **kwargs)
+    except Exception as e:
+        failed = [(key, 'Shard {} failed: {}'.format(shard_idx, e)) for key, _ in args[2]]
+    queue.put((shard_idx, failed))
+
+
+def build_sharded_db(path, db_name, items, num_shards, shard_paths=None, num_replicas=64,
+                     read_fn=read_series, num_workers=None, **kwargs):
+    """Build a dataset sharded over num_shards LMDB databases, the shards are written in parallel.
+
+    Parameters
+    ----------
+    path : str
+        Path to folder to write the shards manifest to.
+    db_name : str
+        Name of the database, the shards are named db_name_shardXXX.
+    items : list
+        List of (key, source) tuples, see `manet.lmdb.builder.build_db`.
+    num_shards : int
+        Number of shards.
+    shard_paths : list, optional
+        Folders to divide the shards over, for instance on different disks. By default path.
+    num_replicas : int
+        Number of points per shard on the consistent hash ring.
+    read_fn : function
+        See `manet.lmdb.builder.build_db`.
+    num_workers : int, optional
+        Number of decoding processes per shard, by default the number of cpus divided over the shards.
+    kwargs : dict
+        Passed to `manet.lmdb.builder.build_db`.
+
+    Returns
+    -------
+    List of (key, error message) tuples for the items which failed.
+    """
+    shard_paths = shard_paths or [path]
+    shards = [(os.path.abspath(shard_paths[idx % len(shard_paths)]), '{}_shard{:03d}'.format(db_name, idx))
+              for idx in range(num_shards)]
+    manifest_path = _manifest_path(path, db_name)
+    if os.path.isfile(manifest_path):
+        manifest = read_json(manifest_path)
+        if [tuple(_) for _ in manifest['shards']] != shards or manifest['num_replicas'] != num_replicas:
+            raise ValueError('{} exists with a different sharding.'.format(manifest_path))
+    write_json(manifest_path, {'shards': shards, 'num_replicas': num_replicas})
+
+    ring = HashRing(num_shards, num_replicas)
+    shard_items = [[] for _ in range(num_shards)]
+    for key, source in items:
+        shard_items[ring(key)].append((key, source))
+
+    if num_workers is None:
+        num_workers = max(multiprocessing.cpu_count() // num_shards, 1)
+
+    # Every shard has its own writer process, which has its own pool to decode the images.
+    queue = multiprocessing.Queue()
+    processes = []
+    for idx, (shard_path, shard_name) in enumerate(shards):
+        kwargs_ = dict(kwargs, read_fn=read_fn, num_workers=num_workers)
+        process = multiprocessing.Process(
+            target=_build_shard, args=(queue, idx, (shard_path, shard_name, shard_items[idx]), kwargs_))
+        process.start()
+        processes.append(process)
+
+    # A writer which is killed, for instance by the OOM killer, never puts its result, so the writers
+    # are checked while waiting. All items of such a shard are reported as failed, written items are
+    # skipped when the build is resumed.
+    results = {}
+    while len(results) < len(processes):
+        try:
+            shard_idx, shard_failed = queue.get(timeout=1)
+            results[shard_idx] = shard_failed
+        except Empty:
+            for idx, process in enumerate(processes):
+                if idx not in results and process.exitcode not in [None, 0]:
+                    results[idx] = [(key, 'Shard {} failed: writer exited with code {}.'.format(idx, process.exitcode))
+                                    for key, _ in shard_items[idx]]
+    for process in processes:
+        process.join()
+    return [item for idx in range(len(processes)) for item in results[idx]]
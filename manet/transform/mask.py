@@ -2,7 +2,7 @@
 # Author: Jonas Teuwen
 import numpy as np
 from skimage.transform import resize as _resize
-from skimage.measure import label, regionprops
+from manet.utils.mask_utils import connected_components
 from manet._shared.utils import assert_nD, assert_binary
 
 
@@ -40,21 +40,15 @@ def bounding_box(mask):
     Parameters
     ----------
     mask : ndarray
-        binary array
+        binary array, 2D or 3D
 
     Returns
     -------
-    List of ((col, row, height, width), (col, row)) tuples.
+    List of ((row, col, height, width), (row, col)) tuples, in 3D the slice is added.
     """
-    assert_nD(mask, 2, 'mask')
+    assert_nD(mask, [2, 3], 'mask')
     assert_binary(mask, 'mask')
 
-    regions = regionprops(label(mask))
-    bboxes = []
-    for region in regions:
-        center_of_mass = map(int, region.centroid)
-        bbox_ = np.array(region.bbox).astype(np.int)
-        bbox = np.concatenate([bbox_[:2], bbox_[2:] - bbox_[:2]]).tolist()
-        bboxes.append((bbox, center_of_mass))
-
-    return bboxes
+    components = connected_components(mask)
+    centers_of_mass = components['centroids'].astype(int).tolist()
+    return list(zip(components['bboxes'].tolist(), centers_of_mass))
@@ -1,8 +1,13 @@
 # encoding: utf-8
 from .file_readers import read_yml, read_json, write_yml, write_json
 from .file_readers import read_list, write_list
-from .image_readers import read_image, read_dcm, read_dcm_series
+from .image_readers import read_image, read_images, read_dcm, read_dcm_header, read_dcm_series
+from .image_readers import DicomSeriesVolume, ImageCache, register_modality_handler
 from .numpy_utils import prob_round, cast_numpy
-from .patch_utils import extract_patch, rebuild_bbox, sym_bbox_from_bbox, sym_bbox_from_point
-from .mask_utils import bounding_box, random_mask_idx
+from .patch_utils import extract_patch, extract_patches, rebuild_bbox, sym_bbox_from_bbox, sym_bbox_from_point
+from .mask_utils import bounding_box, random_mask_idx, connected_components, MaskSampler
+from .window_level import window_level, window_levels
+from .pyramid import downsample, build_pyramid
+from .series_index import SeriesIndex, build_series_index
+from .tiling import Tiler, Stitcher, predict_tiled
 from .bbox_utils import _split_bbox, _combine_bbox
@@ -1,16 +1,298 @@
 # encoding: utf-8
 import SimpleITK as sitk
 import os
+import json
+import hashlib
+import tempfile
+import multiprocessing
+from collections import deque, OrderedDict
 import numpy as np
+from manet.utils.file_readers import read_json
+from manet.utils.window_level import window_level, window_levels, window_level_bytes
+from manet.utils.pyramid import DEFAULT_FACTORS, downsample, build_pyramid, scale_metadata
 
 _DICOM_MODALITY_TAG = '0008|0060'
+_DICOM_IMAGE_POSITION_TAG = '0020|0032'
 _DICOM_VOI_LUT_FUNCTION = '0028|1056'
 _DICOM_WINDOW_CENTER_TAG = '0028|1050'
 _DICOM_WINDOW_WIDTH_TAG = '0028|1051'
 _DICOM_WINDOW_CENTER_WIDTH_EXPLANATION_TAG = '0028|1055'
+_DICOM_SPACING_BETWEEN_SLICES_TAG = '0018|0088'
 
 
-def read_image(filename, force_2d=False, dtype=None, **kwargs):
+def _get_tag(reader, tag, default=None):
+    """Stripped value of a dicom tag, or default if the tag is not available."""
+    return reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else default
+
+
+def read_single_frame(reader):
+    """Modality handler for single frame images, such as radiographs (CR, DX)."""
+    size = reader.GetSize()
+    if len(size) > 2 and size[2] != 1:
+        return None
+    return {'ndim': 2}
+
+
+def read_multi_frame(reader):
+    """Modality handler for modalities which can be single or multi-frame, such as MG, where a multi-frame
+    image is a DBT, and CT. Multi-frame images are read as a (depth, height, width) volume."""
+    size = reader.GetSize()
+    if len(size) < 3 or size[2] == 1:
+        return {'ndim': 2}
+    slice_spacing = _get_tag(reader, _DICOM_SPACING_BETWEEN_SLICES_TAG)
+    return {'ndim': 3, 'slice_spacing': float(slice_spacing) if slice_spacing else None}
+
+
+# Modality: handler. A handler gets the ImageFileReader after the header is read and returns how to read
+# the image as a dictionary with the number of dimensions 'ndim' and optionally the 'slice_spacing',
+# or None if it cannot read the image. This is decided before the pixel data is decoded.
+MODALITY_HANDLERS = {
+    'MG': read_multi_frame,
+    'CT': read_multi_frame,
+    'CR': read_single_frame,
+    'DX': read_single_frame,
+}
+
+
+def register_modality_handler(modality, handler):
+    """Register a handler to read images of a modality with `read_dcm`, see `MODALITY_HANDLERS`."""
+    MODALITY_HANDLERS[modality] = handler
+
+
+def _dcm_settings(reader, filename):
+    """Modality and read settings of a dicom file of which the header is read, raises if it cannot be read."""
+    modality = _get_tag(reader, _DICOM_MODALITY_TAG)
+    if not modality:
+        raise ValueError('{}: Modality tag {} does not exist.'.format(filename, _DICOM_MODALITY_TAG))
+    handler = MODALITY_HANDLERS.get(modality, None)
+    settings = handler(reader) if handler else None
+    if settings is None:
+        raise NotImplementedError('{}: Modality {} not implemented'.format(filename, modality))
+    return modality, settings
+
+
+def _dcm_geometry(reader, settings):
+    """Depth and spacing of a dicom file, the spacing has the dimension of the image as read."""
+    size = reader.GetSize()
+    depth = size[2] if len(size) > 2 else 0
+    spacing = tuple(reader.GetSpacing()[::-1])
+    if settings['ndim'] == 2:
+        spacing = spacing[-2:]
+    elif settings.get('slice_spacing'):
+        spacing = (settings['slice_spacing'], ) + spacing[-2:]
+    return depth, spacing
+
+
+# Fraction of max_size an ImageCache is reduced to when it is full.
+EVICT_FRACTION = 0.8
+
+
+def _makedirs(folder):
+    """Create folder, which can be created concurrently by other threads or processes."""
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:  # Created by another process.
+            if not os.path.isdir(folder):
+                raise
+
+
+def _write_json_atomic(filename, data):
+    """Write json to a temporary file and rename it, so concurrent readers never see a partial file.
+    Returns the size of the file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, sort_keys=True, indent=4)
+        size = f.tell()
+    os.rename(tmp_path, filename)
+    return size
+
+
+class ImageCache(object):
+    def __init__(self, cache_dir, max_size=None, pyramid_factors=DEFAULT_FACTORS):
+        """Disk cache of decoded images, used through the cache argument of `read_image` and `read_dcm`.
+
+        Every entry is a .npy file with the image and a .json file with the metadata. An entry is keyed by
+        the path, size and modification time of the file and the read parameters, so a changed file is
+        decoded again. Hits are returned as read-only memory maps.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Folder to store the cache in, can be shared between processes.
+        max_size : int, optional
+            Maximal size of the cache in bytes. If exceeded, the least recently used entries are removed until
+            the cache is below `EVICT_FRACTION` of max_size, so the cache is only scanned once every few writes.
+        pyramid_factors : tuple
+            If a downsampled image is requested, all these levels are computed and cached at once,
+            see `manet.utils.pyramid.build_pyramid`.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.pyramid_factors = pyramid_factors
+        # Estimated size of the cache, from the last scan and the entries written since. Other processes
+        # writing to the same cache are only accounted for by the next scan.
+        self._size = None
+
+    def _entry_path(self, filename, params):
+        stat = os.stat(filename)
+        params = sorted((k, np.dtype(v).str if k == 'dtype' and v else v) for k, v in params.items())
+        identifier = '{}:{}:{}:{}'.format(filename, stat.st_size, stat.st_mtime, params)
+        digest = hashlib.sha1(identifier.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _entries(self):
+        """List of (last used, size, path) for all entries."""
+        entries = []
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.npy'):
+                    path = os.path.join(root, filename[:-4])
+                    try:
+                        stat = os.stat(path + '.npy')
+                        size = stat.st_size + os.path.getsize(path + '.json')
+                    except OSError:  # Removed by another process.
+                        continue
+                    entries.append((stat.st_mtime, size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_size * EVICT_FRACTION if total > self.max_size else self.max_size
+        for _, size, path in entries:
+            if total <= target:
+                break
+            for ext in ['.npy', '.json']:
+                try:
+                    os.remove(path + ext)
+                except OSError:
+                    pass
+            total -= size
+        self._size = total
+
+    def get(self, filename, params):
+        """Cached image and metadata, or None if not in the cache."""
+        path = self._entry_path(os.path.abspath(filename), params)
+        try:
+            metadata = read_json(path + '.json')
+            image = np.load(path + '.npy', mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        # The modification time of the data file marks the last use.
+        try:
+            os.utime(path + '.npy', None)
+        except OSError:  # The cache is read-only, or the entry was removed by another process.
+            pass
+        for k in ['spacing', 'shape']:
+            if k in metadata:
+                metadata[k] = tuple(metadata[k])
+        return image, metadata
+
+    def put(self, filename, params, image, metadata):
+        """Store an image and its metadata."""
+        path = self._entry_path(os.path.abspath(filename), params)
+        folder = os.path.dirname(path)
+        _makedirs(folder)
+        # Write to temporary files and rename, so concurrent readers never see a partial entry.
+        # The metadata is written last, as it marks the entry as complete.
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(image))
+            size = f.tell()
+        os.rename(tmp_path, path + '.npy')
+        size += _write_json_atomic(path + '.json', metadata)
+        if self.max_size is not None:
+            if self._size is not None:
+                self._size += size
+            if self._size is None or self._size > self.max_size:
+                self._evict()
+
+    def read(self, reader, filename, return_stats=False, **kwargs):
+        """Read an image with reader from the cache, or read and cache it if not available.
+
+        Parameters
+        ----------
+        reader : function
+            Function mapping a filename and kwargs to an image and metadata dictionary, e.g. `read_image`.
+        filename : str
+        return_stats : bool
+            If True, also return the statistics of the read. On a miss reader is called with
+            return_stats=True, as `read_image` and `read_dcm` support.
+        kwargs : dict
+            Passed to reader, these are part of the cache key. If kwargs contains scale, the downsampled
+            image is read, which is computed from the cached full resolution image together with the
+            other pyramid levels.
+
+        Returns
+        -------
+        Image as ndarray or memmap and dictionary with metadata. If return_stats, also a dictionary with
+        'peak_bytes', the bytes allocated by the reader and the pyramid on a miss, which is 0 for a hit.
+        """
+        scale = kwargs.pop('scale', None) or 1
+        params = dict(kwargs, reader=reader.__name__)
+        if scale != 1:
+            cached = self.get(filename, dict(params, scale=scale))
+            if cached is not None:
+                return cached + ({'peak_bytes': 0}, ) if return_stats else cached
+            result = self.read(reader, filename, return_stats=return_stats, **kwargs)
+            image, metadata = result[:2]
+            pyramid = build_pyramid(image, set(self.pyramid_factors) | {scale})
+            for factor, level in pyramid.items():
+                self.put(filename, dict(params, scale=factor), level, scale_metadata(metadata, factor, level.shape))
+            metadata = scale_metadata(metadata, scale, pyramid[scale].shape)
+            if not return_stats:
+                return pyramid[scale], metadata
+            # The levels and their float32 block sums, the reader allocated nothing if the full image was a hit.
+            peak_bytes = result[2]['peak_bytes'] + sum(_.nbytes + _.size * 4 for _ in pyramid.values())
+            return pyramid[scale], metadata, {'peak_bytes': peak_bytes}
+
+        cached = self.get(filename, params)
+        if cached is not None:
+            return cached + ({'peak_bytes': 0}, ) if return_stats else cached
+        if return_stats:
+            image, metadata, stats = reader(filename, return_stats=True, **kwargs)
+        else:
+            image, metadata = reader(filename, **kwargs)
+        self.put(filename, params, image, metadata)
+        return (image, metadata, stats) if return_stats else (image, metadata)
+
+
+def _get_cache(cache):
+    """Cache can be an ImageCache instance or a folder."""
+    return cache if isinstance(cache, ImageCache) else ImageCache(cache)
+
+
+def _copy_array(data, dtype=None, out=None):
+    """Copy data to out or to a new array of dtype, casting in the same pass.
+
+    SimpleITK owns the decoded buffer, so the views on it need to be copied once. Copying the view
+    instead of the output of `sitk.GetArrayFromImage` avoids a second copy for the cast.
+    """
+    if out is None:
+        return data.astype(dtype or data.dtype)
+    if out.shape != data.shape:
+        raise ValueError('out has shape {}, expected {}.'.format(out.shape, data.shape))
+    np.copyto(out, data, casting='unsafe')
+    return out
+
+
+def _cached_read(cache, reader, filename, out, return_stats, **kwargs):
+    """Read through the cache, hits are memory maps so nothing is allocated unless out is given."""
+    result = _get_cache(cache).read(reader, filename, return_stats=return_stats, **kwargs)
+    if out is not None:
+        result = (_copy_array(result[0], out=out), ) + result[1:]
+    return result
+
+
+def _result(image, metadata, peak_bytes, return_stats):
+    """Return value of the readers, with the statistics if requested."""
+    if return_stats:
+        return image, metadata, {'peak_bytes': peak_bytes}
+    return image, metadata
+
+
+def read_image(filename, force_2d=False, dtype=None, cache=None, scale=None, out=None, return_stats=False, **kwargs):
     """Read medical image
 
     Parameters
@@ -22,225 +304,439 @@ def read_image(filename, force_2d=False, dtype=None, **kwargs):
         this option reduces the image to 2D.
     dtype : dtype
         The requested dtype the output should be cast.
+    cache : ImageCache or str, optional
+        Cache of decoded images, or the folder of one. If the image is cached, a memory map is returned.
+    scale : int, optional
+        Integer downsampling factor of the height and width, see `manet.utils.pyramid.downsample`.
+        With a cache, the full pyramid is stored so the image only needs to be decoded once.
+    out : ndarray, optional
+        Preallocated array to write the image to, for instance to reuse one buffer per worker.
+    return_stats : bool
+        If True, also return a dictionary with 'peak_bytes', the bytes allocated by this call, including
+        the decoded buffer and the output unless out is given. This is 0 for a cache hit.
 
     Returns
     -------
-    Image as ndarray and dictionary with metadata.
+    Image as ndarray and dictionary with metadata, and the statistics if return_stats is True.
     """
+    if cache:
+        return _cached_read(cache, read_image, filename, out, return_stats, force_2d=force_2d, dtype=dtype,
+                            scale=scale, **kwargs)
+
+    if scale and scale != 1:
+        image, metadata, stats = read_image(filename, force_2d=force_2d, dtype=dtype, return_stats=True, **kwargs)
+        scaled = downsample(image, scale)
+        # The block sums are accumulated in float32 and cast to the output dtype.
+        peak_bytes = stats['peak_bytes'] + scaled.size * 4 + (scaled.nbytes if scaled.dtype != np.float32 else 0)
+        if out is not None:
+            scaled = _copy_array(scaled, out=out)
+        return _result(scaled, scale_metadata(metadata, scale, scaled.shape), peak_bytes, return_stats)
+
     if os.path.splitext(filename)[-1].lower() == '.dcm':
-        image, metadata = read_dcm(filename, **kwargs)
+        image, metadata, stats = read_dcm(filename, dtype=dtype, out=out, return_stats=True, **kwargs)
+        peak_bytes = stats['peak_bytes']
 
     else:
         sitk_image = sitk.ReadImage(str(filename))
-        image = sitk.GetArrayFromImage(sitk_image)
+        # The view shares the buffer of the SimpleITK image, it is only valid while sitk_image exists.
+        view = sitk.GetArrayViewFromImage(sitk_image)
         if force_2d:
-            if image.ndim == 3 and image.shape[0] == 1:
-                image = image[0]
+            if view.ndim == 3 and view.shape[0] == 1:
+                view = view[0]
             else:
                 raise ValueError('Can only force image to be 2D when the depth is 1.')
+        image = _copy_array(view, dtype, out)
 
         metadata = {}
         metadata['filename'] = os.path.abspath(filename)
         metadata['depth'] = sitk_image.GetDepth()
         metadata['spacing'] = sitk_image.GetSpacing()[::-1]
         metadata['shape'] = image.shape
-        if dtype:
-            image = image.astype(dtype)
+        peak_bytes = view.nbytes + (image.nbytes if out is None else 0)
 
-    return image, metadata
+    return _result(image, metadata, peak_bytes, return_stats)
 
 
-def apply_window_level(sitk_image, voi_lut_fn='LINEAR', out_range=[0, 255], which_explanation=0):
-    """Apply window and level to a SimpleITK image.
+def _window_center_width(sitk_image, which_explanation=0):
+    """Window center and width from the DICOM header.
 
     Parameters
     ----------
-    sitk_image : SimpleITK image instance
-    out_range : tuple or list of new range
+    sitk_image : SimpleITK image or ImageFileReader instance
+    which_explanation : int or str
+        Index of the window, or its explanation (e.g. 'NORMAL') if there are several.
 
     Returns
     -------
-    SimpleITK image
+    Tuple (center, width)
     """
-
-    center = sitk_image.GetMetaData(
-        _DICOM_WINDOW_CENTER_TAG).strip()
-    width = sitk_image.GetMetaData(
-        _DICOM_WINDOW_WIDTH_TAG).strip()
-
-    try:
-        explanation = sitk_image.GetMetaData(_DICOM_WINDOW_CENTER_WIDTH_EXPLANATION_TAG).strip()
-    except RuntimeError:
-        explanation = '\\'*len(center.split('\\'))
-
-    exp_split = explanation.split('\\')
-    if len(exp_split) > 1:
-        c_split = center.split('\\')
-        w_split = width.split('\\')
-        if isinstance(which_explanation, int):
-            idx = which_explanation
-        else:
-            idx = exp_split.index(which_explanation)
-    center = float(c_split[idx])
-    width = float(w_split[idx])
-
-    if voi_lut_fn == 'LINEAR':
-        lower_bound = center - (width - 1)/2
-        upper_bound = center + (width - 1)/2
-    elif voi_lut_fn == 'SIGMOID':
-        origin = sitk_image.GetOrigin()
-        direction = sitk_image.GetDirection()
-        spacing = sitk_image.GetSpacing()
-        arr = sitk.GetArrayFromImage(sitk_image)
-        arr = 1.0 / (1 + np.exp(-4 * (arr - center)/width))
-        sitk_image = sitk.GetImageFromArray(arr)
-        sitk_image.SetOrigin(origin)
-        sitk_image.SetDirection(direction)
-        sitk_image.SetSpacing(spacing)
-
-    sitk_image = sitk.IntensityWindowing(
-        sitk_image, lower_bound, upper_bound,
-        out_range[0], out_range[1])
-    # Recast after intensity windowing.
-    if (out_range[0] >= 0) and (out_range[1] <= 255):
-        pass
+    centers = sitk_image.GetMetaData(_DICOM_WINDOW_CENTER_TAG).strip().split('\\')
+    widths = sitk_image.GetMetaData(_DICOM_WINDOW_WIDTH_TAG).strip().split('\\')
+    if isinstance(which_explanation, int):
+        idx = which_explanation
     else:
-        raise NotImplementedError('Only uint8 supported.')
+        explanations = []
+        if sitk_image.HasMetaDataKey(_DICOM_WINDOW_CENTER_WIDTH_EXPLANATION_TAG):
+            explanations = sitk_image.GetMetaData(
+                _DICOM_WINDOW_CENTER_WIDTH_EXPLANATION_TAG).strip().split('\\')
+        explanations = [_.strip() for _ in explanations]
+        if which_explanation not in explanations:
+            raise ValueError('Window explanation {} not in {}.'.format(which_explanation, explanations))
+        idx = explanations.index(which_explanation)
+    return float(centers[idx]), float(widths[idx])
 
-    sitk_image = sitk.Cast(sitk_image, sitk.sitkUInt8)
-    return sitk_image
 
+def _voi_lut_fn(voi_lut_fn, sitk_linear):
+    return 'LINEAR_SITK' if sitk_linear and voi_lut_fn == 'LINEAR' else voi_lut_fn
 
-def apply_window_level_sigmoid(sitk_image, out_range=[0, 255], which_explanation=0):
+
+def apply_window_level(sitk_image, voi_lut_fn='LINEAR', out_range=[0, 255], which_explanation=0, dtype=None,
+                       sitk_linear=True):
     """Apply window and level to a SimpleITK image.
 
     Parameters
     ----------
     sitk_image : SimpleITK image instance
+    voi_lut_fn : str
+        VOI LUT function, see `manet.utils.window_level.window_level`.
     out_range : tuple or list of new range
+    which_explanation : int or str
+        Index or explanation of the window to apply.
+    dtype : dtype, optional
+        Output dtype, by default the smallest dtype containing out_range.
+    sitk_linear : bool
+        If True, LINEAR is applied as the SimpleITK IntensityWindowing filter used before, see 'LINEAR_SITK'
+        in `manet.utils.window_level`. If False, the DICOM formula is used, which differs by at most one.
 
     Returns
     -------
     SimpleITK image
     """
+    voi_lut_fn = _voi_lut_fn(voi_lut_fn, sitk_linear)
+    center, width = _window_center_width(sitk_image, which_explanation)
+    arr = window_level(sitk.GetArrayViewFromImage(sitk_image), center, width, voi_lut_fn, out_range, dtype)
+    new_image = sitk.GetImageFromArray(arr)
+    new_image.CopyInformation(sitk_image)
+    return new_image
 
-    center = sitk_image.GetMetaData(
-        _DICOM_WINDOW_CENTER_TAG).strip()
-    width = sitk_image.GetMetaData(
-        _DICOM_WINDOW_WIDTH_TAG).strip()
 
-    try:
-        explanation = sitk_image.GetMetaData(
-            _DICOM_WINDOW_CENTER_WIDTH_EXPLANATION_TAG).strip()
-    except RuntimeError():
-        explanation = ''
-
-    exp_split = explanation.split('\\')
-    if len(exp_split) > 1:
-        c_split = center.split('\\')
-        w_split = width.split('\\')
-        if isinstance(which_explanation, int):
-            idx = which_explanation
-        else:
-            idx = exp_split.index(which_explanation)
-    center = float(c_split[idx])
-    width = float(w_split[idx])
-
-    lower_bound = center - (width - 1)/2
-    upper_bound = center + (width - 1)/2
-
-    sitk_image = sitk.IntensityWindowing(
-        sitk_image, lower_bound, upper_bound,
-        out_range[0], out_range[1])
-    # Recast after intensity windowing.
-    if (out_range[0] >= 0) and (out_range[1] <= 255):
-        pass
-    else:
-        raise NotImplementedError('Only uint8 supported.')
+def apply_window_level_sigmoid(sitk_image, out_range=[0, 255], which_explanation=0):
+    """Apply window and level with the SIGMOID function to a SimpleITK image.
 
-    sitk_image = sitk.Cast(sitk_image, sitk.sitkUInt8)
-    return sitk_image
+    Parameters
+    ----------
+    sitk_image : SimpleITK image instance
+    out_range : tuple or list of new range
 
+    Returns
+    -------
+    SimpleITK image
+    """
+    return apply_window_level(sitk_image, 'SIGMOID', out_range, which_explanation)
 
 
-def read_dcm(filename, window_leveling=True, dtype=None, **kwargs):
+def read_dcm(filename, window_leveling=True, dtype=None, out_range=(0, 255), which_explanation=0, cache=None,
+             out=None, sitk_linear=True, return_stats=False, **kwargs):
     """Read single dicom files. Tries to apply VOILutFunction if available.
-    Check if the file is a mammogram or not.
+    The modality handler in `MODALITY_HANDLERS` decides from the header how to read the image, before
+    the pixel data is decoded. Single frame images are read as 2D, multi-frame images such as DBT as a
+    (depth, height, width) volume.
 
     Parameters
     ----------
     filename : str
         Path to dicom file
     window_leveling : bool
-        Whether to apply the window level settings.
+        Whether to apply the window level settings. If True and the header has no window, a ValueError
+        is raised before the pixel data is decoded.
     dtype : dtype
-        The type the output should be cast.
+        The type the output should be cast. When window leveling, the output is computed in this dtype.
+    out_range : tuple
+        Output range of the window leveling.
+    which_explanation : int, str or list
+        Index or explanation of the window to apply. If a list, all windows are applied to the same
+        decoded image and the output is stacked along the first axis, e.g. (n_windows, height, width).
+    cache : ImageCache or str, optional
+        Cache of decoded images, or the folder of one. If the image is cached, a memory map is returned.
+    out : ndarray, optional
+        Preallocated array to write the image to, its dtype takes precedence over dtype.
+    sitk_linear : bool
+        If True, the LINEAR function is applied as by the SimpleITK filter used before, so existing datasets
+        are reproduced exactly. If False, the DICOM formula is used, see `apply_window_level`.
+    return_stats : bool
+        If True, also return a dictionary with 'peak_bytes', see `read_image`.
 
     Returns
     -------
-    Image as ndarray and dictionary with metadata
+    Image as ndarray and dictionary with metadata, and the statistics if return_stats is True.
 
     TODO: Rename to read_mammo and rebuild the read_dcm function.
-    TODO: Seperate function to only read the dicom header.
     """
     if not os.path.splitext(str(filename))[1] == '.dcm':
         raise ValueError('{} should have .dcm as an extension'.format(filename))
 
+    if cache:
+        return _cached_read(cache, read_dcm, filename, out, return_stats, window_leveling=window_leveling, dtype=dtype,
+                            out_range=out_range, which_explanation=which_explanation, sitk_linear=sitk_linear,
+                            **kwargs)
+
     # SimpleITK has issues with unicode string names.
-    sitk_image = sitk.ReadImage(str(filename))
-    try:
-        modality = sitk_image.GetMetaData(_DICOM_MODALITY_TAG)
-    except RuntimeError as e:  # The key probably does not exist
-        modality = None
-        raise ValueError('Modality tag {} does not exist: {}'
-                         .format(_DICOM_MODALITY_TAG, e))
-    try:
-        voi_lut_fn = sitk_image.GetMetaData(
-            _DICOM_VOI_LUT_FUNCTION).strip()
-    except RuntimeError:
-        voi_lut_fn = 'LINEAR'
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(filename))
+    reader.ReadImageInformation()
+    # Decide how to read the image before decoding.
+    modality, settings = _dcm_settings(reader, filename)
+    voi_lut_fn = _voi_lut_fn(_get_tag(reader, _DICOM_VOI_LUT_FUNCTION, 'LINEAR'), sitk_linear)
+    if window_leveling and not all(
+            reader.HasMetaDataKey(_) for _ in [_DICOM_WINDOW_CENTER_TAG, _DICOM_WINDOW_WIDTH_TAG]):
+        raise ValueError('{}: Window tags {} and {} are required for window leveling, '
+                         'use window_leveling=False to read the raw image.'.format(
+                             filename, _DICOM_WINDOW_CENTER_TAG, _DICOM_WINDOW_WIDTH_TAG))
 
     # Check if kwargs contains extra dicom tags
     dicom_keys = kwargs.get('dicom_keys', None)
     extra_metadata = {}
     if dicom_keys:
         for k, v in dicom_keys:
-            extra_metadata[k] = sitk_image.GetMetaData(v)
-
-    # This needs to be done after reading all tags.
-    # The DICOM tags are lost after this operation.
-    if window_leveling:
-        try:
-            sitk_image = apply_window_level(sitk_image, voi_lut_fn)
-        except NotImplementedError as e:
-            raise NotImplementedError(
-                '{}: {}'.format(filename, e))
+            extra_metadata[k] = reader.GetMetaData(v)
 
     metadata = {}
     metadata.update(extra_metadata)
     metadata['filename'] = os.path.abspath(filename)
-    metadata['depth'] = sitk_image.GetDepth()
-    metadata['modality'] = 'n/a' if not modality else modality
-    metadata['spacing'] = sitk_image.GetSpacing()[::-1]
+    metadata['depth'], metadata['spacing'] = _dcm_geometry(reader, settings)
+    metadata['modality'] = modality
 
-    data = sitk.GetArrayFromImage(sitk_image)
-    if dtype:
-        data = data.astype(dtype)
-
-    if modality == 'MG':
-        # If modality is MG the image can be a DBT image.
-        # If the image is true mammogram, we reshape.
-        if metadata['depth'] == 1:
-            data = data.reshape(data.shape[1:])
-            metadata['spacing'] = metadata['spacing'][1:]
+    sitk_image = reader.Execute()
+    # The view shares the buffer of the SimpleITK image, it is only valid while sitk_image exists.
+    data = sitk.GetArrayViewFromImage(sitk_image)
+    if settings['ndim'] == 2:
+        data = data.reshape(data.shape[-2:])
+
+    src = data
+    if window_leveling:
+        try:
+            if isinstance(which_explanation, (list, tuple)):
+                windows = [_window_center_width(reader, _) for _ in which_explanation]
+                data = window_levels(src, windows, voi_lut_fn, out_range, dtype, out=out)
+            else:
+                windows = [_window_center_width(reader, which_explanation)]
+                data = window_level(src, windows[0][0], windows[0][1], voi_lut_fn, out_range, dtype, out=out)
+        except ValueError as e:
+            raise ValueError('{}: {}'.format(filename, e))
+        temp_bytes = window_level_bytes(src, len(windows), data.dtype, voi_lut_fn=voi_lut_fn)
     else:
-        raise NotImplementedError(
-            '{}: Modality {} not implemented'.format(filename, modality))
+        data = _copy_array(src, dtype, out)
+        temp_bytes = 0
+    peak_bytes = src.nbytes + temp_bytes + (data.nbytes if out is None else 0)
 
-    return data, metadata
+    return _result(data, metadata, peak_bytes, return_stats)
+
+
+def _header_cache_path(cache_dir, filename, dicom_keys):
+    """Path of the cached header, the file is identified by its path, size and modification time."""
+    stat = os.stat(filename)
+    identifier = '{}:{}:{}:{}'.format(filename, stat.st_size, stat.st_mtime, dicom_keys)
+    digest = hashlib.sha1(identifier.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest[:2], digest + '.json')
+
+
+def read_dcm_header(filename, dicom_keys=None, cache_dir=None):
+    """Read the header of a single dicom file, without decoding the pixel data.
+
+    Parameters
+    ----------
+    filename : str
+        Path to dicom file
+    dicom_keys : list, optional
+        List of (name, dicom tag) tuples which are added to the metadata.
+    cache_dir : str, optional
+        If given, the header is cached in this folder as json. The cache entry is keyed by the path,
+        size and modification time, so a changed file is read again.
 
+    Returns
+    -------
+    Dictionary with the same metadata as `read_dcm`.
+    """
+    filename = os.path.abspath(str(filename))
+    if cache_dir:
+        cache_path = _header_cache_path(cache_dir, filename, dicom_keys)
+        if os.path.isfile(cache_path):
+            metadata = read_json(cache_path)
+            metadata['spacing'] = tuple(metadata['spacing'])
+            return metadata
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filename)
+    reader.ReadImageInformation()
+
+    modality = _get_tag(reader, _DICOM_MODALITY_TAG)
+    handler = MODALITY_HANDLERS.get(modality, None)
+    # Without a handler, the image is described as SimpleITK reads it.
+    settings = (handler(reader) if handler else None) or {'ndim': len(reader.GetSize())}
 
-def read_dcm_series(path, series_id=None):
+    metadata = {}
+    if dicom_keys:
+        for k, v in dicom_keys:
+            metadata[k] = reader.GetMetaData(v)
+    metadata['filename'] = filename
+    metadata['depth'], metadata['spacing'] = _dcm_geometry(reader, settings)
+    metadata['modality'] = 'n/a' if not modality else modality
+
+    if cache_dir:
+        _makedirs(os.path.dirname(cache_path))
+        _write_json_atomic(cache_path, metadata)
+    return metadata
+
+
+# SimpleITK pixel types of scalar images and the corresponding numpy dtypes.
+_PIXEL_DTYPES = {
+    sitk.sitkUInt8: np.dtype(np.uint8), sitk.sitkInt8: np.dtype(np.int8),
+    sitk.sitkUInt16: np.dtype(np.uint16), sitk.sitkInt16: np.dtype(np.int16),
+    sitk.sitkUInt32: np.dtype(np.uint32), sitk.sitkInt32: np.dtype(np.int32),
+    sitk.sitkUInt64: np.dtype(np.uint64), sitk.sitkInt64: np.dtype(np.int64),
+    sitk.sitkFloat32: np.dtype(np.float32), sitk.sitkFloat64: np.dtype(np.float64),
+}
+
+
+class DicomSeriesVolume(object):
+    def __init__(self, filenames, cache_size=8):
+        """Volume of a dicom series which only decodes a slice when it is indexed.
+
+        Supports numpy style indexing, e.g. volume[10], volume[5:8, 100:200], volume[[1, 3]], volume[mask]
+        with a boolean mask over the slices, or volume[..., 0], where the first axis selects the slices.
+        The most recently decoded slices are kept in an LRU cache.
+
+        Parameters
+        ----------
+        filenames : list
+            Filenames of the slices, sorted along the volume axis.
+        cache_size : int
+            Number of decoded slices to keep.
+        """
+        self.filenames = list(filenames)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(self.filenames[0]))
+        reader.ReadImageInformation()
+        size = reader.GetSize()
+        self.shape = (len(self.filenames), size[1], size[0])
+        spacing = reader.GetSpacing()
+        self.spacing = (self._slice_spacing(reader, spacing[2] if len(spacing) > 2 else 1.), spacing[1], spacing[0])
+        self.dtype = _PIXEL_DTYPES.get(reader.GetPixelID(), None)
+        if self.dtype is None:
+            raise ValueError('{}: Pixel type {} is not supported.'.format(
+                self.filenames[0], reader.GetPixelIDTypeAsString()))
+
+    def _slice_spacing(self, first_reader, default):
+        """Distance between the first two slices, as computed by `sitk.ImageSeriesReader`."""
+        if len(self.filenames) < 2 or not first_reader.HasMetaDataKey(_DICOM_IMAGE_POSITION_TAG):
+            return default
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(self.filenames[1]))
+        reader.ReadImageInformation()
+        if not reader.HasMetaDataKey(_DICOM_IMAGE_POSITION_TAG):
+            return default
+        positions = [np.array(_.GetMetaData(_DICOM_IMAGE_POSITION_TAG).split('\\'), dtype=float)
+                     for _ in [first_reader, reader]]
+        return float(np.linalg.norm(positions[1] - positions[0])) or default
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_slice(self, idx):
+        """Decoded slice idx, from the cache if available."""
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('Slice {} out of range for volume with {} slices.'.format(idx, len(self)))
+        if idx in self._cache:
+            self._cache[idx] = self._cache.pop(idx)
+            return self._cache[idx]
+
+        data = sitk.GetArrayFromImage(sitk.ReadImage(str(self.filenames[idx])))
+        data = data.reshape(data.shape[-2:])
+        data.flags.writeable = False
+        self._cache[idx] = data
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def _slice_indices(self, idx):
+        """Indices of the slices selected by a slice, a boolean mask or a list of integers."""
+        if isinstance(idx, slice):
+            return range(*idx.indices(len(self)))
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            if idx.shape != (len(self), ):
+                raise IndexError('Boolean index of shape {} does not match {} slices.'.format(idx.shape, len(self)))
+            return np.flatnonzero(idx)
+        if idx.ndim != 1 or idx.dtype.kind not in 'iu':
+            raise IndexError('Slices can only be indexed by an integer, slice, boolean mask or list of integers.')
+        return idx
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item, )
+        if any(_ is None for _ in item):
+            raise IndexError('New axes are not supported, index the returned array instead.')
+        if any(_ is Ellipsis for _ in item):
+            pos = [_ is Ellipsis for _ in item].index(True)
+            item = item[:pos] + (slice(None), ) * (self.ndim - len(item) + 1) + item[pos + 1:]
+        idx, rest = item[0], item[1:]
+        if isinstance(idx, (bool, np.bool_)):
+            raise IndexError('Boolean scalars are not supported as index.')
+        if isinstance(idx, (int, np.integer)):
+            return self.get_slice(int(idx))[rest].copy()
+        slices = [self.get_slice(int(_))[rest] for _ in self._slice_indices(idx)]
+        if not slices:
+            return np.empty((0, ) + np.empty(self.shape[1:], dtype=np.uint8)[rest].shape, dtype=self.dtype)
+        return np.stack(slices)
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        return data.astype(dtype) if dtype else data
+
+    def read_region(self, bbox, pad_value=0):
+        """Read a region of the volume, only the slices intersecting the bounding box are decoded.
+
+        Parameters
+        ----------
+        bbox : tuple
+            bbox of the form (coordinates, size), see `manet.utils.patch_utils.extract_patch`.
+        pad_value : number
+            Value to pad with if the bounding box is not contained in the volume.
+
+        Returns
+        -------
+        ndarray
+        """
+        bbox = np.asarray(bbox, dtype=int)
+        bbox_coords, bbox_size = bbox[:self.ndim], bbox[self.ndim:]
+        # Part of the bounding box within the volume.
+        region = tuple(slice(max(i, 0), max(min(i + j, s), max(i, 0)))
+                       for i, j, s in zip(bbox_coords, bbox_size, self.shape))
+        out_idx = tuple(slice(r.start - i, r.stop - i) for r, i in zip(region, bbox_coords))
+        patch = np.empty(bbox_size, dtype=self.dtype)
+        if any(r.stop - r.start != j for r, j in zip(region, bbox_size)):
+            patch[...] = pad_value
+        for out_slice, idx in zip(range(out_idx[0].start, out_idx[0].stop), range(region[0].start, region[0].stop)):
+            patch[(out_slice, ) + out_idx[1:]] = self.get_slice(idx)[region[1:]]
+        return patch
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def __repr__(self):
+        return '{} (shape {}, {})'.format(self.__class__.__name__, self.shape, os.path.dirname(self.filenames[0]))
+
+
+def read_dcm_series(path, series_id=None, lazy=False, cache_size=8, index=None):
     """Read dicom series from a folder. If multiple dicom series are availabe in the folder,
     no image is returned. The metadata dictionary then contains the SeriesIDs which can be selected.
 
@@ -250,6 +746,13 @@ def read_dcm_series(path, series_id=None):
         path to folder containing the series
     series_ids : str
         SeriesID to load
+    lazy : bool
+        If True, return a `DicomSeriesVolume` instead of an ndarray, which decodes the slices on demand.
+    cache_size : int
+        Number of decoded slices the lazy volume keeps.
+    index : SeriesIndex, optional
+        Index of series, see `manet.utils.series_index.build_series_index`.
+        If given, the slices of series_id are taken from the index without scanning path, which can be None.
 
     Returns
     -------
@@ -262,19 +765,37 @@ def read_dcm_series(path, series_id=None):
     GDCMSeriesFileNames (0x4a6e830): No Series were found
     """
 
-    if not os.path.isdir(path):
-        raise ValueError('{} is not a directory'.format(path))
-
     metadata = {}
     reader = sitk.ImageSeriesReader()
-    series_ids = list(reader.GetGDCMSeriesIDs(str(path)))
-    metadata['series_ids'] = series_ids
-    if len(series_ids) > 1 and not series_ids:
-        image = None
-        return image, metadata
+    if index is not None:
+        if series_id is None:
+            raise ValueError('A series_id is required to read from an index.')
+        entry = index[series_id]
+        metadata['series_ids'] = [series_id]
+        metadata['study_uid'] = entry['study_uid']
+        metadata['modality'] = 'n/a' if not entry['modality'] else entry['modality']
+        fns = entry['filenames']
+    else:
+        if not os.path.isdir(path):
+            raise ValueError('{} is not a directory'.format(path))
+
+        series_ids = list(reader.GetGDCMSeriesIDs(str(path)))
+        metadata['series_ids'] = series_ids
+        if len(series_ids) > 1 and not series_ids:
+            image = None
+            return image, metadata
+
+        fns = reader.GetGDCMSeriesFileNames(
+            str(path), series_id or series_ids[0])
+
+    if lazy:
+        volume = DicomSeriesVolume(fns, cache_size=cache_size)
+        metadata['filenames'] = fns
+        metadata['depth'] = len(volume)
+        metadata['spacing'] = volume.spacing
+        metadata['shape'] = volume.shape
+        return volume, metadata
 
-    fns = reader.GetGDCMSeriesFileNames(
-        str(path), series_id or series_ids[0])
     reader.SetFileNames(fns)
     sitk_image = reader.Execute()
 
@@ -287,3 +808,77 @@ def read_dcm_series(path, series_id=None):
     metadata['shape'] = tuple(data.shape)
 
     return data, metadata
+
+
+def _read_one(reader, filename, kwargs):
+    """Read a single file, errors are returned instead of raised so the other files are still read."""
+    try:
+        image, metadata = reader(filename, **kwargs)
+    except Exception as e:
+        return filename, None, None, e
+    return filename, image, metadata, None
+
+
+def read_images(filenames, workers=None, reader=read_image, processes=False, ordered=True,
+                max_pending=None, **kwargs):
+    """Read many images in parallel. The decoding in SimpleITK releases the GIL, so threads scale well.
+
+    Parameters
+    ----------
+    filenames : iterable
+        Filenames to read, can be a generator.
+    workers : int, optional
+        Number of threads or processes, by default the number of cpus. If 0, the files are read in
+        the current thread.
+    reader : function
+        Function mapping a filename and kwargs to an image and metadata dictionary, for instance
+        `read_image`, `read_dcm` or `read_dcm_series`. Needs to be picklable if processes is True.
+    processes : bool
+        If True, use a pool of processes instead of threads.
+    ordered : bool
+        If True, the results are yielded in the order of filenames, otherwise as soon as they are available.
+    max_pending : int, optional
+        Maximal number of files being read or waiting to be yielded, by default twice the number of workers.
+        This bounds the memory use when the consumer is slower than the readers.
+    kwargs : dict
+        Passed to reader.
+
+    Returns
+    -------
+    Generator of (filename, image, metadata, error) tuples. If reading failed, image and metadata
+    are None and error is the exception.
+    """
+    if workers == 0:
+        for filename in filenames:
+            yield _read_one(reader, filename, kwargs)
+        return
+
+    # Imported here, as on Python 2 this requires the futures backport.
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    workers = workers or multiprocessing.cpu_count()
+    max_pending = max_pending or 2 * workers
+    executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(workers)
+    filenames = iter(filenames)
+    pending = deque()
+    try:
+        for filename in filenames:
+            pending.append(executor.submit(_read_one, reader, filename, kwargs))
+            if len(pending) >= max_pending:
+                break
+
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(iter(wait(pending, return_when=FIRST_COMPLETED)[0]))
+                pending.remove(future)
+            result = future.result()
+            for filename in filenames:
+                pending.append(executor.submit(_read_one, reader, filename, kwargs))
+                break
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -1,9 +1,10 @@
 # encoding: utf-8
+import io
 import numpy as np
-from manet.utils.bbox_utils import _combine_bbox
+from manet.utils.bbox_utils import _combine_bbox, _split_bbox
 from manet._shared.utils import assert_nD, assert_binary
-from skimage.measure import find_contours, approximate_polygon, regionprops
-from skimage.morphology import label
+from skimage.measure import find_contours, approximate_polygon
+from scipy import ndimage
 from scipy.spatial import Delaunay
 
 
@@ -21,18 +22,64 @@ def bounding_box(mask):
     """
     bbox_coords = []
     bbox_sizes = []
+    # After every axis the mask is cropped to the found range, so only the first reduction is over the full mask.
+    region = mask
     for idx in range(mask.ndim):
         axis = tuple([i for i in range(mask.ndim) if i != idx])
-        nonzeros = np.any(mask, axis=axis)
-        min_val, max_val = np.where(nonzeros)[0][[0, -1]]
+        nonzeros = np.flatnonzero(np.any(region, axis=axis))
+        if len(nonzeros) == 0:
+            raise ValueError('Mask contains no non-zero entries.')
+        min_val, max_val = nonzeros[0], nonzeros[-1]
+        region = region[(slice(None), ) * idx + (slice(min_val, max_val + 1), )]
         bbox_coords.append(min_val)
         bbox_sizes.append(max_val - min_val + 1)
 
     return _combine_bbox(bbox_coords, bbox_sizes)
 
 
+def connected_components(mask, connectivity=None):
+    """Label the connected components of a mask and compute their bounding boxes, areas and centroids.
+
+    The mask is labeled once with `scipy.ndimage.label`, the bounding boxes are read with
+    `scipy.ndimage.find_objects` and the areas and centroids are computed with bincounts over the
+    non-zero values only.
+
+    Parameters
+    ----------
+    mask : ndarray
+        Binary mask, 2D or 3D.
+    connectivity : int, optional
+        Maximal number of orthogonal steps between neighbours, as in `skimage.measure.label`.
+        By default mask.ndim, so diagonal neighbours are connected.
+
+    Returns
+    -------
+    Dictionary with
+        labels : ndarray with the label of every pixel, 0 is background and the components are 1, ..., N.
+        bboxes : (N, 2 * ndim) int array with bounding boxes of the form (coordinates, size).
+        areas : (N, ) int array with the number of pixels per component.
+        centroids : (N, ndim) float array.
+    """
+    structure = ndimage.generate_binary_structure(mask.ndim, connectivity or mask.ndim)
+    labels, num_labels = ndimage.label(mask, structure=structure)
+
+    bboxes = np.zeros((num_labels, 2 * mask.ndim), dtype=int)
+    for idx, region in enumerate(ndimage.find_objects(labels)):
+        bboxes[idx] = [r.start for r in region] + [r.stop - r.start for r in region]
+
+    flat_idx = np.flatnonzero(labels)
+    flat_labels = labels.ravel()[flat_idx]
+    areas = np.bincount(flat_labels, minlength=num_labels + 1)[1:]
+    coords = np.unravel_index(flat_idx, mask.shape)
+    centroids = np.zeros((num_labels, mask.ndim))
+    for axis, axis_coords in enumerate(coords):
+        centroids[:, axis] = np.bincount(flat_labels, weights=axis_coords, minlength=num_labels + 1)[1:] / areas
+
+    return {'labels': labels, 'bboxes': bboxes, 'areas': areas, 'centroids': centroids}
+
+
 def random_mask_idx(mask):
-    """Get a random mask index"""
+    """Get a random mask index. To sample repeatedly from the same mask, use `MaskSampler`."""
     mask_idx = np.where(mask != 0)  # This is slow.
     try:
         selected_idx = np.random.randint(len(mask_idx[0]))
@@ -43,6 +90,115 @@ def random_mask_idx(mask):
     return rand_idx
 
 
+class MaskSampler(object):
+    def __init__(self, mask, avoid=None, weights=None):
+        """Sample indices within the non-zero values of a mask.
+
+        The flat indices of the non-zero values are computed once, after which every sample is a
+        constant time lookup. Many samples are drawn in a single vectorized operation. The sorted flat
+        indices of the samples are `indices`, those of all non-zero values, including the margin, are
+        `mask_indices`.
+
+        Parameters
+        ----------
+        mask : ndarray
+        avoid : int or tuple, optional
+            Margin per axis at the border of the bounding box of the mask from which no indices are sampled.
+            If the mask has several components, the margin is relative to the bounding box of all of them.
+        weights : ndarray, optional
+            Array with the shape of the mask. If given, indices are sampled with probability proportional
+            to the weight, for instance a function of the distance to a lesion.
+        """
+        self.shape = tuple(mask.shape)
+        index_dtype = np.int32 if mask.size < 2**31 else np.int64
+        self.mask_indices = np.flatnonzero(mask).astype(index_dtype)
+        if avoid is None or np.all(np.asarray(avoid) == 0):
+            self.avoid = None
+            self.indices = self.mask_indices
+        else:
+            self.avoid = tuple(np.broadcast_to(np.asarray(avoid, dtype=int), (mask.ndim, )).tolist())
+            self.indices = np.zeros(0, dtype=index_dtype)
+            if len(self.mask_indices):
+                bbox_coords, bbox_size = _split_bbox(bounding_box(mask))
+                starts = bbox_coords + self.avoid
+                stops = np.maximum(bbox_coords + bbox_size - self.avoid, starts)
+                inner = mask[tuple(slice(i, j) for i, j in zip(starts, stops))]
+                coords = np.unravel_index(np.flatnonzero(inner), inner.shape)
+                coords = tuple(c + i for c, i in zip(coords, starts))
+                self.indices = np.ravel_multi_index(coords, self.shape).astype(index_dtype)
+
+        self.cumulative_weights = None
+        if weights is not None:
+            cumulative_weights = np.cumsum(np.asarray(weights).ravel()[self.indices], dtype=np.float64)
+            if len(cumulative_weights) and cumulative_weights[-1] <= 0:
+                raise ValueError('The weights within the mask need to have a positive sum.')
+            self.cumulative_weights = cumulative_weights
+
+    def __len__(self):
+        return len(self.indices)
+
+    def sample(self, num=None, rng=None):
+        """Sample indices within the mask.
+
+        Parameters
+        ----------
+        num : int, optional
+            Number of samples. If not given, a single index is returned as a tuple.
+        rng : RandomState, optional
+            Random number generator, by default the global numpy generator.
+
+        Returns
+        -------
+        Tuple with a single index, or an ndarray of shape (num, ndim).
+        """
+        if len(self.indices) == 0:
+            raise ValueError('Mask contains no non-zero entries.')
+        rng = rng or np.random
+        size = 1 if num is None else num
+        if self.cumulative_weights is None:
+            positions = rng.randint(0, len(self.indices), size=size)
+        else:
+            uniform = rng.random_sample(size) * self.cumulative_weights[-1]
+            positions = np.searchsorted(self.cumulative_weights, uniform, side='right')
+        coords = np.stack(np.unravel_index(self.indices[positions], self.shape), axis=-1)
+        if num is None:
+            return tuple(coords[0].tolist())
+        return coords
+
+    def pack(self):
+        """Serialize the sampler to bytes, for instance to store it next to an LMDB record."""
+        arrays = {'shape': np.array(self.shape, dtype=np.int64), 'indices': self.indices}
+        if self.avoid is not None:
+            arrays['avoid'] = np.array(self.avoid, dtype=np.int64)
+            arrays['mask_indices'] = self.mask_indices
+        if self.cumulative_weights is not None:
+            arrays['cumulative_weights'] = self.cumulative_weights
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        return buf.getvalue()
+
+    @classmethod
+    def unpack(cls, buf):
+        """Load a sampler serialized with `pack`."""
+        arrays = np.load(io.BytesIO(bytes(buf)))
+        sampler = cls.__new__(cls)
+        sampler.shape = tuple(arrays['shape'].tolist())
+        sampler.indices = arrays['indices']
+        sampler.avoid = tuple(arrays['avoid'].tolist()) if 'avoid' in arrays else None
+        sampler.mask_indices = arrays['mask_indices'] if 'mask_indices' in arrays else sampler.indices
+        sampler.cumulative_weights = arrays['cumulative_weights'] if 'cumulative_weights' in arrays else None
+        return sampler
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.pack())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls.unpack(f.read())
+
+
 def find_contour(mask, tolerance=0):
     """"""
 
@@ -94,7 +250,7 @@ def mask_to_coords(mask, get_contours=False):
     Parameters
     ----------
     mask : ndarray
-        binary mask
+        binary mask, 2D or 3D
     get_contours : bool
         if True, also output contours
 
@@ -102,18 +258,12 @@ def mask_to_coords(mask, get_contours=False):
     -------
     centroids and optionally the coordinates.
     """
-    assert_nD(mask, 2)
+    assert_nD(mask, [2, 3])
     assert_binary(mask)
 
-    labels, num_labels = label(mask, background=0, return_num=True)
-    regions = regionprops(labels, mask)
-
     # We can extract the contours as well, if we want.
     if get_contours:
-        raise NotImplementedError('Not Implemented. Use find_countours, mask is stored in `intensity_image` property.')
-
-    centroids = []
-    for region in regions:
-        centroids.append(region.centroid)
+        raise NotImplementedError('Not Implemented. Use find_countours on the mask.')
 
-    return centroids
+    centroids = connected_components(mask)['centroids']
+    return [tuple(_) for _ in centroids.tolist()]
@@ -1,10 +1,18 @@
 # encoding: utf-8
 from __future__ import division
+import copy
 import numpy as np
-from manet.utils import prob_round, read_dcm
+from numpy.lib.stride_tricks import as_strided
+from manet.utils import prob_round, read_dcm, read_image
 from manet.utils import cast_numpy
 from manet.utils.bbox_utils import _split_bbox, _combine_bbox
-from manet.utils.mask_utils import random_mask_idx, bounding_box
+from manet.utils.mask_utils import MaskSampler
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
 
 def extract_patch(image, bbox, pad_value=0):
     """Extract bbox from images, coordinates can be negative.
@@ -32,9 +40,9 @@ def extract_patch(image, bbox, pad_value=0):
     r_offset = (bbox_coords + bbox_size) - np.array(image.shape)
     r_offset[r_offset < 0] = 0
 
-    region_idx = [slice(i, j) for i, j
-                  in zip(bbox_coords + l_offset,
-                         bbox_coords + bbox_size - r_offset)]
+    region_idx = tuple([slice(i, j) for i, j
+                        in zip(bbox_coords + l_offset,
+                               bbox_coords + bbox_size - r_offset)])
     out = image[region_idx]
 
     if np.all(l_offset == 0) and np.all(r_offset == 0):
@@ -42,12 +50,74 @@ def extract_patch(image, bbox, pad_value=0):
 
     # If we have a positive offset, we need to pad the patch.
     patch = pad_value*np.ones(bbox_size, dtype=image.dtype)
-    patch_idx = [slice(i, j) for i, j
-                 in zip(l_offset, bbox_size + l_offset - r_offset)]
+    patch_idx = tuple([slice(i, j) for i, j
+                       in zip(l_offset, bbox_size - r_offset)])
     patch[patch_idx] = out
     return patch
 
 
+def _windows(image, size):
+    """Read-only view of image with all windows of the given size, of shape image.shape - size + 1 + size."""
+    shape = tuple(np.array(image.shape) - size + 1) + tuple(size)
+    return as_strided(image, shape=shape, strides=image.strides * 2, writeable=False)
+
+
+def extract_patches(image, bboxes, out=None, pad_value=0):
+    """Extract many bounding boxes of the same size from an image, coordinates can be negative.
+
+    If all bounding boxes are within the image, the patches are gathered in a single operation
+    from a strided view containing all windows of the image, without copying the image.
+    Otherwise only the bounding boxes crossing the border are copied one by one.
+
+    Parameters
+    ----------
+    image : ndarray
+        nD array
+    bboxes : ndarray
+        Array of shape (N, 2 * ndim) with bounding boxes of the form (coordinates, size),
+        see `extract_patch`. All bounding boxes need to have the same size.
+    out : ndarray, optional
+        Array of shape (N, ) + size to write the patches to.
+    pad_value : number
+        If a bounding box would be out of the image, this is value the patch will be padded with.
+
+    Returns
+    -------
+    ndarray of shape (N, ) + size
+    """
+    bboxes = np.asarray(bboxes, dtype=int).reshape(-1, 2 * image.ndim)
+    coords, sizes = bboxes[:, :image.ndim], bboxes[:, image.ndim:]
+    if len(bboxes) == 0:
+        return out if out is not None else np.empty((0, ) + (0, ) * image.ndim, dtype=image.dtype)
+    size = sizes[0]
+    if np.any(sizes != size):
+        raise ValueError('All bounding boxes need to have the same size.')
+    if out is None:
+        out = np.empty((len(bboxes), ) + tuple(size), dtype=image.dtype)
+    elif out.shape != (len(bboxes), ) + tuple(size):
+        raise ValueError('out has shape {}, expected {}.'.format(out.shape, (len(bboxes), ) + tuple(size)))
+
+    # Part of every bounding box within the image.
+    shape = np.array(image.shape)
+    starts = np.clip(coords, 0, shape)
+    stops = np.clip(coords + size, starts, shape)
+    interior = np.all(starts == coords, axis=1) & np.all(stops == coords + size, axis=1)
+
+    if np.all(size <= shape) and np.any(interior):
+        windows = _windows(image, size)
+        if np.all(interior):
+            out[...] = windows[tuple(coords.T)]
+            return out
+        out[interior] = windows[tuple(coords[interior].T)]
+
+    for idx in np.flatnonzero(~interior):
+        out[idx] = pad_value
+        src = tuple(slice(i, j) for i, j in zip(starts[idx], stops[idx]))
+        dst = tuple(slice(i - c, j - c) for i, j, c in zip(starts[idx], stops[idx], coords[idx]))
+        out[idx][dst] = image[src]
+    return out
+
+
 def rebuild_bbox(bbox, new_size):
     """Given a bounding box and a requested size return the new bounding box around the center of the old.
     If the coordinate would be non-integer, the value is randomly rounded up or down.
@@ -101,44 +171,243 @@ def sym_bbox_from_point(point, bbox_size):
 
 
 def sample_from_mask(mask, avoid, num_tries=100):
-    """A random index is sampled for a mask in the non-zero values.
-    As a first try, num_tries iterations randomly select a point and if found,
-    proceeds. This is more efficient than finding all possible non-zero
-    values which is O(n x m). If this fails within num_tries iterators, we look
-    through all non-positive indices. Otherwise, we look through all
-    possible indexes.
+    """A random index is sampled for a mask in the non-zero values, avoiding a margin of size avoid
+    at the border of the bounding box of the mask. If there are no such values, the margin is ignored.
 
     Parameters
     ----------
-    mask : str or ndarray
-        Path to file containing mask or ndarray.
+    mask : str, ndarray or MaskSampler
+        Path to file containing mask, ndarray, or a sampler to reuse for repeated sampling. A sampler needs
+        to be built with the same avoid, as `MaskSampler(mask, avoid)`.
+    avoid : int or tuple
+        Margin at the border of the bounding box of the mask.
+    num_tries : int
+        Unused, kept for backwards compatibility.
 
     Returns
     -------
     An index sampled within the mask.
     """
-    if isinstance(mask, basestring):
+    if isinstance(mask, MaskSampler):
+        if avoid is not None and np.any(np.asarray(avoid) != 0) and \
+                tuple(np.broadcast_to(avoid, (len(mask.shape), )).tolist()) != mask.avoid:
+            raise ValueError('The sampler has margin {}, but avoid is {}.'.format(mask.avoid, avoid))
+        return mask.sample()
+
+    if isinstance(mask, string_types):
         mask, _ = read_dcm(mask, window_leveling=False, dtype=int)
 
-    bbox = bounding_box(mask)
-    mask = extract_patch(mask, bbox)
-
-    i = 0
-    rand_idx = None
-    while i < num_tries:
-        # We sample up to a part of the edge
-        rand_idx = tuple(
-            [np.random.randint(x, y) for x, y
-             in zip(avoid, mask.shape - avoid)])
-        if mask[rand_idx] != 0:
-            break
-        i += 1
-    # If that didn't work, we unfortunately have to do a full search.
-    # Here we do not try to avoid the edge.
-    if not rand_idx:
-        rand_idx = random_mask_idx(mask)
-
-    bbox_coords, _ = _split_bbox(bbox)
-    rand_idx = cast_numpy(bbox_coords)
-    idx = tuple(rand_idx + bbox_coords)
-    return idx
+    sampler = MaskSampler(mask, avoid)
+    if len(sampler) == 0:
+        # Here we do not try to avoid the edge.
+        sampler = MaskSampler(mask)
+    return sampler.sample()
+
+
+class BalancedPatchSampler(object):
+    def __init__(self, images, masks=None, patch_size=(64, 64), positive_fraction=0.5, batch_size=32,
+                 foreground_masks=None, avoid=None, seed=0, worker_id=0, pad_value=0, read_kwargs=None):
+        """Stream of batches of patches centered at lesions (positives) and elsewhere (negatives).
+
+        The index of every mask is computed once with `MaskSampler` and cached, the centers of a batch
+        are drawn in a few vectorized calls. From a dataset only the regions of the patches are read, see
+        `manet.lmdb.dataset.LmdbDb.read_region`, images given as paths are read once per batch.
+        Every worker has its own random generator seeded with (seed, worker_id), so the stream is
+        reproducible. The sampler can be pickled to worker processes, use `cache_masks` before forking
+        to share the mask indexes.
+
+        Parameters
+        ----------
+        images : LmdbDb or list
+            Dataset with the images, or a list of paths read with `manet.utils.read_image`.
+        masks : dict or list, optional
+            Lesion mask per key of the dataset, or per path, as ndarray, path or `MaskSampler`.
+            If None, the samplers stored in the dataset are used, see `manet.lmdb.dataset.LmdbDb.read_sampler`.
+            This is required if images is a list of paths and positives are sampled.
+            Images without mask only provide negatives.
+        patch_size : tuple
+        positive_fraction : float
+            Fraction of positives in every batch.
+        batch_size : int
+        foreground_masks : dict or list, optional
+            Masks in the same form as masks, negatives are sampled within the foreground, e.g. the breast.
+            By default anywhere in the image.
+        avoid : int or tuple, optional
+            Margin at the border of the lesion masks, see `MaskSampler`. Samplers which are given or
+            stored in the dataset keep the margin they were built with.
+        seed : int
+        worker_id : int
+            Index of the worker, see `for_worker`.
+        pad_value : number
+            Value to pad patches extending beyond the image with.
+        read_kwargs : dict, optional
+            Passed to `manet.utils.read_image` when images is a list of paths, for instance a cache.
+        """
+        if isinstance(images, (list, tuple)):
+            if masks is None and positive_fraction > 0:
+                raise ValueError('masks are required to sample positives from a list of paths.')
+            self.dataset = None
+            self.keys = list(images)
+        else:
+            self.dataset = images
+            self.keys = list(images.keys())
+        self.masks = self._by_key(masks)
+        self.foreground_masks = self._by_key(foreground_masks)
+        self.patch_size = np.asarray(patch_size, dtype=int)
+        self.positive_fraction = positive_fraction
+        self.batch_size = batch_size
+        self.avoid = avoid
+        self.seed = seed
+        self.worker_id = worker_id
+        self.pad_value = pad_value
+        self.read_kwargs = read_kwargs or {}
+        self._samplers = {}
+        self._foreground_samplers = {}
+        self._shapes = {}
+        # Keys which can have lesions, the keys of which the sampler turns out to be empty are removed
+        # when they are drawn, so the masks are only loaded when needed.
+        if self.masks is None:
+            self._positive_keys = list(self.keys)
+        else:
+            self._positive_keys = [key for key in self.keys if self.masks.get(key, None) is not None]
+
+    def _by_key(self, masks):
+        if masks is None or isinstance(masks, dict):
+            return masks
+        return dict(zip(self.keys, masks))
+
+    def for_worker(self, worker_id):
+        """Copy of the sampler with the random generator of worker worker_id, the mask cache is shared."""
+        new = copy.copy(self)
+        new.worker_id = worker_id
+        new._positive_keys = list(self._positive_keys)
+        return new
+
+    def _make_sampler(self, mask, avoid=None):
+        if mask is None or isinstance(mask, MaskSampler):
+            return mask
+        if isinstance(mask, string_types):
+            mask, _ = read_image(mask, window_leveling=False)
+        return MaskSampler(mask, avoid)
+
+    def sampler(self, key):
+        """Cached lesion sampler of key, or None if the image has no lesions."""
+        if key not in self._samplers:
+            if self.masks is None:
+                sampler = self.dataset.read_sampler(key) if self.dataset is not None else None
+            else:
+                sampler = self._make_sampler(self.masks.get(key, None), self.avoid)
+            self._samplers[key] = sampler if sampler is not None and len(sampler) > 0 else None
+        return self._samplers[key]
+
+    def foreground_sampler(self, key):
+        """Cached foreground sampler of key, or None if negatives are sampled in the whole image."""
+        if self.foreground_masks is None:
+            return None
+        if key not in self._foreground_samplers:
+            self._foreground_samplers[key] = self._make_sampler(self.foreground_masks.get(key, None))
+        return self._foreground_samplers[key]
+
+    def cache_masks(self):
+        """Compute all mask indexes, for instance in the parent process before starting the workers."""
+        for key in self.keys:
+            self.sampler(key)
+            self.foreground_sampler(key)
+        self._positive_keys = [key for key in self._positive_keys if self.sampler(key) is not None]
+        return self
+
+    def _read(self, key):
+        if self.dataset is not None:
+            return self.dataset[key]['data']
+        return read_image(key, **self.read_kwargs)[0]
+
+    def _patches(self, key, bboxes):
+        """Patches of an image, from a dataset only the regions are read, see `LmdbDb.read_region`."""
+        if self.dataset is not None:
+            return np.stack([self.dataset.read_region(key, bbox, self.pad_value) for bbox in bboxes])
+        return extract_patches(self._read(key), bboxes, pad_value=self.pad_value)
+
+    def _draw_positive_keys(self, num, rng):
+        """Draw num keys of images with lesions."""
+        keys = []
+        while len(keys) < num:
+            if not self._positive_keys:
+                raise ValueError('None of the images has a lesion to sample positives from.')
+            key = self._positive_keys[rng.randint(0, len(self._positive_keys))]
+            if self.sampler(key) is None:
+                self._positive_keys.remove(key)
+                continue
+            keys.append(key)
+        return keys
+
+    def _shape(self, key):
+        if key not in self._shapes:
+            sampler = self.sampler(key) or self.foreground_sampler(key)
+            if sampler is not None:
+                self._shapes[key] = sampler.shape
+            elif self.dataset is not None:
+                self._shapes[key] = tuple(self.dataset.read_metadata(key)['shape'])
+            else:
+                self._shapes[key] = self._read(key).shape
+        return self._shapes[key]
+
+    def _negatives(self, key, num, rng):
+        """Centers outside the lesions, by vectorized rejection sampling."""
+        sampler = self.sampler(key)
+        foreground = self.foreground_sampler(key)
+        shape = self._shape(key)
+        centers = []
+        num_found = 0
+        for _ in range(100):
+            if num_found >= num:
+                break
+            size = 2 * (num - num_found)
+            if foreground is not None:
+                candidates = foreground.sample(size, rng)
+            else:
+                candidates = np.stack([rng.randint(0, s, size=size) for s in shape], axis=-1)
+            if sampler is not None:
+                # The lesion indices are sorted, so membership is a binary search. These are all lesion
+                # pixels, the margin excluded from the positives by avoid is not sampled either.
+                lesion = sampler.mask_indices
+                flat = np.ravel_multi_index(tuple(candidates.T), shape)
+                pos = np.searchsorted(lesion, flat).clip(max=len(lesion) - 1)
+                candidates = candidates[lesion[pos] != flat]
+            centers.append(candidates[:num - num_found])
+            num_found += len(centers[-1])
+        if num_found < num:
+            raise ValueError('Could not sample {} negatives in {}.'.format(num, key))
+        return np.concatenate(centers)
+
+    def _batch(self, rng):
+        num_positive = int(round(self.positive_fraction * self.batch_size))
+        # Key and label of every patch in the batch.
+        keys = self._draw_positive_keys(num_positive, rng) + \
+            [self.keys[idx] for idx in rng.randint(0, len(self.keys), size=self.batch_size - num_positive)]
+        labels = np.zeros(self.batch_size, dtype=np.int64)
+        labels[:num_positive] = 1
+
+        bboxes = np.empty((self.batch_size, 2 * len(self.patch_size)), dtype=int)
+        data = None
+        for key in sorted(set(keys)):
+            idxs = np.array([idx for idx, _ in enumerate(keys) if _ == key])
+            positive = labels[idxs] == 1
+            centers = np.empty((len(idxs), len(self.patch_size)), dtype=int)
+            if positive.any():
+                centers[positive] = self.sampler(key).sample(int(positive.sum()), rng)
+            if (~positive).any():
+                centers[~positive] = self._negatives(key, int((~positive).sum()), rng)
+            bboxes[idxs] = np.hstack([centers - self.patch_size // 2, np.tile(self.patch_size, (len(idxs), 1))])
+
+            patches = self._patches(key, bboxes[idxs])
+            if data is None:
+                data = np.empty((self.batch_size, ) + tuple(self.patch_size), dtype=patches.dtype)
+            data[idxs] = patches
+        return {'data': data, 'labels': labels, 'keys': keys, 'bboxes': bboxes}
+
+    def __iter__(self):
+        """Infinite generator of batches, dictionaries with the stacked patches 'data', 'labels' which are 1
+        for positives, and the 'keys' and 'bboxes' the patches are taken from."""
+        rng = np.random.RandomState([self.seed, self.worker_id])
+        while True:
+            yield self._batch(rng)
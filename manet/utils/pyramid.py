@@ -0,0 +1,105 @@
+# encoding: utf-8
+"""Integer factor downsampling by block means, and multi-resolution pyramids."""
+import numpy as np
+
+DEFAULT_FACTORS = (2, 4, 8)
+
+
+def _factors(ndim, factor):
+    """Per axis factors, an integer factor applies to the last two axes."""
+    if isinstance(factor, (int, np.integer)):
+        return (1, ) * (ndim - 2) + (int(factor), ) * min(ndim, 2)
+    factor = tuple(int(_) for _ in factor)
+    if len(factor) != ndim:
+        raise ValueError('Need one factor per axis, got {} for an image of dimension {}.'.format(factor, ndim))
+    return factor
+
+
+def _block_sum(image, factors):
+    """Sum over blocks of shape factors, in float32. Incomplete blocks at the end of an axis are dropped."""
+    out_shape = tuple(s // f for s, f in zip(image.shape, factors))
+    out = np.zeros(out_shape, dtype=np.float32)
+    # Accumulate the strided views of every offset within the block, so the only temporary is the output.
+    for offset in np.ndindex(*factors):
+        idx = tuple(slice(o, o + f * s, f) for o, f, s in zip(offset, factors, out_shape))
+        np.add(out, image[idx], out=out, casting='unsafe')
+    return out
+
+
+def _cast(image, dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'biu':
+        np.rint(image, out=image)
+    return image.astype(dtype, copy=False)
+
+
+def downsample(image, factor, dtype=None):
+    """Downsample an image by an integer factor, every output pixel is the mean of a block of pixels.
+
+    Parameters
+    ----------
+    image : ndarray
+    factor : int or tuple
+        Downsampling factor. An integer is applied to the last two (spatial) axes, so a volume of shape
+        (depth, height, width) is downsampled per slice. A tuple gives the factor per axis.
+    dtype : dtype, optional
+        Output dtype, by default the dtype of image. Integer outputs are rounded.
+
+    Returns
+    -------
+    ndarray of shape image.shape // factor. Rows and columns which do not fill a complete block are dropped.
+    """
+    image = np.asarray(image)
+    factors = _factors(image.ndim, factor)
+    if all(f == 1 for f in factors):
+        return image.astype(dtype or image.dtype, copy=False)
+
+    out = _block_sum(image, factors)
+    out *= 1. / np.prod(factors)
+    return _cast(out, dtype or image.dtype)
+
+
+def build_pyramid(image, factors=DEFAULT_FACTORS, dtype=None):
+    """Build a multi-resolution pyramid of an image.
+
+    Every level is computed from the previous level when its factor is a multiple of the previous one,
+    so the full resolution image is only traversed once. The block means are exact, as the intermediate
+    levels are kept in float32.
+
+    Parameters
+    ----------
+    image : ndarray
+    factors : tuple
+        Downsampling factors of the levels, see `downsample`.
+    dtype : dtype, optional
+        Output dtype, by default the dtype of image.
+
+    Returns
+    -------
+    Dictionary mapping factor to the downsampled image.
+    """
+    image = np.asarray(image)
+    dtype = dtype or image.dtype
+    pyramid = {}
+    prev_factor, prev_level = 1, image
+    for factor in sorted(factors):
+        if factor % prev_factor == 0:
+            level = _block_sum(prev_level, _factors(image.ndim, factor // prev_factor))
+            level *= 1. / np.prod(_factors(image.ndim, factor // prev_factor))
+        else:
+            level = downsample(image, factor, np.float32)
+        pyramid[factor] = _cast(level.copy(), dtype)
+        prev_factor, prev_level = factor, level
+    return pyramid
+
+
+def scale_metadata(metadata, factor, shape):
+    """Update the metadata of an image downsampled by factor to the new shape."""
+    metadata = dict(metadata)
+    metadata['shape'] = tuple(shape)
+    if metadata.get('spacing'):
+        # The spacing of a 2D image can be stored for a volume with depth one.
+        factors = _factors(len(shape), factor)[-len(metadata['spacing']):]
+        metadata['spacing'] = tuple(s * f for s, f in zip(metadata['spacing'], factors))
+    metadata['scale'] = factor
+    return metadata
@@ -0,0 +1,180 @@
+# encoding: utf-8
+"""Index of the dicom series in a directory tree, so series can be found without scanning the headers again."""
+import os
+import json
+import logging
+import tempfile
+import multiprocessing
+import SimpleITK as sitk
+from manet.utils.file_readers import read_json
+from manet.utils.image_readers import read_dcm_series, _DICOM_MODALITY_TAG
+
+logger = logging.getLogger(__name__)
+
+_DICOM_STUDY_UID_TAG = '0020|000d'
+INDEX_VERSION = 1
+
+
+def _scan_directory(folder):
+    """List of series in folder as dictionaries with the study and series uid, modality and sorted filenames."""
+    reader = sitk.ImageSeriesReader()
+    series = []
+    for series_uid in reader.GetGDCMSeriesIDs(str(folder)):
+        # The filenames are sorted by GDCM along the volume axis.
+        filenames = reader.GetGDCMSeriesFileNames(str(folder), series_uid)
+        header = sitk.ImageFileReader()
+        header.SetFileName(str(filenames[0]))
+        header.ReadImageInformation()
+        tags = [header.GetMetaData(tag).strip() if header.HasMetaDataKey(tag) else None
+                for tag in [_DICOM_STUDY_UID_TAG, _DICOM_MODALITY_TAG]]
+        series.append({
+            'series_uid': series_uid,
+            'study_uid': tags[0],
+            'modality': tags[1],
+            'filenames': [os.path.relpath(_, folder) for _ in filenames],
+        })
+    return folder, series
+
+
+class SeriesIndex(object):
+    def __init__(self, root, directories=None):
+        """Index of the dicom series in a directory tree, see `build_series_index`.
+
+        Parameters
+        ----------
+        root : str
+            Root of the directory tree.
+        directories : dict, optional
+            Mapping of directory, relative to root, to a dictionary with the modification time 'mtime'
+            and the list of 'series' in the directory as returned by the scan.
+        """
+        self.root = os.path.abspath(root)
+        self.directories = directories or {}
+        self._series = None
+
+    @property
+    def series(self):
+        """Mapping of series uid to the entry of the series, with the absolute folder and filenames."""
+        if self._series is None:
+            self._series = {}
+            for directory, entry in sorted(self.directories.items()):
+                folder = os.path.join(self.root, directory)
+                for series in entry['series']:
+                    uid = series['series_uid']
+                    if uid in self._series:
+                        logger.warning('Series %s is in both %s and %s, using the first.',
+                                       uid, self._series[uid]['folder'], folder)
+                        continue
+                    self._series[uid] = dict(series, folder=folder,
+                                             filenames=[os.path.join(folder, _) for _ in series['filenames']])
+        return self._series
+
+    def __getitem__(self, series_uid):
+        return self.series[series_uid]
+
+    def __contains__(self, series_uid):
+        return series_uid in self.series
+
+    def __len__(self):
+        return len(self.series)
+
+    def keys(self):
+        return sorted(self.series)
+
+    def filter(self, modality=None, study_uid=None):
+        """Series uids with the given modality and study uid."""
+        return [uid for uid in self.keys()
+                if (modality is None or self.series[uid]['modality'] == modality) and
+                (study_uid is None or self.series[uid]['study_uid'] == study_uid)]
+
+    def read(self, series_uid, **kwargs):
+        """Read a series from the index, see `manet.utils.read_dcm_series`."""
+        return read_dcm_series(None, series_uid, index=self, **kwargs)
+
+    def save(self, filename):
+        """Write the index to a json file, the file is replaced atomically."""
+        folder = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'root': self.root, 'directories': self.directories},
+                      f, sort_keys=True, separators=(',', ':'))
+        os.rename(tmp_path, filename)
+
+    @classmethod
+    def load(cls, filename):
+        index = read_json(filename)
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError('{} has index version {}, expected {}.'.format(
+                filename, index.get('version'), INDEX_VERSION))
+        return cls(index['root'], index['directories'])
+
+    def __repr__(self):
+        return '{} ({}, {} series)'.format(self.__class__.__name__, self.root, len(self))
+
+
+def build_series_index(root, index_path=None, workers=None, processes=True):
+    """Build or update the index of all dicom series below root.
+
+    The tree is walked once. Directories of which the modification time did not change since the index
+    was written are not scanned again, the others are scanned in parallel. Adding or removing files
+    changes the modification time of a directory, modifying a file in place does not.
+
+    Parameters
+    ----------
+    root : str
+        Root of the directory tree.
+    index_path : str, optional
+        If given, the index is loaded from this file to be updated, and written to it afterwards.
+    workers : int, optional
+        Number of processes or threads scanning directories, by default the number of cpus.
+        If 0, the directories are scanned in the current process.
+    processes : bool
+        If True, scan with a pool of processes, otherwise with threads.
+
+    Returns
+    -------
+    SeriesIndex
+    """
+    root = os.path.abspath(root)
+    old = {}
+    if index_path and os.path.isfile(index_path):
+        index = SeriesIndex.load(index_path)
+        if index.root == root:
+            old = index.directories
+        else:
+            logger.warning('Index %s has root %s, rebuilding for %s.', index_path, index.root, root)
+
+    directories = {}
+    todo = {}
+    for folder, _, filenames in os.walk(root):
+        if not filenames:
+            continue
+        directory = os.path.relpath(folder, root)
+        mtime = os.stat(folder).st_mtime
+        if directory in old and old[directory]['mtime'] == mtime:
+            directories[directory] = old[directory]
+        else:
+            todo[folder] = mtime
+    logger.info('Scanning %d directories, %d unchanged.', len(todo), len(directories))
+
+    workers = multiprocessing.cpu_count() if workers is None else workers
+    if workers == 0:
+        results = map(_scan_directory, sorted(todo))
+        executor = None
+    else:
+        # Imported here, as on Python 2 this requires the futures backport.
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(workers)
+        results = executor.map(_scan_directory, sorted(todo))
+    try:
+        for folder, series in results:
+            # Directories without dicom files are stored as well, so they are not scanned again.
+            directories[os.path.relpath(folder, root)] = {'mtime': todo[folder], 'series': series}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    index = SeriesIndex(root, directories)
+    if index_path:
+        index.save(index_path)
+    return index
@@ -0,0 +1,232 @@
+# encoding: utf-8
+"""Sliding-window tiling of images and stitching of the predictions on the tiles."""
+import itertools
+import numpy as np
+from manet.utils.patch_utils import extract_patches
+
+
+def tile_bboxes(shape, tile_size, stride=None):
+    """Bounding boxes of tiles covering an image. The last tile along an axis is aligned with the end
+    of the image, so the tiles overlap more there if the stride does not fit.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image.
+    tile_size : tuple
+    stride : tuple, optional
+        By default the tile size, so the tiles do not overlap.
+
+    Returns
+    -------
+    ndarray of shape (N, 2 * ndim) with bounding boxes of the form (coordinates, size).
+    """
+    tile_size = tuple(int(_) for _ in tile_size)
+    stride = tile_size if stride is None else tuple(int(_) for _ in stride)
+    starts = []
+    for s, t, d in zip(shape, tile_size, stride):
+        axis_starts = list(range(0, max(s - t, 0) + 1, d))
+        if axis_starts[-1] + t < s:
+            axis_starts.append(s - t)
+        starts.append(axis_starts)
+    coords = np.array(list(itertools.product(*starts)), dtype=int).reshape(-1, len(shape))
+    return np.hstack([coords, np.tile(tile_size, (len(coords), 1))])
+
+
+def _region_sums(mask, bboxes):
+    """Number of non-zero mask values in every bounding box, with a summed-area table."""
+    ndim = mask.ndim
+    # The counts are at most the number of pixels, so int32 suffices for all but huge images.
+    dtype = np.int32 if mask.size < 2**31 else np.int64
+    table = np.zeros(tuple(s + 1 for s in mask.shape), dtype=dtype)
+    table[(slice(1, None), ) * ndim] = mask != 0
+    for axis in range(ndim):
+        np.cumsum(table, axis=axis, dtype=dtype, out=table)
+
+    coords, sizes = bboxes[:, :ndim], bboxes[:, ndim:]
+    starts = np.clip(coords, 0, mask.shape)
+    stops = np.clip(coords + sizes, 0, mask.shape)
+    sums = np.zeros(len(bboxes), dtype=np.int64)
+    # Inclusion-exclusion over the corners of the boxes.
+    for corner in itertools.product([0, 1], repeat=ndim):
+        idx = tuple(np.where(c, stops[:, axis], starts[:, axis]) for axis, c in enumerate(corner))
+        sign = (-1)**(ndim - sum(corner))
+        sums += sign * table[idx]
+    return sums
+
+
+def foreground_bboxes(mask, bboxes, min_fraction=0.):
+    """Select the bounding boxes containing foreground.
+
+    Parameters
+    ----------
+    mask : ndarray
+        Foreground mask of the image, e.g. `image > 0` for a mammogram.
+    bboxes : ndarray
+        Array of shape (N, 2 * ndim).
+    min_fraction : float
+        Minimal fraction of foreground in a bounding box. If 0, any foreground suffices.
+
+    Returns
+    -------
+    ndarray with the selected bounding boxes.
+    """
+    sums = _region_sums(mask, bboxes)
+    if min_fraction <= 0:
+        return bboxes[sums > 0]
+    return bboxes[sums >= min_fraction * np.prod(bboxes[:, mask.ndim:], axis=1)]
+
+
+def blending_weights(tile_size, mode='gaussian', sigma_scale=1. / 8):
+    """Weights to blend overlapping tiles, which decrease towards the border of the tile.
+
+    Parameters
+    ----------
+    tile_size : tuple
+    mode : str
+        'gaussian', 'linear' or 'constant'.
+    sigma_scale : float
+        Standard deviation of the gaussian relative to the tile size.
+
+    Returns
+    -------
+    float32 ndarray of shape tile_size, with maximum 1.
+    """
+    profiles = []
+    for t in tile_size:
+        x = np.arange(t, dtype=np.float64) - (t - 1) / 2.
+        if mode == 'gaussian':
+            profile = np.exp(-x**2 / (2 * (sigma_scale * t)**2))
+        elif mode == 'linear':
+            profile = 1 - np.abs(x) / (t / 2. + 1)
+        elif mode == 'constant':
+            profile = np.ones(t)
+        else:
+            raise ValueError('Blending mode {} not supported.'.format(mode))
+        profiles.append(profile / profile.max())
+
+    weights = profiles[0]
+    for profile in profiles[1:]:
+        weights = np.multiply.outer(weights, profile)
+    # Every pixel of a tile contributes, also at the border.
+    return np.maximum(weights, 1e-3).astype(np.float32)
+
+
+class Tiler(object):
+    def __init__(self, image, tile_size, stride=None, mask=None, min_foreground=0., batch_size=32, pad_value=0):
+        """Iterate over the tiles of an image in batches of (bboxes, patches).
+
+        Only the bounding boxes are computed up front, the patches are extracted per batch, so the memory
+        use is bounded by the batch size.
+
+        Parameters
+        ----------
+        image : ndarray
+        tile_size : tuple
+        stride : tuple, optional
+            By default the tile size, so the tiles do not overlap.
+        mask : ndarray, optional
+            Foreground mask, tiles without foreground are skipped, see `foreground_bboxes`.
+        min_foreground : float
+            Minimal fraction of foreground in a tile.
+        batch_size : int
+        pad_value : number
+            Value to pad tiles with if the image is smaller than the tile.
+        """
+        self.image = image
+        self.tile_size = tuple(int(_) for _ in tile_size)
+        self.batch_size = batch_size
+        self.pad_value = pad_value
+        self.bboxes = tile_bboxes(image.shape, self.tile_size, stride)
+        self.num_tiles = len(self.bboxes)
+        if mask is not None:
+            self.bboxes = foreground_bboxes(mask, self.bboxes, min_foreground)
+
+    def __len__(self):
+        """Number of batches."""
+        return -(-len(self.bboxes) // self.batch_size)
+
+    def __iter__(self):
+        for start in range(0, len(self.bboxes), self.batch_size):
+            bboxes = self.bboxes[start:start + self.batch_size]
+            yield bboxes, extract_patches(self.image, bboxes, pad_value=self.pad_value)
+
+
+class Stitcher(object):
+    def __init__(self, shape, tile_size, mode='gaussian', num_channels=None):
+        """Accumulate predictions on tiles into a prediction for the whole image, overlapping tiles are
+        blended with `blending_weights`.
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the image.
+        tile_size : tuple
+        mode : str
+            Blending mode, see `blending_weights`.
+        num_channels : int, optional
+            If given, the predictions have shape (num_channels, ) + tile_size.
+        """
+        self.shape = tuple(shape)
+        self.weights = blending_weights(tile_size, mode)
+        channels = (num_channels, ) if num_channels else ()
+        self._accumulator = np.zeros(channels + self.shape, dtype=np.float32)
+        self._weight_sum = np.zeros(self.shape, dtype=np.float32)
+
+    def add(self, bboxes, predictions):
+        """Add a batch of predictions on the tiles given by bboxes, as yielded by `Tiler`."""
+        bboxes = np.asarray(bboxes, dtype=int)
+        ndim = len(self.shape)
+        coords, sizes = bboxes[:, :ndim], bboxes[:, ndim:]
+        starts = np.clip(coords, 0, self.shape)
+        stops = np.clip(coords + sizes, starts, self.shape)
+        for bbox_start, bbox_stop, coord, prediction in zip(starts, stops, coords, predictions):
+            region = tuple(slice(i, j) for i, j in zip(bbox_start, bbox_stop))
+            tile_region = tuple(slice(i - c, j - c) for i, j, c in zip(bbox_start, bbox_stop, coord))
+            weights = self.weights[tile_region]
+            accumulator = self._accumulator[(Ellipsis, ) + region]
+            accumulator += prediction[(Ellipsis, ) + tile_region] * weights
+            self._weight_sum[region] += weights
+
+    def result(self, fill_value=0):
+        """The blended prediction, pixels without a tile get fill_value. This normalizes the accumulator
+        in place, so no more predictions can be added."""
+        covered = self._weight_sum > 0
+        np.divide(self._accumulator, self._weight_sum, out=self._accumulator, where=covered)
+        self._accumulator[..., ~covered] = fill_value
+        return self._accumulator
+
+
+def predict_tiled(image, predict_fn, tile_size, stride=None, mask=None, min_foreground=0., batch_size=32,
+                  mode='gaussian', num_channels=None, fill_value=0, pad_value=0):
+    """Apply a patch based model to a whole image with a sliding window.
+
+    Parameters
+    ----------
+    image : ndarray
+    predict_fn : function
+        Maps a batch of patches of shape (batch, ) + tile_size to predictions of the same shape,
+        or (batch, num_channels) + tile_size.
+    tile_size : tuple
+    stride : tuple, optional
+        See `Tiler`, for instance half the tile size to blend overlapping tiles.
+    mask : ndarray, optional
+        Foreground mask, see `Tiler`.
+    min_foreground : float
+    batch_size : int
+    mode : str
+        Blending mode, see `blending_weights`.
+    num_channels : int, optional
+    fill_value : number
+        Value of the prediction where no tile was predicted, for instance the background.
+    pad_value : number
+
+    Returns
+    -------
+    float32 ndarray with the prediction of shape image.shape or (num_channels, ) + image.shape.
+    """
+    tiler = Tiler(image, tile_size, stride, mask, min_foreground, batch_size, pad_value)
+    stitcher = Stitcher(image.shape, tile_size, mode, num_channels)
+    for bboxes, patches in tiler:
+        stitcher.add(bboxes, predict_fn(patches))
+    return stitcher.result(fill_value)
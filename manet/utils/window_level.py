@@ -0,0 +1,245 @@
+# encoding: utf-8
+"""Window and level (VOI LUT) functions on numpy arrays.
+
+The functions follow the DICOM standard, PS3.3 C.11.2.1.2:
+
+    LINEAR: y = ((x - (c - 0.5)) / (w - 1) + 0.5) * (y_max - y_min) + y_min, clipped to [y_min, y_max].
+    LINEAR_EXACT: y = ((x - c) / w + 0.5) * (y_max - y_min) + y_min, clipped to [y_min, y_max].
+    SIGMOID: y = (y_max - y_min) / (1 + exp(-4 * (x - c) / w)) + y_min.
+
+Integer outputs are rounded to the nearest integer. Additionally LINEAR_SITK reproduces the SimpleITK
+`IntensityWindowing` filter on the window [c - (w - 1) / 2, c + (w - 1) / 2], as `read_dcm` applied before:
+
+    LINEAR_SITK: y = (x - x_min) / (x_max - x_min) * (y_max - y_min) + y_min, clipped to [y_min, y_max],
+
+where the window bounds x_min and x_max are truncated for integer inputs and integer outputs are truncated.
+"""
+import numpy as np
+
+VOI_LUT_FUNCTIONS = ['LINEAR', 'LINEAR_EXACT', 'SIGMOID', 'LINEAR_SITK']
+
+
+def window_dtype(out_range):
+    """Smallest integer dtype which can hold the output range, if the range spans at least 256 integers.
+    Smaller ranges, such as (0, 1), are float32 so the output is not quantized to a few values."""
+    low, high = out_range
+    if float(low).is_integer() and float(high).is_integer() and high - low >= 255:
+        for dtype in [np.uint8, np.int8, np.uint16, np.int16]:
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+
+def _use_lut(arr):
+    """A lookup table is used for integers of at most 16 bits, when the array is larger than the table."""
+    return arr.dtype.kind in 'ui' and arr.dtype.itemsize <= 2 and arr.size > 2**(8 * arr.dtype.itemsize)
+
+
+def window_level_bytes(arr, num_windows=1, dtype=np.uint8, use_lut=None, voi_lut_fn='LINEAR'):
+    """Number of bytes of the temporaries `window_level` and `window_levels` allocate, excluding the output.
+
+    Parameters
+    ----------
+    arr : ndarray
+        Input array.
+    num_windows : int
+    dtype : dtype
+        Output dtype.
+    use_lut : bool, optional
+        See `window_level`.
+    voi_lut_fn : str
+        One of `VOI_LUT_FUNCTIONS`.
+
+    Returns
+    -------
+    int
+    """
+    dtype = np.dtype(dtype)
+    buf_itemsize = _buffer_dtype(arr, voi_lut_fn).itemsize
+    if use_lut is None:
+        use_lut = _use_lut(arr)
+    if use_lut:
+        lut_size = 2**(8 * arr.dtype.itemsize)
+        # The tables and the float buffer used to compute one table.
+        return num_windows * lut_size * dtype.itemsize + lut_size * (arr.dtype.itemsize + buf_itemsize)
+    if dtype == _buffer_dtype(arr, voi_lut_fn):
+        return 0
+    return arr.size * buf_itemsize
+
+
+def _buffer_dtype(arr, voi_lut_fn):
+    """LINEAR_SITK on integers is computed in float64 as SimpleITK does, the rest in float32."""
+    return np.dtype(np.float64 if voi_lut_fn == 'LINEAR_SITK' and arr.dtype.kind in 'biu' else np.float32)
+
+
+def _window_level_float(arr, center, width, voi_lut_fn, out_range, buf):
+    """Compute the window level in the float buffer buf."""
+    # Python floats, as integer parameters would make numpy subtract in the (wrapping) integer dtype of arr.
+    center, width = float(center), float(width)
+    low, high = float(out_range[0]), float(out_range[1])
+    if voi_lut_fn == 'SIGMOID':
+        np.subtract(arr, center, out=buf, casting='unsafe')
+        buf *= -4. / width
+        # Far below the window exp overflows to inf, which correctly gives y_min.
+        with np.errstate(over='ignore'):
+            np.exp(buf, out=buf)
+        buf += 1
+        np.divide(high - low, buf, out=buf)
+        buf += low
+        return buf
+
+    if voi_lut_fn == 'LINEAR':
+        center, width = center - 0.5, width - 1
+    elif voi_lut_fn == 'LINEAR_SITK':
+        x_min, x_max = center - (width - 1) / 2., center + (width - 1) / 2.
+        if arr.dtype.kind in 'biu':
+            # SimpleITK casts the window to the pixel type.
+            x_min, x_max = float(np.trunc(x_min)), float(np.trunc(x_max))
+        if x_max > x_min:
+            # Same order of operations as the filter, so the truncated output is identical.
+            scale = (high - low) / (x_max - x_min)
+            np.multiply(arr, scale, out=buf, casting='unsafe')
+            buf += low - x_min * scale
+            np.clip(buf, low, high, out=buf)
+            return buf
+        center, width = x_min, 0
+    if width <= 0:
+        # Degenerate window, this is a threshold.
+        np.greater(arr, center, out=buf, casting='unsafe')
+        buf *= high - low
+        buf += low
+        return buf
+
+    # Affine map followed by clipping, both in place.
+    scale = (high - low) / width
+    np.subtract(arr, center, out=buf, casting='unsafe')
+    buf *= scale
+    buf += 0.5 * (high - low) + low
+    np.clip(buf, low, high, out=buf)
+    return buf
+
+
+def window_level_lut(dtype, center, width, voi_lut_fn='LINEAR', out_range=(0, 255), out_dtype=None):
+    """Lookup table for an integer input dtype of at most 16 bits.
+
+    The table is indexed by the unsigned view of the input, so `lut[arr.view(uint)]` applies the window.
+
+    Parameters
+    ----------
+    dtype : dtype
+        Integer input dtype.
+    center : float
+    width : float
+    voi_lut_fn : str
+        One of `VOI_LUT_FUNCTIONS`.
+    out_range : tuple
+    out_dtype : dtype, optional
+        By default the smallest dtype containing out_range.
+
+    Returns
+    -------
+    ndarray
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'ui' or dtype.itemsize > 2:
+        raise ValueError('Lookup tables are only supported for integers up to 16 bits, got {}.'.format(dtype))
+    unsigned = np.dtype('u{}'.format(dtype.itemsize))
+    values = np.arange(2**(8 * dtype.itemsize), dtype=unsigned).view(dtype)
+    return window_level(values, center, width, voi_lut_fn, out_range, out_dtype, use_lut=False)
+
+
+def window_level(arr, center, width, voi_lut_fn='LINEAR', out_range=(0, 255), dtype=None, out=None, use_lut=None):
+    """Apply window and level to an array.
+
+    Parameters
+    ----------
+    arr : ndarray
+    center : float
+        Window center.
+    width : float
+        Window width.
+    voi_lut_fn : str
+        One of `VOI_LUT_FUNCTIONS`.
+    out_range : tuple
+        Range (y_min, y_max) of the output.
+    dtype : dtype, optional
+        Output dtype, by default the smallest dtype containing out_range. Integer outputs are rounded.
+    out : ndarray, optional
+        Array to write the output to, this determines the dtype.
+    use_lut : bool, optional
+        Use a lookup table, by default if the input is an integer of at most 16 bits and the array
+        is larger than the table. The table maps the whole image in a single gather.
+
+    Returns
+    -------
+    ndarray
+    """
+    if voi_lut_fn not in VOI_LUT_FUNCTIONS:
+        raise ValueError('VOI LUT function {} not supported, choose from {}.'.format(voi_lut_fn, VOI_LUT_FUNCTIONS))
+    arr = np.asarray(arr)
+    if out is not None:
+        dtype = out.dtype
+    dtype = np.dtype(dtype) if dtype is not None else window_dtype(out_range)
+
+    if use_lut is None:
+        use_lut = _use_lut(arr)
+    if use_lut:
+        lut = window_level_lut(arr.dtype, center, width, voi_lut_fn, out_range, dtype)
+        unsigned = np.dtype('u{}'.format(arr.dtype.itemsize))
+        return np.take(lut, arr.view(unsigned), out=out)
+
+    buf_dtype = _buffer_dtype(arr, voi_lut_fn)
+    if dtype == buf_dtype:
+        buf = out if out is not None else np.empty(arr.shape, dtype=buf_dtype)
+        return _window_level_float(arr, center, width, voi_lut_fn, out_range, buf)
+
+    buf = _window_level_float(arr, center, width, voi_lut_fn, out_range, np.empty(arr.shape, dtype=buf_dtype))
+    if dtype.kind in 'ui':
+        (np.trunc if voi_lut_fn == 'LINEAR_SITK' else np.rint)(buf, out=buf)
+    if out is None:
+        return buf.astype(dtype)
+    np.copyto(out, buf, casting='unsafe')
+    return out
+
+
+def window_levels(arr, windows, voi_lut_fn='LINEAR', out_range=(0, 255), dtype=None, out=None, use_lut=None):
+    """Apply several windows to an array and stack the results.
+
+    Parameters
+    ----------
+    arr : ndarray
+    windows : list
+        List of (center, width) tuples.
+    voi_lut_fn : str
+        One of `VOI_LUT_FUNCTIONS`.
+    out_range : tuple
+    dtype : dtype, optional
+        Output dtype, by default the smallest dtype containing out_range.
+    out : ndarray, optional
+        Array of shape (len(windows), ) + arr.shape to write the output to.
+    use_lut : bool, optional
+        See `window_level`. With lookup tables all windows are applied in a single gather.
+
+    Returns
+    -------
+    ndarray of shape (len(windows), ) + arr.shape
+    """
+    arr = np.asarray(arr)
+    if out is not None:
+        dtype = out.dtype
+    dtype = np.dtype(dtype) if dtype is not None else window_dtype(out_range)
+
+    if use_lut is None:
+        use_lut = _use_lut(arr)
+    if use_lut:
+        luts = np.stack([window_level_lut(arr.dtype, center, width, voi_lut_fn, out_range, dtype)
+                         for center, width in windows])
+        unsigned = np.dtype('u{}'.format(arr.dtype.itemsize))
+        return np.take(luts, arr.view(unsigned), axis=1, out=out)
+
+    if out is None:
+        out = np.empty((len(windows), ) + arr.shape, dtype=dtype)
+    for idx, (center, width) in enumerate(windows):
+        window_level(arr, center, width, voi_lut_fn, out_range, out=out[idx], use_lut=False)
+    return out
@@ -0,0 +1,334 @@
+import gc
+import os
+import pickle
+import multiprocessing
+
+import lmdb
+import numpy as np
+import pytest
+import simplejson as json
+
+from manet.lmdb.builder import LmdbBuilder
+from manet.lmdb import compression
+from manet.lmdb.compression import CODECS
+from manet.lmdb.dataset import LmdbDb, _ENVIRONMENTS
+from manet.lmdb.memmap import MemmapDb, lmdb_to_memmap
+from manet.lmdb.record import HEADER_SIZE, pack_record, unpack_header, unpack_record
+from manet.lmdb.sharded import HashRing, ShardedLmdbDb, build_sharded_db
+from manet.utils.pyramid import downsample
+
+
+def _build(path, num_images=20):
+    images = {}
+    with LmdbBuilder(str(path), 'test') as builder:
+        for idx in range(num_images):
+            key = 'image_{:03d}'.format(idx)
+            images[key] = np.full((8, 8), idx, dtype=np.uint16)
+            builder.write(key, images[key])
+    return images
+
+
+def _sum(args):
+    dataset, key = args
+    return int(dataset[key]['data'].sum())
+
+
+def test_pickle(tmpdir):
+    images = _build(tmpdir)
+    dataset = LmdbDb(str(tmpdir), 'test', persistent_txn=True)
+    dataset['image_003']
+    loaded = pickle.loads(pickle.dumps(dataset))
+    assert loaded._lease is None
+    assert loaded.keys() == dataset.keys()
+    assert np.array_equal(loaded['image_003']['data'], images['image_003'])
+
+
+def test_copy_shares_keys(tmpdir):
+    _build(tmpdir)
+    dataset = LmdbDb(str(tmpdir), 'test')
+    dataset_copy = dataset.copy()
+    assert dataset_copy._keys is dataset._keys
+    del dataset_copy['image_000']
+    assert not dataset_copy.has_key('image_000')
+    assert dataset.has_key('image_000')
+    assert len(dataset) == len(dataset_copy) + 1
+
+
+def test_parallel_readers(tmpdir):
+    images = _build(tmpdir)
+    dataset = LmdbDb(str(tmpdir), 'test', persistent_txn=True)
+    # Open the environment and a transaction in the parent, the workers have to reopen these.
+    dataset['image_000']
+    keys = dataset.keys()
+    pool = multiprocessing.Pool(2)
+    try:
+        sums = pool.map(_sum, [(dataset, key) for key in keys])
+    finally:
+        pool.terminate()
+    assert sums == [int(images[key].sum()) for key in keys]
+
+
+def test_tiled_read_region(tmpdir):
+    image = np.arange(50 * 40, dtype=np.uint16).reshape(50, 40)
+    with LmdbBuilder(str(tmpdir), 'test', chunk_shape=(16, 16)) as builder:
+        builder.write('image', image)
+    dataset = LmdbDb(str(tmpdir), 'test')
+    assert np.array_equal(dataset['image']['data'], image)
+    assert np.array_equal(dataset.read_region('image', (10, 5, 20, 30)), image[10:30, 5:35])
+
+    # Bounding boxes partially outside the image are padded.
+    patch = dataset.read_region('image', (-2, 30, 8, 16), pad_value=7)
+    assert np.all(patch[:2] == 7) and np.all(patch[:, 10:] == 7)
+    assert np.array_equal(patch[2:, :10], image[:6, 30:])
+
+
+def test_chunk_keys_do_not_collide(tmpdir):
+    image = np.arange(32 * 32, dtype=np.uint16).reshape(32, 32)
+    with LmdbBuilder(str(tmpdir), 'test', chunk_shape=(16, 16)) as builder:
+        builder.write('x', image)
+        # Same key as the first chunk of x.
+        builder.write('x/0', np.ones((4, 4), dtype=np.uint8))
+        with pytest.raises(ValueError):
+            builder.write('__manet_keys__', image)
+    dataset = LmdbDb(str(tmpdir), 'test')
+    assert dataset.keys() == ['x', 'x/0']
+    assert np.array_equal(dataset['x']['data'], image)
+    assert np.array_equal(dataset['x/0']['data'], np.ones((4, 4), dtype=np.uint8))
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_codecs_round_trip(tmpdir, codec):
+    image = np.random.RandomState(0).randint(0, 4096, size=(30, 20)).astype(np.uint16)
+    with LmdbBuilder(str(tmpdir), 'test', codec=codec) as builder:
+        builder.write('image', image, {'spacing': (0.1, 0.2)})
+    for persistent_txn in [False, True]:
+        item = LmdbDb(str(tmpdir), 'test', persistent_txn=persistent_txn)['image']
+        assert np.array_equal(item['data'], image)
+        assert item['metadata']['spacing'] == (0.1, 0.2)
+        # Without a persistent transaction every codec returns a writable array.
+        assert persistent_txn or item['data'].flags.writeable
+
+
+@pytest.mark.parametrize('codec', sorted(set(CODECS) - {'raw'}))
+def test_decode_in_blocks(monkeypatch, codec):
+    # Blocks which do not align with the elements or the byte planes of the shuffled data.
+    monkeypatch.setattr(compression, '_BLOCK_SIZE', 37)
+    image = np.random.RandomState(0).randint(0, 2**20, size=(13, 11)).astype(np.int32)
+    data = compression.encode(codec, image.tobytes(), image.itemsize)
+    decoded = compression.decode(codec, data, image.shape, image.dtype)
+    assert np.array_equal(decoded, image) and decoded.flags.writeable
+    with pytest.raises(ValueError):
+        compression.decode(codec, data[:-8], image.shape, image.dtype)
+    with pytest.raises(ValueError):
+        compression.decode(codec, data, (13, 10), image.dtype)
+
+
+def test_close_keeps_shared_environment(tmpdir):
+    images = _build(tmpdir)
+    dataset = LmdbDb(str(tmpdir), 'test', persistent_txn=True)
+    data = dataset['image_003']['data']
+    dataset_copy = dataset.copy()
+    dataset_copy['image_000']
+    dataset_copy.close()
+    other = LmdbDb(str(tmpdir), 'test', persistent_txn=True)
+    other.close()
+    # The views of dataset are still valid, the environment is closed with the last reference.
+    assert int(data.sum()) == int(images['image_003'].sum())
+    assert dataset.lmdb_path in _ENVIRONMENTS
+    dataset.close()
+    # The zero-copy view keeps the environment open, until it is garbage collected itself.
+    assert dataset.lmdb_path in _ENVIRONMENTS
+    assert int(data.sum()) == int(images['image_003'].sum())
+    del data
+    assert dataset.lmdb_path not in _ENVIRONMENTS
+    assert np.array_equal(dataset['image_003']['data'], images['image_003'])
+    dataset.close()
+
+
+def test_garbage_collected_dataset_releases_environment(tmpdir):
+    _build(tmpdir)
+    for persistent_txn in [False, True]:
+        dataset = LmdbDb(str(tmpdir), 'test', persistent_txn=persistent_txn)
+        copy = dataset.copy()
+        data = dataset['image_003']['data']
+        copy['image_004']
+        del dataset
+        assert copy['image_005']['data'][0, 0] == 5
+        del copy
+        gc.collect()
+        # With persistent_txn the returned array is a view into the memory map, which stays valid.
+        assert (str(tmpdir.join('test')) in _ENVIRONMENTS) == persistent_txn
+        assert np.all(data == 3)
+        del data
+        gc.collect()
+        assert str(tmpdir.join('test')) not in _ENVIRONMENTS
+        # The database can be opened for writing again in this process.
+        with LmdbBuilder(str(tmpdir), 'test') as builder:
+            builder.write('image_{}'.format(persistent_txn), np.zeros((8, 8), dtype=np.uint16))
+
+
+def test_record_round_trip():
+    image = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    buf = pack_record(image, {'spacing': (1., 0.5, 0.5), 'modality': 'MG', 'shape': (0, )})
+    shape, dtype, offset, metadata = unpack_header(buf)
+    assert offset == HEADER_SIZE
+    assert shape == image.shape and dtype == image.dtype
+    assert metadata == {'shape': (2, 3, 4), 'dtype': 'int16', 'spacing': (1., 0.5, 0.5), 'modality': 'MG'}
+    data, _ = unpack_record(buf)
+    assert np.array_equal(data, image)
+
+    with pytest.raises(ValueError):
+        unpack_header(b'XXXX' + buf[4:])
+    with pytest.raises(ValueError):
+        pack_record(image, {'spacing': (1., 1.)})
+
+
+def test_legacy_format(tmpdir):
+    images = {'a': np.arange(6, dtype=np.uint8).reshape(2, 3), 'b': np.ones((4, 4), dtype=np.float32)}
+    env = lmdb.open(str(tmpdir.join('test')), map_size=2**20)
+    with env.begin(write=True) as txn:
+        for key, image in images.items():
+            txn.put(key.encode('utf-8'), image.tobytes())
+            metadata = {'shape': image.shape, 'dtype': str(image.dtype), 'spacing': [0.1, 0.1]}
+            txn.put((key + '_metadata').encode('utf-8'), json.dumps(metadata).encode('utf-8'))
+    env.close()
+
+    dataset = LmdbDb(str(tmpdir), 'test')
+    assert dataset.format_version == 0
+    assert sorted(dataset.keys()) == ['a', 'b']
+    # The keys are scanned once and written to the keys file.
+    assert tmpdir.join('test_keys.lst').check()
+    for key, image in images.items():
+        assert np.array_equal(dataset[key]['data'], image)
+        assert dataset[key]['metadata']['spacing'] == [0.1, 0.1]
+
+
+def test_get_many(tmpdir):
+    images = _build(tmpdir)
+    keys = ['image_005', 'image_001', 'image_003']
+    for persistent_txn in [False, True]:
+        dataset = LmdbDb(str(tmpdir), 'test', persistent_txn=persistent_txn)
+        items = dataset.get_many(keys)
+        assert [int(item['data'][0, 0]) for item in items] == [5, 1, 3]
+
+        out = np.zeros((3, 8, 8), dtype=np.uint16)
+        batch = dataset.get_many(keys, stack=True, out=out)
+        assert batch['data'] is out
+        assert np.array_equal(out, np.stack([images[key] for key in keys]))
+        assert len(batch['metadata']) == 3
+        with pytest.raises(KeyError):
+            dataset.get_many(['image_000', 'missing'])
+        with pytest.raises(ValueError):
+            dataset.get_many(keys, stack=True, out=np.zeros((3, 8, 8), dtype=np.float32))
+
+
+def test_key_index(tmpdir):
+    images = _build(tmpdir)
+    # A stale keys file is ignored, the key index stored in the database is used.
+    tmpdir.join('test_keys.lst').write('image_000\n')
+    dataset = LmdbDb(str(tmpdir), 'test')
+    assert dataset.keys() == sorted(images)
+    assert len(dataset) == len(images)
+    dataset.close()
+
+    # A resumed build loads the keys and only adds the new ones.
+    with LmdbBuilder(str(tmpdir), 'test', commit_every=1) as builder:
+        assert builder.has_key('image_003') and len(builder) == len(images)
+        builder.write('extra', np.zeros((2, 2), dtype=np.uint8))
+    dataset = LmdbDb(str(tmpdir), 'test')
+    assert dataset.keys() == sorted(list(images) + ['extra'])
+    assert dataset['extra']['data'].shape == (2, 2)
+
+
+def test_builder_commits_on_pending_bytes(tmpdir):
+    image = np.zeros((64, 64), dtype=np.uint16)
+    with LmdbBuilder(str(tmpdir), 'test', commit_every=64, max_pending_bytes=3 * image.nbytes) as builder:
+        for idx in range(5):
+            builder.write('image_{}'.format(idx), image)
+        # The third record exceeded the limit, so only the last two are pending.
+        assert len(builder) == 3 and len(builder._pending) == 2
+    assert len(LmdbDb(str(tmpdir), 'test')) == 5
+
+
+def _read_or_exit(source):
+    if source < 0:
+        # Simulates a writer killed by the OOM killer.
+        os._exit(3)
+    return np.full((4, 4), source, dtype=np.uint8), {}
+
+
+def test_sharded_db(tmpdir):
+    items = [('image_{:03d}'.format(idx), idx) for idx in range(20)]
+    failed = build_sharded_db(str(tmpdir), 'test', items, 2, read_fn=_read_or_exit, num_workers=0)
+    assert failed == []
+    dataset = ShardedLmdbDb(str(tmpdir), 'test')
+    assert sorted(dataset.keys()) == [key for key, _ in items]
+
+    keys = ['image_005', 'image_012', 'image_001', 'image_018']
+    out = np.zeros((4, 4, 4), dtype=np.uint8)
+    batch = dataset.get_many(keys, stack=True, out=out)
+    assert batch['data'] is out
+    assert [int(_) for _ in out[:, 0, 0]] == [5, 12, 1, 18]
+    assert np.array_equal(dataset.get_many(keys, stack=True)['data'], out)
+    for bad_out in [np.zeros((4, 4, 4), dtype=np.float32), np.zeros((4, 4, 5), dtype=np.uint8),
+                    np.zeros((3, 4, 4), dtype=np.uint8)]:
+        with pytest.raises(ValueError):
+            dataset.get_many(keys, stack=True, out=bad_out)
+
+
+def test_sharded_db_writer_killed(tmpdir):
+    ring = HashRing(2)
+    items = [('image_{:03d}'.format(idx), idx) for idx in range(20)]
+    killed_shard = ring(items[0][0])
+    items[0] = (items[0][0], -1)
+    failed = build_sharded_db(str(tmpdir), 'test', items, 2, read_fn=_read_or_exit, num_workers=0)
+    assert sorted(key for key, _ in failed) == sorted(key for key, _ in items if ring(key) == killed_shard)
+    assert all('exited with code 3' in error for _, error in failed)
+
+
+def test_memmap_round_trip(tmpdir):
+    rng = np.random.RandomState(0)
+    with LmdbBuilder(str(tmpdir), 'test') as builder:
+        builder.write('volume', rng.randint(0, 4096, size=(3, 10, 12)).astype(np.int16), {'spacing': (2., 0.5, 0.5)})
+        builder.write('image', rng.rand(7, 5).astype(np.float32), {'modality': 'MG'})
+        builder.write('mask', rng.rand(6, 6) > 0.5)
+    lmdb_to_memmap(str(tmpdir), 'test', str(tmpdir), 'memmap')
+    # The LMDB database was released, so it can be written again.
+    with LmdbBuilder(str(tmpdir), 'test') as builder:
+        builder.write('empty', np.zeros((0, 4), dtype=np.uint8))
+    lmdb_to_memmap(str(tmpdir), 'test', str(tmpdir), 'memmap')
+
+    lmdb_db = LmdbDb(str(tmpdir), 'test')
+    memmap_db = MemmapDb(str(tmpdir), 'memmap')
+    assert memmap_db.keys() == lmdb_db.keys()
+    for key in lmdb_db.keys():
+        expected, item = lmdb_db[key], memmap_db[key]
+        assert item['data'].dtype == expected['data'].dtype
+        assert np.array_equal(item['data'], expected['data'])
+        assert item['metadata'] == expected['metadata'] == memmap_db.read_metadata(key)
+    assert np.array_equal(memmap_db.read_region('volume', (1, -2, 8, 1, 4, 6)),
+                          lmdb_db.read_region('volume', (1, -2, 8, 1, 4, 6)))
+    keys = ['volume', 'volume']
+    assert np.array_equal(memmap_db.get_many(keys, stack=True)['data'], lmdb_db.get_many(keys, stack=True)['data'])
+
+    del memmap_db['image']
+    assert not memmap_db.has_key('image') and len(memmap_db) == 3
+    loaded = pickle.loads(pickle.dumps(memmap_db))
+    assert np.array_equal(loaded['volume']['data'], lmdb_db['volume']['data'])
+
+
+def test_pyramid_keys_do_not_collide(tmpdir):
+    image = np.arange(20 * 20, dtype=np.uint16).reshape(20, 20)
+    other = np.full((5, 5), 7, dtype=np.uint8)
+    with LmdbBuilder(str(tmpdir), 'test', pyramid=(2, )) as builder:
+        builder.write('x', image)
+        builder.write('x/scale2', other)
+    for order in [['x', 'x/scale2'], ['x/scale2', 'x']]:
+        dataset = LmdbDb(str(tmpdir), 'test')
+        for key in order:
+            if key == 'x':
+                scaled = dataset.read_scaled('x', 2)
+                assert scaled['metadata']['shape'] == (10, 10)
+                assert np.array_equal(scaled['data'], downsample(image, 2))
+            else:
+                assert np.array_equal(dataset[key]['data'], other)
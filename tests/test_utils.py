@@ -0,0 +1,329 @@
+import os
+import warnings
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from skimage.measure import label, regionprops
+
+from manet.utils.image_readers import EVICT_FRACTION, ImageCache, read_image
+from manet.utils.mask_utils import MaskSampler, connected_components
+from manet.utils.patch_utils import BalancedPatchSampler, extract_patch, extract_patches
+from manet.utils.pyramid import downsample
+from manet.utils.tiling import _region_sums, predict_tiled, tile_bboxes
+from manet.utils.window_level import VOI_LUT_FUNCTIONS, window_dtype, window_level, window_levels
+
+
+def _image(dtype=np.uint16, shape=(300, 300)):
+    return np.random.RandomState(0).randint(0, 4096, size=shape).astype(dtype)
+
+
+@pytest.mark.parametrize('voi_lut_fn', VOI_LUT_FUNCTIONS)
+def test_window_level_lut_matches_float(voi_lut_fn):
+    image = _image()
+    for center, width in [(2000, 1000), (2000.5, 999), (100, 1)]:
+        lut = window_level(image, center, width, voi_lut_fn, use_lut=True)
+        direct = window_level(image, center, width, voi_lut_fn, use_lut=False)
+        assert lut.dtype == direct.dtype == np.uint8
+        assert np.array_equal(lut, direct)
+
+
+def test_window_level_linear():
+    values = np.array([1000, 1499, 1500, 2000, 2500, 3000])
+    out = window_level(values, 2000, 1001, 'LINEAR_EXACT', dtype=np.float32)
+    assert np.allclose(out, [0, 0, 0.127, 127.5, 254.873, 255], atol=1e-3)
+
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.int16, np.float32])
+def test_window_level_sitk(dtype):
+    # LINEAR_SITK reproduces the SimpleITK filter read_dcm applied before.
+    image = _image(dtype)
+    for center, width in [(2000, 1000), (2000.5, 999), (1000, 777)]:
+        lower, upper = center - (width - 1) / 2., center + (width - 1) / 2.
+        expected = sitk.GetArrayFromImage(sitk.Cast(
+            sitk.IntensityWindowing(sitk.GetImageFromArray(image), lower, upper, 0, 255), sitk.sitkUInt8))
+        assert np.array_equal(window_level(image, center, width, 'LINEAR_SITK'), expected)
+
+
+def test_window_level_sigmoid():
+    image = _image()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        out = window_level(image, 2000, 10, 'SIGMOID', out_range=(0., 1.))
+    assert out.dtype == np.float32
+    assert out.min() == 0 and out.max() == 1 and len(np.unique(out)) > 2
+
+
+def test_window_dtype():
+    assert window_dtype((0, 255)) == np.uint8
+    assert window_dtype((-128, 127)) == np.int8
+    assert window_dtype((0, 4095)) == np.uint16
+    assert window_dtype((0., 1.)) == np.float32
+    assert window_dtype((-1, 1)) == np.float32
+
+
+def test_window_levels():
+    image = _image()
+    windows = [(2000, 1000), (2200, 1500)]
+    out = window_levels(image, windows)
+    assert out.shape == (2, ) + image.shape
+    for idx, (center, width) in enumerate(windows):
+        assert np.array_equal(out[idx], window_level(image, center, width))
+    # The direct computation into a preallocated array gives the same result as the lookup tables.
+    direct = np.zeros((2, ) + image.shape, dtype=np.uint8)
+    assert window_levels(image, windows, out=direct, use_lut=False) is direct
+    assert np.array_equal(direct, out)
+
+
+def test_extract_patches():
+    image = np.arange(20 * 30, dtype=np.int16).reshape(20, 30)
+    # Inside, partially outside at every border and completely outside the image.
+    bboxes = np.array([[2, 3, 5, 7], [-2, 10, 5, 7], [17, -4, 5, 7], [10, 26, 5, 7], [-3, -5, 5, 7],
+                       [30, 40, 5, 7], [0, 0, 5, 7]])
+    patches = extract_patches(image, bboxes, pad_value=-1)
+    assert patches.shape == (7, 5, 7) and patches.dtype == image.dtype
+    for bbox, patch in zip(bboxes, patches):
+        assert np.array_equal(patch, extract_patch(image, bbox, pad_value=-1))
+    assert np.all(patches[5] == -1)
+
+    # Reference for the padding: the patch read from a padded copy of the image.
+    padded = np.pad(image, 10, constant_values=-1)
+    assert np.array_equal(patches[1], padded[8:13, 20:27])
+
+    out = np.zeros((7, 5, 7), dtype=np.float32)
+    assert extract_patches(image, bboxes, out=out, pad_value=-1) is out
+    assert np.array_equal(out, patches)
+
+    with pytest.raises(ValueError):
+        extract_patches(image, [[0, 0, 5, 7], [0, 0, 5, 6]])
+    with pytest.raises(ValueError):
+        extract_patches(image, bboxes, out=np.zeros((7, 5, 6)))
+
+
+def test_extract_patches_larger_than_image():
+    image = np.ones((4, 4, 4), dtype=np.uint8)
+    patches = extract_patches(image, [[-2, -2, -2, 8, 8, 8], [1, 1, 1, 8, 8, 8]])
+    assert patches.shape == (2, 8, 8, 8)
+    assert patches[0].sum() == 64 and np.all(patches[0, 2:6, 2:6, 2:6] == 1)
+    assert patches[1].sum() == 27
+
+
+# Filenames read by _counting_reader.
+_READS = []
+
+
+def _counting_reader(filename, dtype=np.uint16):
+    _READS.append(filename)
+    return np.arange(64 * 48, dtype=dtype).reshape(64, 48), {'spacing': (0.1, 0.1), 'shape': (64, 48)}
+
+
+def _source(tmpdir, name='image.raw'):
+    source = tmpdir.join(name)
+    source.write('data')
+    return str(source)
+
+
+def test_image_cache_hit_and_miss(tmpdir):
+    cache = ImageCache(str(tmpdir.join('cache')))
+    filename = _source(tmpdir)
+    del _READS[:]
+    image, metadata = cache.read(_counting_reader, filename)
+    cached, cached_metadata = cache.read(_counting_reader, filename)
+    assert len(_READS) == 1
+    assert isinstance(cached, np.memmap) and not cached.flags.writeable
+    assert np.array_equal(cached, image)
+    assert cached_metadata['spacing'] == (0.1, 0.1) and cached_metadata['shape'] == (64, 48)
+
+    # Other parameters and a modified file are different entries.
+    cache.read(_counting_reader, filename, dtype='float32')
+    assert len(_READS) == 2
+    os.utime(filename, (0, 0))
+    cache.read(_counting_reader, filename)
+    assert len(_READS) == 3
+
+
+def test_image_cache_read_only(tmpdir, monkeypatch):
+    cache = ImageCache(str(tmpdir.join('cache')))
+    filename = _source(tmpdir)
+    del _READS[:]
+    cache.read(_counting_reader, filename)
+
+    def utime(*args):
+        raise OSError('Read-only file system')
+    monkeypatch.setattr(os, 'utime', utime)
+    image, _ = cache.read(_counting_reader, filename)
+    assert len(_READS) == 1 and image.shape == (64, 48)
+
+
+def test_image_cache_concurrent(tmpdir):
+    cache = ImageCache(str(tmpdir.join('cache')), max_size=10 * 2**20)
+    filenames = [_source(tmpdir, 'image{}.raw'.format(idx)) for idx in range(4)]
+    expected = np.arange(64 * 48, dtype=np.uint16).reshape(64, 48)
+
+    def read(idx):
+        image, _ = cache.read(_counting_reader, filenames[idx % len(filenames)])
+        return np.array_equal(image, expected)
+    threads = ThreadPool(8)
+    assert all(threads.map(read, range(64)))
+    threads.close()
+    # Every entry is complete and no temporary files are left behind.
+    assert len(cache._entries()) == len(filenames)
+    assert not [_ for _ in tmpdir.join('cache').visit() if _.ext == '.tmp']
+
+
+def test_image_cache_eviction(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    entry_size = 64 * 48 * 2 + 1024
+    cache = ImageCache(cache_dir, max_size=3 * entry_size)
+    filenames = [_source(tmpdir, 'image{}.raw'.format(idx)) for idx in range(4)]
+    del _READS[:]
+    for idx, filename in enumerate(filenames[:3]):
+        cache.read(_counting_reader, filename)
+        # Deterministic order of last use.
+        os.utime(cache._entry_path(filename, {'reader': '_counting_reader'}) + '.npy', (idx, idx))
+    # Using the oldest entry makes it the most recent.
+    cache.read(_counting_reader, filenames[0])
+    assert len(_READS) == 3 and cache._size <= cache.max_size
+
+    # The cache is full, so the least recently used entries are evicted until it is below EVICT_FRACTION.
+    cache.read(_counting_reader, filenames[3])
+    total = sum(size for _, size, _ in cache._entries())
+    assert total <= EVICT_FRACTION * cache.max_size and cache._size == total
+    del _READS[:]
+    for filename in [filenames[3], filenames[0], filenames[1]]:
+        cache.read(_counting_reader, filename)
+    assert _READS == [filenames[1]]
+
+
+def test_image_cache_scaled(tmpdir):
+    cache = ImageCache(str(tmpdir.join('cache')), pyramid_factors=(2, 4))
+    filename = _source(tmpdir)
+    del _READS[:]
+    image = np.arange(64 * 48, dtype=np.uint16).reshape(64, 48)
+    scaled, metadata = cache.read(_counting_reader, filename, scale=2)
+    assert np.array_equal(scaled, downsample(image, 2))
+    assert metadata['shape'] == (32, 24) and metadata['spacing'] == (0.2, 0.2)
+
+    # The full resolution image and the other levels were cached at once.
+    for scale in [4, 1, 2]:
+        cached, cached_metadata = cache.read(_counting_reader, filename, scale=scale)
+        assert np.array_equal(cached, downsample(image, scale))
+        assert cached_metadata['shape'] == cached.shape
+    assert len(_READS) == 1
+    # A factor which is not in the pyramid is computed from the cached full resolution image.
+    assert cache.read(_counting_reader, filename, scale=3)[0].shape == (21, 16)
+    assert len(_READS) == 1
+
+
+def test_read_image_stats(tmpdir):
+    image = _image(shape=(40, 30))
+    filename = str(tmpdir.join('image.mha'))
+    sitk.WriteImage(sitk.GetImageFromArray(image), filename)
+
+    data, metadata = read_image(filename)
+    assert np.array_equal(data, image) and 'peak_bytes' not in metadata
+    data, metadata, stats = read_image(filename, dtype=np.float32, return_stats=True)
+    # The decoded buffer and the cast output.
+    assert stats == {'peak_bytes': image.nbytes + data.nbytes} and 'peak_bytes' not in metadata
+    out = np.zeros(image.shape, dtype=np.uint16)
+    assert read_image(filename, out=out, return_stats=True)[2] == {'peak_bytes': image.nbytes}
+
+    cache = ImageCache(str(tmpdir.join('cache')))
+    _, metadata, stats = read_image(filename, cache=cache, return_stats=True)
+    assert stats['peak_bytes'] == 2 * image.nbytes and 'peak_bytes' not in metadata
+    assert read_image(filename, cache=cache, return_stats=True)[2] == {'peak_bytes': 0}
+    # The pyramid is built from the cached full resolution image.
+    scaled, metadata, stats = read_image(filename, cache=cache, scale=2, return_stats=True)
+    assert scaled.shape == (20, 15) and stats['peak_bytes'] > 0 and 'peak_bytes' not in metadata
+    assert len(read_image(filename, cache=cache, scale=2)) == 2
+    assert 'peak_bytes' not in cache.read(read_image, filename)[1]
+
+
+def test_tile_bboxes():
+    bboxes = tile_bboxes((10, 7), (4, 4), stride=(3, 3))
+    # The last tile along every axis is aligned with the end of the image.
+    assert sorted(set(bboxes[:, 0])) == [0, 3, 6] and sorted(set(bboxes[:, 1])) == [0, 3]
+    assert np.all(bboxes[:, 2:] == 4)
+    # An image smaller than the tile has a single tile, padded at the end.
+    assert tile_bboxes((3, 5), (4, 4)).tolist() == [[0, 0, 4, 4], [0, 1, 4, 4]]
+
+
+@pytest.mark.parametrize('shape', [(37, 29), (9, 11, 13)])
+def test_region_sums(shape):
+    rng = np.random.RandomState(0)
+    mask = rng.rand(*shape) > 0.7
+    ndim = len(shape)
+    # Boxes which are partially or completely outside the mask count only the pixels inside.
+    coords = rng.randint(-5, max(shape), size=(200, ndim))
+    sizes = rng.randint(1, 12, size=(200, ndim))
+    bboxes = np.hstack([coords, sizes])
+    sums = _region_sums(mask, bboxes)
+    padded = np.pad(mask, 20)
+    for bbox, count in zip(bboxes, sums):
+        region = tuple(slice(c + 20, c + s + 20) for c, s in zip(bbox[:ndim], bbox[ndim:]))
+        assert count == padded[region].sum()
+
+
+@pytest.mark.parametrize('mode', ['gaussian', 'linear', 'constant'])
+def test_predict_tiled_identity(mode):
+    image = _image(np.float32, shape=(50, 37))
+    # Overlapping tiles, tiles aligned with the end of the image and an image smaller than the tile.
+    prediction = predict_tiled(image, lambda patches: patches, (16, 16), stride=(10, 10), batch_size=5, mode=mode)
+    assert prediction.dtype == np.float32
+    assert np.allclose(prediction, image)
+    small = image[:10, :12]
+    assert np.allclose(predict_tiled(small, lambda patches: patches, (16, 16), pad_value=-1), small)
+
+    # Two channels, and tiles without foreground are not predicted.
+    mask = np.zeros(image.shape, dtype=bool)
+    mask[:8, :8] = True
+    prediction = predict_tiled(image, lambda patches: np.stack([patches, -patches], axis=1), (16, 16),
+                               mask=mask, num_channels=2, fill_value=-7)
+    assert prediction.shape == (2, ) + image.shape
+    assert np.allclose(prediction[0, :16, :16], image[:16, :16])
+    assert np.allclose(prediction[1, :16, :16], -image[:16, :16])
+    assert np.all(prediction[:, 16:] == -7) and np.all(prediction[:, :, 16:] == -7)
+
+
+def test_balanced_patch_sampler_negatives_avoid_lesion(tmpdir):
+    image = _image(shape=(40, 40))
+    mask = np.zeros((40, 40), dtype=bool)
+    mask[5:35, 5:35] = True
+    filename = str(tmpdir.join('image.mha'))
+    sitk.WriteImage(sitk.GetImageFromArray(image), filename)
+
+    sampler = BalancedPatchSampler([filename], masks=[mask], patch_size=(8, 8), batch_size=64, avoid=5)
+    negatives = sampler._negatives(filename, 2000, np.random.RandomState(0))
+    assert np.all(mask[tuple(negatives.T)] == 0)
+
+    batch = next(iter(sampler))
+    centers = batch['bboxes'][:, :2] + 4
+    labels = batch['labels'] == 1
+    assert labels.sum() == 32
+    # Positives are within the lesion minus the margin, negatives outside the lesion.
+    assert np.all((centers[labels] >= 10) & (centers[labels] < 30))
+    assert np.all(mask[tuple(centers[~labels].T)] == 0)
+    assert np.array_equal(batch['data'][0], extract_patch(image, batch['bboxes'][0]))
+
+    # The complete lesion is kept when the sampler is packed.
+    unpacked = MaskSampler.unpack(sampler.sampler(filename).pack())
+    assert np.array_equal(unpacked.mask_indices, np.flatnonzero(mask))
+    assert np.array_equal(unpacked.indices, sampler.sampler(filename).indices)
+
+
+@pytest.mark.parametrize('shape', [(64, 48), (16, 20, 24)])
+@pytest.mark.parametrize('connectivity', [1, None])
+def test_connected_components_regionprops(shape, connectivity):
+    mask = np.random.RandomState(0).rand(*shape) > 0.6
+    result = connected_components(mask, connectivity=connectivity)
+    expected = label(mask, connectivity=connectivity)
+    assert np.array_equal(result['labels'], expected)
+
+    regions = regionprops(expected)
+    ndim = len(shape)
+    assert len(result['areas']) == len(regions) > 1
+    assert np.array_equal(result['areas'], [region.area for region in regions])
+    bboxes = [region.bbox[:ndim] + tuple(np.subtract(region.bbox[ndim:], region.bbox[:ndim])) for region in regions]
+    assert np.array_equal(result['bboxes'], bboxes)
+    assert np.allclose(result['centroids'], [region.centroid for region in regions])